@@ -1,6 +1,7 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+import os
 import numpy as np
 from scipy import stats
 from skimage.measure import block_reduce
@@ -31,15 +32,201 @@ def corr2_coef(A, B, mode='full'):
         norm_B = np.nan_to_num(norm_B)
         return np.einsum('ij, ij->i', norm_A, norm_B)/A.shape[1]
 
-def parallel_corr2_coef(A, B, filename, block_size=32, n_jobs=8):
+def _unit_rows(X, dtype=np.float32, out=None):
+    """Center the rows of X and scale them to unit norm, in `dtype`; the
+    moments are accumulated in float64. Constant rows become NaN.
+
+    The result is built in place in a single copy of X, or in `out` (e.g.
+    a memmap) if given. X itself is never modified."""
+    if out is None:
+        out = np.array(X, dtype=dtype)
+    else:
+        out[...] = X
+    out -= X.mean(1, dtype=np.float64)[:, None].astype(out.dtype)
+    norm = np.sqrt(np.einsum('ij,ij->i', out, out, dtype=np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out /= norm[:, None].astype(out.dtype)
+    return out
+
+def block_corr2_coef(A, B, out=None, row_block=1024, col_block=4096,
+                     dtype=np.float32):
+    """Cache-blocked row-wise correlation coefficient of two 2D arrays, as
+    corr2_coef(A, B, mode='full').
+
+    Each row of A and B is z-scored once, in `dtype`. B is normalized as a
+    whole, A in blocks of `row_block` rows, and each (row_block, col_block)
+    tile of the correlation matrix is computed by one matrix product and
+    written into `out`. Peak memory is the normalized B plus one block of A
+    and one output tile, so A (e.g. CNN features) may be a memmap much
+    larger than memory; pass the smaller array (e.g. voxels) as B.
+
+    Parameters
+    ----------
+    A : array_like, shape (m, d)
+    B : array_like, shape (n, d)
+    out : array_like, shape (m, n), optional
+        Preallocated output, e.g. a memmap opened with
+        np.lib.format.open_memmap. Allocated in `dtype` if not given.
+    row_block, col_block : int
+        Tile size along the rows of A and B.
+    dtype : data-type
+        Precision of the normalized inputs and of the products.
+
+    Return
+    ------
+    out : the (m, n) correlation matrix. Rows without variance give NaN.
+    """
+    A_size = A.shape[0]
+    B_size = B.shape[0]
+    if out is None:
+        out = np.empty((A_size, B_size), dtype=dtype)
+    elif out.shape != (A_size, B_size):
+        raise ValueError('Output shape %s does not match (%s, %s)' %
+                         (out.shape, A_size, B_size))
+    for i, j, tile in _corr_tiles(A, B, row_block, col_block, dtype):
+        out[i:i+tile.shape[0], j:j+tile.shape[1]] = tile
+    return out
+
+def _corr_tiles(A, B, row_block, col_block, dtype):
+    """Yield (i, j, tile) for each (row_block, col_block) tile of the
+    correlation matrix of A and B, starting at row i and column j."""
+    zB = _unit_rows(B, dtype)
+    for i in range(0, A.shape[0], row_block):
+        zA = _unit_rows(A[i:i+row_block], dtype)
+        for j in range(0, B.shape[0], col_block):
+            yield i, j, np.dot(zA, zB[j:j+col_block].T)
+
+
+class TopKReducer(object):
+    """Streaming top-k selection over the tiles of an (m, n) matrix.
+
+    Keeps, for each column (e.g. each voxel), the `k` largest values seen so
+    far and their row indices, and optionally the `row_k` largest values of
+    each row (e.g. each feature) and their column indices. Tiles can be fed
+    in any order; the full matrix is never held. NaNs are ignored.
+
+    Parameters
+    ----------
+    shape : (m, n)
+        Shape of the full matrix.
+    k : int
+        Number of values kept per column.
+    row_k : int or None
+        Number of values kept per row, None to skip the per-row search.
+    absolute : bool
+        Rank by absolute value; the signed values are returned.
+
+    Usage
+    -----
+    red = TopKReducer((m, n), 10)
+    for i, j, tile in tiles:
+        red.update(tile, i, j)
+    idx, val = red.col_topk()
+    """
+    def __init__(self, shape, k, row_k=None, absolute=False):
+        self.shape = shape
+        self.absolute = absolute
+        self.k = min(k, shape[0])
+        self._col = self._buffers((self.k, shape[1]))
+        self.row_k = None
+        if row_k is not None:
+            self.row_k = min(row_k, shape[1])
+            self._row = self._buffers((shape[0], self.row_k))
+
+    def _buffers(self, shape):
+        return [np.full(shape, -np.inf), np.full(shape, np.nan),
+                np.full(shape, -1, dtype=np.int64)]
+
+    def _rank_key(self, tile):
+        key = np.abs(tile) if self.absolute else tile.astype(np.float64)
+        key[np.isnan(key)] = -np.inf
+        return key
+
+    def _merge(self, buf, key, val, idx, axis):
+        k = buf[0].shape[axis]
+        allkey = np.concatenate([buf[0], key], axis=axis)
+        sel = np.argpartition(-allkey, k-1, axis=axis)
+        if axis == 0:
+            sel = (sel[:k], np.arange(allkey.shape[1])[None])
+        else:
+            sel = (np.arange(allkey.shape[0])[:, None], sel[:, :k])
+        return [allkey[sel],
+                np.concatenate([buf[1], val], axis=axis)[sel],
+                np.concatenate([buf[2], idx], axis=axis)[sel]]
+
+    def update(self, tile, i=0, j=0):
+        """Merge a tile of the matrix whose top-left entry is at (i, j)."""
+        tile = np.asarray(tile)
+        r, c = tile.shape
+        key = self._rank_key(tile)
+        cols = slice(j, j+c)
+        rows_idx = np.broadcast_to(np.arange(i, i+r)[:, None], (r, c))
+        merged = self._merge([b[:, cols] for b in self._col], key, tile,
+                             rows_idx, 0)
+        for b, m in zip(self._col, merged):
+            b[:, cols] = m
+        if self.row_k is not None:
+            rows = slice(i, i+r)
+            cols_idx = np.broadcast_to(np.arange(j, j+c)[None], (r, c))
+            merged = self._merge([b[rows] for b in self._row], key, tile,
+                                 cols_idx, 1)
+            for b, m in zip(self._row, merged):
+                b[rows] = m
+
+    def _sorted(self, buf, axis):
+        order = np.argsort(-buf[0], axis=axis, kind='mergesort')
+        if axis == 0:
+            sel = (order, np.arange(order.shape[1])[None])
+        else:
+            sel = (np.arange(order.shape[0])[:, None], order)
+        return buf[2][sel], buf[1][sel]
+
+    def col_topk(self):
+        """Return (row indices, values), each of shape (k, n), of the top-k
+        entries of each column in decreasing order. Slots never filled hold
+        index -1 and value NaN."""
+        return self._sorted(self._col, 0)
+
+    def row_topk(self):
+        """Return (column indices, values), each of shape (m, row_k), of the
+        top-k entries of each row in decreasing order."""
+        if self.row_k is None:
+            raise ValueError('Per-row top-k was not requested.')
+        return self._sorted(self._row, 1)
+
+
+def topk_corr2_coef(A, B, k, row_k=None, absolute=False, row_block=1024,
+                    col_block=4096, dtype=np.float32):
+    """Top-k row-wise correlations of two 2D arrays, without forming the
+    full correlation matrix.
+
+    The correlation matrix of A (m, d) and B (n, d) is computed tile by
+    tile as in block_corr2_coef and streamed into a TopKReducer, which
+    keeps the `k` best rows of A for each row of B (e.g. the best CNN
+    features of each voxel), and optionally the `row_k` best rows of B for
+    each row of A.
+
+    Return
+    ------
+    A TopKReducer, see its col_topk and row_topk methods.
+    """
+    red = TopKReducer((A.shape[0], B.shape[0]), k, row_k=row_k,
+                      absolute=absolute)
+    for i, j, tile in _corr_tiles(A, B, row_block, col_block, dtype):
+        red.update(tile, i, j)
+    return red
+
+def parallel_corr2_coef(A, B, filename, block_size=32, n_jobs=8,
+                        dtype='float16', resume=False, verbose=0):
     """Compute row-wise correlation coefficient for two 2D arrays in a
     parallel computing approach.
     Array `B` would be divided into several blocks each containing
-    `block_size` rows for one parallel computing iteration.
+    `block_size` rows for one parallel computing iteration; the last block
+    holds the remaining rows.
     
     Usage
     -----
-    cross_modal_corr(A, B, filename, block_size=32, n_jobs=8)
+    parallel_corr2_coef(A, B, filename, block_size=32, n_jobs=8)
     
     Return
     ------
@@ -50,27 +237,68 @@ def parallel_corr2_coef(A, B, filename, block_size=32, n_jobs=8):
     Note
     ----
     'block_size' : the number of rows in `B` processed in one iter.
+    'dtype' : data type of the saved correlation matrix.
+    'resume' : if True and `filename` holds a matrix of the same shape and
+        dtype, only the blocks not yet completed are computed. Completed
+        blocks are recorded in `filename`+'.blocks.npy', see
+        corr2_progress.
+    'verbose' : joblib verbosity level for progress messages.
+
+    The rows of `A` are normalized once, block by block, into the memmap
+    `filename`+'.zA.npy' (removed when done), which the workers share
+    read-only; `B` is shared the same way if it is large (pass a memmap to
+    avoid any copy). Each worker normalizes its block of
+    `B` and writes its columns straight into `filename`, an .npy file opened
+    with np.lib.format.open_memmap.
     """
-    # to reduce memory usage, we compute Pearson's r iteratively
     A_size = A.shape[0]
     B_size = B.shape[0]
-    corr_mtx = np.memmap(filename, dtype='float16', mode='w+',
-                         shape=(A_size, B_size))
+    block_num = (B_size + block_size - 1) / block_size
+    done_file = filename + '.blocks.npy'
+    corr_mtx = None
+    if resume and os.path.exists(filename) and os.path.exists(done_file):
+        corr_mtx = np.lib.format.open_memmap(filename, mode='r+')
+        done = np.lib.format.open_memmap(done_file, mode='r+')
+        if corr_mtx.shape != (A_size, B_size) or \
+           corr_mtx.dtype != np.dtype(dtype) or done.shape != (block_num,):
+            corr_mtx = None
+    if corr_mtx is None:
+        corr_mtx = np.lib.format.open_memmap(filename, mode='w+',
+                                             dtype=dtype,
+                                             shape=(A_size, B_size))
+        done = np.lib.format.open_memmap(done_file, mode='w+', dtype=np.bool_,
+                                         shape=(block_num,))
+    todo = np.nonzero(np.logical_not(done))[0]
     print 'Compute row-wise correlation ...'
+    print '%s of %s blocks to compute' % (len(todo), block_num)
+    za_file = filename + '.zA.npy'
+    zA = np.lib.format.open_memmap(za_file, mode='w+', dtype=np.float32,
+                                   shape=A.shape)
+    for i in range(0, A_size, 1024):
+        _unit_rows(A[i:i+1024], out=zA[i:i+1024])
+    zA.flush()
+    zA = np.load(za_file, mmap_mode='r')
     # parallelize the corr computation
-    Parallel(n_jobs=n_jobs)(delayed(pcorr2_sugar)(A, B, corr_mtx, i,
-                            block_size) for i in range(B_size/block_size))
-    narray = np.nan_to_num(np.array(corr_mtx))
-    np.save(filename, narray)
-
-def pcorr2_sugar(A, B, output, i, block_size):
-    """Sugar function for parallel computing."""
-    print 'Iter %s' %(i)
-    if (i+1)*block_size > B.shape[0]:
-        output[:, i*block_size:] = corr2_coef(A, B[i*block_size:, :])
-    else:
-        output[:, i*block_size:(i+1)*block_size] = corr2_coef(A,
-                    B[i*block_size:(i+1)*block_size, :])
+    Parallel(n_jobs=n_jobs, mmap_mode='r', verbose=verbose)(
+                delayed(pcorr2_sugar)(zA, B, corr_mtx, done, i, block_size)
+                for i in todo)
+    corr_mtx.flush()
+    os.remove(za_file)
+
+def pcorr2_sugar(zA, B, output, done, i, block_size):
+    """Sugar function for parallel computing: correlate the normalized rows
+    `zA` with block `i` of `B`, and mark the block as done."""
+    sel = slice(i*block_size, min(B.shape[0], (i+1)*block_size))
+    output[:, sel] = np.nan_to_num(np.dot(zA, _unit_rows(B[sel]).T))
+    output.flush()
+    done[i] = True
+    done.flush()
+
+def corr2_progress(filename):
+    """Return the number of completed and total blocks of a (possibly
+    interrupted) parallel_corr2_coef run writing `filename`."""
+    done = np.load(filename + '.blocks.npy', mmap_mode='r')
+    return int(done.sum()), done.shape[0]
 
 def unit_vector(vector):
     """Return the unit vector of the input."""
@@ -102,22 +330,45 @@ def img_resize(img, out_dim):
     resized_im = resized_im * (im_max - im_min) + im_min
     return resized_im
 
-def time_lag_corr(x, y, maxlag):
+def time_lag_corr(x, y, maxlag, normalize=False):
     """Calculate cross-correlation between x and a lagged y.
     `x` and `y` are two 1-D vector, `maxlag` refers to the maximum lag value.
+    `x` and `y` may also be stacks of vectors along the last axis, e.g.
+    x of shape (n, 1, T) and y of shape (1, m, T); they are broadcast
+    against each other and the result has shape (..., maxlag).
 
     formula
     -------
-    c_{xy}[k] = sum_n x[n] * y[n+k]
+    c_{xy}[k] = sum_n x[n] * y[n+k] / T
     k : 0 ~ (maxlag-1)
 
+    If `normalize` is True, c_{xy}[k] is instead the Pearson correlation
+    of x[:T-k] and y[k:], i.e. computed over the overlapping window only.
+
+    All lags are computed at once from the FFTs of the zero-padded series.
     """
-    c = np.zeros(maxlag)
-    y = np.array(y)
-    for i in range(maxlag):
-        lagy = np.array(y[i:].tolist()+[0]*i)
-        c[i] = np.correlate(x, lagy) / len(x)
-    return c
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    T = x.shape[-1]
+    if y.shape[-1] != T:
+        raise ValueError('x and y must have the same length.')
+    maxlag = min(maxlag, T)
+    # padding to 2T-1 avoids circular wrap-around; use a fast FFT length
+    nfft = 1 << int(np.ceil(np.log2(2*T-1)))
+    c = np.fft.irfft(np.conj(np.fft.rfft(x, nfft)) * np.fft.rfft(y, nfft),
+                     nfft)[..., :maxlag]
+    if not normalize:
+        return c / T
+    # moments of x[:T-k] and y[k:] for each lag k
+    n = np.arange(T, T-maxlag, -1, dtype=np.float64)
+    sx = np.cumsum(x, -1)[..., T-maxlag:][..., ::-1]
+    sxx = np.cumsum(np.square(x), -1)[..., T-maxlag:][..., ::-1]
+    sy = np.cumsum(y[..., ::-1], -1)[..., ::-1][..., :maxlag]
+    syy = np.cumsum(np.square(y[..., ::-1]), -1)[..., ::-1][..., :maxlag]
+    cov = c - sx * sy / n
+    var = (sxx - np.square(sx) / n) * (syy - np.square(sy) / n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cov / np.sqrt(var)
 
 def r2p(r, sample_size, two_side=True):
     """Calculate p value from correlation coefficient r.
@@ -148,6 +399,61 @@ def make_2d_gaussian(size, sigma, center=None):
 
     return np.exp(-0.5*((x-x0)**2+(y-y0)**2)/sigma**2)/(2*np.pi*sigma**2)
 
+def gaussian_pool(feat, sigmas, centers, out=None, col_block=1024,
+                  dtype=np.float32):
+    """Pool square 2D feature maps with Gaussian kernels on a grid of
+    centers.
+
+    `feat` has the two spatial axes (row, col) first, e.g. (size, size, m);
+    `sigmas` are the standard deviations of the kernels and `centers` the
+    pixel positions of the grid along each axis. The result has shape
+    (len(sigmas), len(centers), len(centers)) + feat.shape[2:], where entry
+    [si, xi, yi] equals
+        make_2d_gaussian(size, sigmas[si], center=(centers[xi], centers[yi]))
+    pooled over the feature maps, i.e. the kernel flattened and dotted with
+    feat.reshape(size*size, -1).
+
+    The Gaussian is separable, so instead of one dense dot product per
+    center and sigma the maps are contracted with the 1D kernels of all
+    sigmas along the rows in one matrix product, then along the columns per
+    sigma. The trailing axes are processed in blocks of `col_block`
+    columns, which takes about (size + len(sigmas)*len(centers)) * size *
+    col_block values of scratch memory; `out` may be a preallocated array
+    (e.g. a memmap) of the result shape.
+    """
+    size = feat.shape[0]
+    if feat.shape[1] != size:
+        raise ValueError('Feature maps must be square.')
+    rest = feat.shape[2:]
+    m = int(np.prod(rest))
+    ns, nc = len(sigmas), len(centers)
+    shape = (ns, nc, nc) + rest
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError('Output shape %s does not match %s' %
+                         (out.shape, shape))
+    flat_feat = feat.reshape(size, size, m)
+    flat_out = out.reshape(ns, nc, nc, m)
+    # 1D kernels of all sigmas, with the 2D normalization folded in
+    d = np.arange(size, dtype=np.float64)[None, :] - \
+        np.asarray(centers, dtype=np.float64)[:, None]
+    kernels = np.array([np.exp(-0.5*d**2/s**2)/np.sqrt(2*np.pi*s**2)
+                        for s in sigmas]).astype(dtype)
+    row_kernels = kernels.reshape(ns*nc, size)
+    for j in range(0, m, col_block):
+        f = np.asarray(flat_feat[:, :, j:j+col_block], dtype=dtype)
+        mc = f.shape[2]
+        # contract rows: (ns*nc_y, size_x*mc)
+        tmp = np.dot(row_kernels, f.reshape(size, size*mc))
+        tmp = tmp.reshape(ns, nc, size, mc)
+        for si in range(ns):
+            # contract columns: (nc_x, size_x) x (size_x, nc_y*mc)
+            t = tmp[si].transpose(1, 0, 2).reshape(size, nc*mc)
+            flat_out[si, :, :, j:j+mc] = np.dot(kernels[si],
+                                                t).reshape(nc, nc, mc)
+    return out
+
 def make_2d_dog(size, c_sigma, s_sigma, c_beta, s_beta, center=None):
     """Make a square difference of gaussian (DoG) kernel.
 
@@ -2,6 +2,7 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
 import numpy as np
+from scipy import stats
 
 def zero_one_norm(mat, two_side=False):
     """Normalize each column of input 2D array into zero-one range.
@@ -20,70 +21,227 @@ def zero_one_norm(mat, two_side=False):
     else:
         return (mat - col_min)/(col_max - col_min)
 
-def zscore(mat, return_unzvals=False):
+def _rows_view(mat, axis):
+    """Return a 2D view of `mat` whose rows are the series normalized along
+    `axis`."""
+    if mat.ndim != 2 or axis not in (0, 1, -1):
+        raise ValueError('Only the axes of 2D arrays are supported.')
+    return mat.T if axis == 0 else mat
+
+def _out_array(mat, out, dtype):
+    """Return the output array of an element-wise normalization; `out` may
+    be `mat` itself for in-place operation."""
+    if out is None:
+        return np.empty(mat.shape, dtype)
+    if out.shape != mat.shape:
+        raise ValueError('Output shape %s does not match %s' %
+                         (out.shape, mat.shape))
+    return out
+
+def _float_dtype(mat, dtype):
+    if dtype is not None:
+        return np.dtype(dtype)
+    if np.issubdtype(mat.dtype, np.floating):
+        return mat.dtype
+    return np.dtype(np.float64)
+
+def zscore(mat, return_unzvals=False, axis=1, out=None, dtype=None,
+           block_size=1024):
     """Z-scores the rows of [mat] by subtracting off the mean and dividing
     by the standard deviation.
     If [return_unzvals] is True, a matrix will be returned that can be used
     to return the z-scored values to their original state.
+    [axis] is the axis the statistics are computed along, 1 for rows and 0
+    for columns. The result is written into [out] if given, which may be
+    [mat] itself for in-place operation, and is of [dtype] (default: the
+    floating type of [mat]). Moments are accumulated in float64, blocks of
+    [block_size] series at a time, so no full-size float64 copy is made.
     """
-    zmat = np.empty(mat.shape, mat.dtype)
-    unzvals = np.zeros((zmat.shape[0], 2), mat.dtype)
-    for ri in range(mat.shape[0]):
-        unzvals[ri,0] = np.std(mat[ri,:])
-        unzvals[ri,1] = np.mean(mat[ri,:])
-        zmat[ri,:] = (mat[ri,:]-unzvals[ri,1]) / (1e-10+unzvals[ri,0])
+    dtype = _float_dtype(mat, dtype)
+    zmat = _out_array(mat, out, dtype)
+    src = _rows_view(mat, axis)
+    dst = _rows_view(zmat, axis)
+    unzvals = np.zeros((src.shape[0], 2), dtype)
+    for i in range(0, src.shape[0], block_size):
+        blk = src[i:i+block_size]
+        mean = blk.mean(axis=1, dtype=np.float64)
+        std = blk.std(axis=1, dtype=np.float64)
+        unzvals[i:i+block_size, 0] = std
+        unzvals[i:i+block_size, 1] = mean
+        dst[i:i+block_size] = blk
+        dst[i:i+block_size] -= mean[:, None].astype(dst.dtype)
+        dst[i:i+block_size] /= (1e-10+std)[:, None].astype(dst.dtype)
     
     if return_unzvals:
         return zmat, unzvals
     
     return zmat
 
-def center(mat, return_uncvals=False):
+def center(mat, return_uncvals=False, axis=1, out=None, dtype=np.float64,
+           block_size=1024):
     """Centers the rows of [mat] by subtracting off the mean, but doesn't 
     divide by the SD.
-    Can be undone like zscore.
+    Can be undone like zscore. [axis], [out], [dtype] and [block_size] are
+    as in zscore.
     """
-    cmat = np.empty(mat.shape)
-    uncvals = np.ones((mat.shape[0], 2))
-    for ri in range(mat.shape[0]):
-        uncvals[ri,1] = np.mean(mat[ri,:])
-        cmat[ri,:] = mat[ri,:]-uncvals[ri,1]
+    cmat = _out_array(mat, out, dtype)
+    src = _rows_view(mat, axis)
+    dst = _rows_view(cmat, axis)
+    uncvals = np.ones((src.shape[0], 2), dtype)
+    for i in range(0, src.shape[0], block_size):
+        blk = src[i:i+block_size]
+        mean = blk.mean(axis=1, dtype=np.float64)
+        uncvals[i:i+block_size, 1] = mean
+        dst[i:i+block_size] = blk
+        dst[i:i+block_size] -= mean[:, None].astype(dst.dtype)
     
     if return_uncvals:
         return cmat, uncvals
     
     return cmat
 
-def unzscore(mat, unzvals):
+def unzscore(mat, unzvals, axis=1, out=None, dtype=np.float64):
     """Un-Z-scores the rows of [mat] by multiplying by unzvals[:,0] (the standard deviations)
     and then adding unzvals[:,1] (the row means).
+    [axis], [out] and [dtype] are as in zscore.
     """
-    unzmat = np.empty(mat.shape)
-    for ri in range(mat.shape[0]):
-        unzmat[ri,:] = mat[ri,:]*(1e-10+unzvals[ri,0])+unzvals[ri,1]
+    unzmat = _out_array(mat, out, dtype)
+    dst = _rows_view(unzmat, axis)
+    dst[:] = _rows_view(mat, axis)
+    dst *= (1e-10+unzvals[:, 0])[:, None].astype(dst.dtype)
+    dst += unzvals[:, 1][:, None].astype(dst.dtype)
     return unzmat
 
+
+class StreamingStats(object):
+    """Running mean and standard deviation of data seen in chunks.
+
+    Chunks are stacked along `axis` (the sample axis, e.g. 0 for a (time,
+    feature) array read a block of time points at a time); the moments of
+    each chunk are merged into the running ones with the pairwise update of
+    Chan et al. (a batched Welford update), in float64.
+
+    The statistics can be saved with `save` and reapplied, e.g. to z-score
+    validation data with the statistics of the training data.
+
+    Usage
+    -----
+    st = StreamingStats(axis=0)
+    for i in range(0, len(feat), 1000):
+        st.update(feat[i:i+1000])
+    zfeat = st.zscore(feat)
+    """
+    def __init__(self, axis=0):
+        self.axis = axis
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, chunk):
+        """Add a chunk of samples."""
+        chunk = np.asarray(chunk)
+        nb = chunk.shape[self.axis]
+        if nb == 0:
+            return self
+        mb = chunk.mean(axis=self.axis, dtype=np.float64)
+        m2b = chunk.var(axis=self.axis, dtype=np.float64) * nb
+        if self.n == 0:
+            self.n, self.mean, self.m2 = nb, mb, m2b
+            return self
+        n = self.n + nb
+        delta = mb - self.mean
+        self.mean = self.mean + delta * nb / n
+        self.m2 = self.m2 + m2b + delta**2 * self.n * nb / n
+        self.n = n
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / self.n
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def unzvals(self):
+        """The statistics in the format returned by zscore, for unzscore."""
+        return np.column_stack([self.std, self.mean])
+
+    def _expand(self, v, ndim):
+        # a negative axis counts from the end of the chunk shape
+        return np.expand_dims(v, self.axis % ndim)
+
+    def zscore(self, chunk, out=None, dtype=None):
+        """Z-score a chunk of samples with the running statistics; `out`
+        may be `chunk` itself for in-place operation."""
+        chunk = np.asarray(chunk)
+        res = _out_array(chunk, out, _float_dtype(chunk, dtype))
+        res[:] = chunk
+        res -= self._expand(self.mean, chunk.ndim).astype(res.dtype)
+        res /= self._expand(1e-10+self.std, chunk.ndim).astype(res.dtype)
+        return res
+
+    def save(self, filename):
+        """Save the statistics to a .npz file."""
+        np.savez(filename, axis=self.axis, n=self.n, mean=self.mean,
+                 m2=self.m2)
+
+    @classmethod
+    def load(cls, filename):
+        """Load statistics saved with `save`."""
+        with np.load(filename) as f:
+            st = cls(axis=int(f['axis']))
+            st.n = int(f['n'])
+            st.mean = f['mean']
+            st.m2 = f['m2']
+        return st
+
+def zscore_chunked(mat, out=None, axis=0, chunk_size=1024, stats=None,
+                   dtype=None):
+    """Z-score a (possibly memmapped) 2D array along `axis` chunk by chunk.
+    The statistics are accumulated in one pass over the chunks, unless
+    `stats` (a StreamingStats, e.g. from the training data) is given, and
+    applied in a second pass. `out` may be `mat` itself (e.g. a memmap
+    opened in r+ mode) or another memmap for out-of-core operation.
+    Returns the normalized array and the StreamingStats.
+    """
+    dtype = _float_dtype(mat, dtype)
+    out = _out_array(mat, out, dtype)
+    n = mat.shape[axis]
+    def _sel(i):
+        sl = [slice(None)] * mat.ndim
+        sl[axis] = slice(i, i+chunk_size)
+        return tuple(sl)
+    if stats is None:
+        stats = StreamingStats(axis=axis)
+        for i in range(0, n, chunk_size):
+            stats.update(mat[_sel(i)])
+    for i in range(0, n, chunk_size):
+        stats.zscore(mat[_sel(i)], out=out[_sel(i)])
+    return out, stats
+
 def gaussianize(vec):
     """Uses a look-up table to force the values in [vec] to be gaussian."""
-    ranks = np.argsort(np.argsort(vec))
-    cranks = (ranks+1).astype(float)/(ranks.max()+2)
-    vals = scipy.stats.norm.isf(1-cranks)
-    zvals = vals/vals.std()
-    return zvals
+    return gaussianize_mat(np.asarray(vec)[:, None])[:, 0]
 
 def gaussianize_mat(mat):
     """Gaussianizes each column of [mat]."""
-    gmat = np.empty(mat.shape)
-    for ri in range(mat.shape[1]):
-        gmat[:,ri] = gaussianize(mat[:,ri])
-    return gmat
+    ranks = np.argsort(np.argsort(mat, axis=0), axis=0)
+    cranks = (ranks+1).astype(float)/(ranks.max(axis=0)+2)
+    vals = stats.norm.isf(1-cranks)
+    return vals/vals.std(axis=0)
 
-def make_delayed(stim, delays, circpad=False):
+def make_delayed(stim, delays, circpad=False, lazy=False):
     """Creates non-interpolated concatenated delayed versions of [stim] with the given [delays] 
     (in samples).
     
     If [circpad], instead of being padded with zeros, [stim] will be circularly shifted.
+    If [lazy], a DelayedDesign standing for the same matrix is returned
+    instead, without copying [stim].
     """
+    if lazy:
+        return DelayedDesign(stim, delays, circpad=circpad)
     nt,ndim = stim.shape
     dstims = []
     for di,d in enumerate(delays):
@@ -101,3 +259,131 @@ def make_delayed(stim, delays, circpad=False):
         dstims.append(dstim)
     return np.hstack(dstims)
 
+
+
+class DelayedDesign(object):
+    """Time-delayed design matrix, as make_delayed(stim, delays, circpad),
+    represented without copying [stim].
+
+    Row t of the block of delay d is stim[t-d] (zero, or stim[(t-d) % T]
+    with [circpad], when t-d is out of range). Products with the design are
+    computed from [stim] and shifts:
+        X.dot(W)   = sum_d shift(stim . W_d, d)
+        X.tdot(Y)  = [stim.T . shift(Y, -d)]_d
+        X . X.T    = sum_d shift(shift(stim . stim.T, d, 0), d, 1)
+    so the Gram matrix of an FIR encoding model costs one (T, T) product of
+    the undelayed stimuli. ridge.gram, and with it the dual solvers of
+    ridge, ridge_corr and bootstrap_ridge, and DualWeights, accept a
+    DelayedDesign wherever a stimulus matrix is expected. Indexing (e.g.
+    X[rows], X[:, cols]) and np.asarray(X) materialize the selected part,
+    which is what the primal (SVD) solvers fall back to.
+
+    Parameters
+    ----------
+    stim : array_like, shape (T, N)
+        Undelayed stimuli, may be a memmap.
+    delays : list of int
+        Delays in samples.
+    circpad : bool
+        Circular instead of zero padding.
+    """
+    def __init__(self, stim, delays, circpad=False):
+        self.stim = stim
+        self.delays = list(delays)
+        self.circpad = circpad
+
+    @property
+    def shape(self):
+        nt, ndim = self.stim.shape
+        return (nt, ndim*len(self.delays))
+
+    @property
+    def dtype(self):
+        return self.stim.dtype
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def shift(self, A, d, axis=0):
+        """Return `A` delayed by `d` samples along `axis`:
+        out[t] = A[t-d], with this design's padding."""
+        A = np.asarray(A)
+        if self.circpad:
+            return np.roll(A, d, axis=axis)
+        n = A.shape[axis]
+        out = np.zeros(A.shape, A.dtype)
+        dst = [slice(None)] * A.ndim
+        src = [slice(None)] * A.ndim
+        if d >= 0:
+            dst[axis], src[axis] = slice(d, n), slice(0, max(0, n-d))
+        else:
+            dst[axis], src[axis] = slice(0, max(0, n+d)), slice(-d, n)
+        out[tuple(dst)] = A[tuple(src)]
+        return out
+
+    def blocks(self):
+        """Yield (d, column slice) of each delay block."""
+        ndim = self.stim.shape[1]
+        for di, d in enumerate(self.delays):
+            yield d, slice(di*ndim, (di+1)*ndim)
+
+    def dot(self, W):
+        """np.dot(X, W) for W of shape (N*len(delays), M)."""
+        stim = self._cast(W.dtype)
+        return sum(self.shift(np.dot(stim, W[sel]), d)
+                   for d, sel in self.blocks())
+
+    def tdot(self, Y):
+        """np.dot(X.T, Y) for Y of shape (T, M)."""
+        stim = self._cast(Y.dtype)
+        return np.concatenate([np.dot(stim.T, self.shift(Y, -d))
+                               for d, sel in self.blocks()])
+
+    def _cast(self, dtype):
+        return np.asarray(self.stim,
+                          dtype=np.result_type(self.stim.dtype, dtype))
+
+    def shift_gram(self, K):
+        """The kernel of two delayed designs with the same delays from the
+        kernel `K` of their undelayed stimuli."""
+        return sum(self.shift(self.shift(K, d, 0), d, 1)
+                   for d in self.delays)
+
+    def same_delays(self, other):
+        return isinstance(other, DelayedDesign) and \
+               self.delays == other.delays and self.circpad == other.circpad
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, cols = key
+        nt, ndim = self.stim.shape
+        rinds = np.arange(nt)[rows]
+        cinds = np.arange(self.shape[1])[cols]
+        scalar_r, scalar_c = np.ndim(rinds) == 0, np.ndim(cinds) == 0
+        rinds, cinds = np.atleast_1d(rinds), np.atleast_1d(cinds)
+        out = np.zeros((len(rinds), len(cinds)), self.dtype)
+        for di, d in enumerate(self.delays):
+            cm = np.nonzero(cinds // ndim == di)[0]
+            if not len(cm):
+                continue
+            src = rinds - d
+            if self.circpad:
+                src %= nt
+            rm = np.nonzero((src >= 0) & (src < nt))[0]
+            if len(rm):
+                feats = cinds[cm] % ndim
+                out[np.ix_(rm, cm)] = np.asarray(self.stim[src[rm]])[:, feats]
+        if scalar_c:
+            out = out[:, 0]
+        if scalar_r:
+            out = out[0]
+        return out
+
+    def __array__(self, dtype=None):
+        X = self[:, :]
+        return X if dtype is None else X.astype(dtype)
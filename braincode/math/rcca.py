@@ -5,11 +5,27 @@ import numpy as np
 from scipy.linalg import eigh
 from scipy.stats import chisqprob
 import h5py
+from joblib import Parallel, delayed
+
+from svdbackend import svd, SVDBackend
+
+# version of the HDF5 layout written by _CCABase.save
+FORMAT_VERSION = 3
+
+# arrays larger than this (in bytes) are saved as datasets, not attributes,
+# which HDF5 limits to 64 kB
+_MAX_ATTR_BYTES = 32768
+
+# (voxel/feature axis, component axis) of the per-dataset arrays
+_AXES = {"ws": (0, 1), "comps": (None, 1), "ev": (1, 0), "preds": (1, None),
+         "corrs": (0, None)}
 
 class _CCABase(object):
     def __init__(self, numCV = None, reg = None, regs = None, numCC = None,
                  numCCs = None, kernelcca = True, ktype = None, verbose = False,
-                 select = 0.2, cutoff = 1e-15, gausigma = 1.0, degree = 2):
+                 select = 0.2, cutoff = 1e-15, gausigma = 1.0, degree = 2,
+                 svd_backend = None, solver = "auto", kapprox = None,
+                 krank = None):
         self.numCV = numCV
         self.reg = reg
         self.regs = regs
@@ -21,6 +37,10 @@ class _CCABase(object):
         self.select = select
         self.gausigma = gausigma
         self.degree = degree
+        self.svd_backend = svd_backend
+        self.solver = solver
+        self.kapprox = kapprox
+        self.krank = krank
         if self.kernelcca and self.ktype == None:
             self.ktype = "linear"
         self.verbose = verbose
@@ -32,7 +52,7 @@ class _CCABase(object):
                 print("Training CCA, %s kernel, regularization = %0.4f, %d components" % (self.ktype, self.reg, self.numCC))
             else:
                 print("Training CCA, regularization = %0.4f, %d components" % (self.reg, self.numCC))
-        comps = kcca(data, self.reg, self.numCC, kernelcca = self.kernelcca, ktype = self.ktype, gausigma = self.gausigma, degree = self.degree)
+        comps = kcca(data, self.reg, self.numCC, kernelcca = self.kernelcca, ktype = self.ktype, gausigma = self.gausigma, degree = self.degree, svd_backend = self.svd_backend, kapprox = self.kapprox, krank = self.krank, solver = self.solver, verbose = self.verbose)
         self.cancorrs, self.ws, self.comps = recon(data, comps, kernelcca = self.kernelcca)
         if len(data) == 2:
             self.cancorrs = self.cancorrs[np.nonzero(self.cancorrs)]
@@ -51,45 +71,106 @@ class _CCABase(object):
         nC = self.ws[0].shape[1]
         nF = [d.shape[1] for d in vdata]
         self.ev = [np.zeros((nC, f)) for f in nF]
-        for cc in range(nC):
-            ccs = cc+1
-            if self.verbose:
-                print("Computing explained variance for component #%d" % ccs)
-            preds, corrs = predict(vdata, [w[:, ccs-1:ccs] for w in self.ws], self.cutoff)
-            resids = [abs(d[0]-d[1]) for d in zip(vdata, preds)]
-            for s in range(nD):
-                ev = abs(vdata[s].var(0) - resids[s].var(0))/vdata[s].var(0)
+        # all canonical components of all datasets in one projection
+        ccomp = _listdot([d.T for d in vdata], self.ws)
+        ccsum = np.sum(ccomp, 0)
+        for s in range(nD):
+            # the prediction of dataset s from component cc is the z-scored
+            # mean projection of the other datasets, times sign(ws[s][:, cc])
+            proj = np.nan_to_num(_zscore((ccsum - ccomp[s])/(nD-1)))
+            sign = np.sign(self.ws[s])
+            dvar = vdata[s].var(0)
+            for cc in range(nC):
+                if self.verbose:
+                    print("Computing explained variance for component #%d" % (cc+1))
+                resid = np.abs(vdata[s] - proj[:, cc:cc+1]*sign[:, cc])
+                ev = abs(dvar - resid.var(0))/dvar
                 ev[np.isnan(ev)] = 0.
                 self.ev[s][cc] = ev
         return self.ev
 
-    def save(self, filename):
+    def save(self, filename, compression = "gzip", compression_opts = 4):
+        '''Save the model to an HDF5 file.
+        Per-dataset arrays (ws, comps, ev, ...) go to groups dataset0, dataset1, ... as chunked datasets compressed with compression (None for contiguous, uncompressed datasets, which load(lazy = True) maps into memory), so they can be read in voxel or component slices (see read). Other attributes, and the file format version, are stored as file attributes, except for large arrays (e.g. the shared response of MultisetCCA), which are stored as datasets in the root group.
+        '''
         h5 = h5py.File(filename, "a")
+        h5.attrs["format_version"] = FORMAT_VERSION
         for key, value in self.__dict__.items():
+            if key.startswith("_"):
+                continue
             if value is not None:
                 if isinstance(value, list):
                     for di in range(len(value)):
                         grpname = "dataset%d" % di
                         dgrp = h5.require_group(grpname)
-                        try:
-                            dgrp.create_dataset(key, data=value[di])
-                        except RuntimeError:
-                            del h5[grpname][key]
-                            dgrp.create_dataset(key, data=value[di])
+                        if key in dgrp:
+                            del dgrp[key]
+                        data = np.asarray(value[di])
+                        if compression is None or data.ndim == 0 or data.size == 0:
+                            dgrp.create_dataset(key, data = data)
+                        else:
+                            dgrp.create_dataset(key, data = data, chunks = _chunks(data.shape), compression = compression, compression_opts = compression_opts, shuffle = True)
+                elif isinstance(value, np.ndarray) and value.nbytes > _MAX_ATTR_BYTES:
+                    if key in h5:
+                        del h5[key]
+                    h5.create_dataset(key, data = value)
                 else:
                     h5.attrs[key] = value
         h5.close()
 
-    def load(self, filename):
-        h5 = h5py.File(filename, "a")
+    def load(self, filename, lazy = False):
+        '''Load a model saved with save.
+        If lazy, the per-dataset arrays are not read: they become h5py datasets, or read-only memmaps for contiguous uncompressed datasets, which read only the slices indexed. The file stays open until close is called.
+        '''
+        self.close()
+        h5 = h5py.File(filename, "r")
+        version = h5.attrs.get("format_version", 1)
+        if version > FORMAT_VERSION:
+            h5.close()
+            raise ValueError("%s has CCA format version %s, newer than %s" % (filename, version, FORMAT_VERSION))
         for key, value in h5.attrs.items():
-            setattr(self, key, value)
-        for di in range(len(h5.keys())):
+            if key != "format_version":
+                setattr(self, key, value)
+        for key, value in h5.items():
+            if isinstance(value, h5py.Dataset):
+                setattr(self, key, value[()])
+        for di in range(len([k for k in h5.keys() if k.startswith("dataset")])):
             ds = "dataset%d" % di
             for key, value in h5[ds].items():
                 if di == 0:
                     setattr(self, key, [])
-                self.__getattribute__(key).append(value.value)
+                if lazy:
+                    self.__getattribute__(key).append(_lazy_dataset(value, filename))
+                else:
+                    self.__getattribute__(key).append(value[()])
+        if lazy:
+            self._h5 = h5
+        else:
+            h5.close()
+        return self
+
+    def close(self):
+        '''Close the file held open by load(lazy = True).'''
+        h5 = getattr(self, "_h5", None)
+        if h5 is not None:
+            h5.close()
+            self._h5 = None
+
+    def read(self, key, dataset = 0, voxels = slice(None), comps = slice(None)):
+        '''Read the selected voxels (features) and canonical components of the array key of a dataset, e.g. read("ws", 1, voxels = idx, comps = slice(0, 3)).
+        Works on eagerly and lazily loaded models; only the selected part is read from a lazily loaded one.
+        '''
+        value = getattr(self, key)[dataset]
+        axes = _AXES.get(key, (0, 1))
+        sel = [slice(None)]*len(value.shape)
+        if axes[0] is not None:
+            sel[axes[0]] = voxels
+        if axes[1] is not None:
+            sel[axes[1]] = comps
+        if len(sel) == 2 and not isinstance(sel[0], slice) and not isinstance(sel[1], slice):
+            # h5py indexes one axis with a list at a time
+            return np.asarray(value[sel[0], :])[:, sel[1]]
+        return np.asarray(value[tuple(sel)])
 
 class CCACrossValidate(_CCABase):
     '''Attributes:
@@ -99,6 +180,12 @@ class CCACrossValidate(_CCABase):
         kernelcca - True if using a kernel (default), False if not kernelized.
         ktype - type of kernel if kernelcca == True (linear or gaussian). Default is linear.
         verbose - True is default
+        svd_backend - method computing the largest kernel eigenvalue the kernels are normalized by: "lanczos", "power", "eigvalsh" or an SVD backend (see braincode.math.svdbackend). Default is None (Lanczos). With the primal solver an SVD backend also computes the SVDs of the datasets; the kernel solver always uses scipy.linalg.eigh.
+        kapprox - None (exact kernel, default), "nystrom" or "rff" (random Fourier features, gaussian kernel only) low-rank kernel approximation, see _make_kernel.
+        krank - rank of the kernel approximation.
+        solver - "kernel", "primal" or "auto" (default), see kcca.
+        n_jobs - number of folds set up at a time, and of threads solving their (fold, reg) problems. Default is 1.
+        seed - seed of the random cross-validation folds. Default is None (numpy global random state).
 
     Results:
         ws - canonical weights
@@ -107,54 +194,80 @@ class CCACrossValidate(_CCABase):
         corrs - correlations on the validation dataset
         preds - predictions on the validation dataset
         ev - explained variance for each canonical dimension
+        cv_corrs - mean cross-validation score of each (reg, numCC) pair
     '''
-    def __init__(self, numCV = None, regs = None, numCCs = None, kernelcca = True, ktype = None, verbose = True, select = 0.2, cutoff = 1e-15, gausigma = 1.0, degree = 2):
+    def __init__(self, numCV = None, regs = None, numCCs = None, kernelcca = True, ktype = None, verbose = True, select = 0.2, cutoff = 1e-15, gausigma = 1.0, degree = 2, svd_backend = None, solver = "auto", kapprox = None, krank = None, n_jobs = 1, seed = None):
         numCV = 10 if numCV is None else numCV
         regs = np.array(np.logspace(-3, 1, 10)) if regs is None else regs
         numCCs = np.arange(5, 10) if numCCs is None else numCCs
-        super(CCACrossValidate, self).__init__(numCV = numCV, regs = regs, numCCs = numCCs, kernelcca = kernelcca, ktype = ktype, verbose = verbose, select = select, cutoff = cutoff, gausigma = gausigma, degree = degree)
+        super(CCACrossValidate, self).__init__(numCV = numCV, regs = regs, numCCs = numCCs, kernelcca = kernelcca, ktype = ktype, verbose = verbose, select = select, cutoff = cutoff, gausigma = gausigma, degree = degree, svd_backend = svd_backend, solver = solver, kapprox = kapprox, krank = krank)
+        self.n_jobs = n_jobs
+        self.seed = seed
 
     def train(self, data):
         """
         Train CCA for a set of regularization coefficients and/or numbers of CCs
         data - list of training data matrices (number of samples X number of features). Number of samples has to match across datasets.
+
+        The numCV folds are drawn once and shared by all (reg, numCC) pairs. The kernels (or SVDs, or reduced kernels, for the primal solver) of a fold are computed once; each reg is solved once for the largest numCC and the smaller numCCs are read off the same eigendecomposition. Up to n_jobs folds are set up at a time, and their (fold, reg) problems are solved in parallel threads sharing the fold matrices.
+        The mean validation score of each (reg, numCC) pair is kept in cv_corrs.
         """
-        nT = data[0].shape[0]
-        chunklen = 10 if nT > 50 else 1
-        nchunks = int(0.2*nT/chunklen)
-        allinds = range(nT)
-        indchunks = zip(*[iter(allinds)]*chunklen)
-        corr_mat = np.zeros((len(self.regs), len(self.numCCs)))
-        selection = int(self.select*min([d.shape[1] for d in data]))
-        if selection == 0:
-            selection = 1
-        for ri, reg in enumerate(self.regs):
-            for ci, numCC in enumerate(self.numCCs):
-                corr_mean = 0
-                for cvfold in range(self.numCV):
-                    if self.verbose:
-                        if self.kernelcca:
-                            print("Training CV CCA, %s kernel, regularization = %0.4f, %d components, fold #%d" % (self.ktype, reg, numCC, cvfold+1))
-                        else:
-                            print("Training CV CCA, regularization = %0.4f, %d components, fold #%d" % (reg, numCC, cvfold+1))
-                    np.random.shuffle(indchunks)
-                    heldinds = [ind for chunk in indchunks[:nchunks] for ind in chunk]
-                    notheldinds = list(set(allinds)-set(heldinds))
-                    comps = kcca([d[notheldinds] for d in data], reg, numCC, kernelcca = self.kernelcca, ktype=self.ktype, gausigma = self.gausigma, degree = self.degree)
-                    cancorrs, ws, ccomps = recon([d[notheldinds] for d in data], comps, kernelcca = self.kernelcca)
-                    preds, corrs = predict([d[heldinds] for d in data], ws, self.cutoff)
-                    corrs_idx = [np.argsort(cs)[::-1] for cs in corrs]
-                    corr_mean += np.mean([corrs[corri][corrs_idx[corri][:selection]].mean() for corri in range(len(corrs))])
-                corr_mat[ri, ci] = corr_mean/self.numCV
+        selection = _cv_selection(data, self.select)
+        folds = _cv_folds(data[0].shape[0], self.numCV, self.seed)
+        solver = choose_solver([(len(folds[0][1]), d.shape[1]) for d in data], kernelcca = self.kernelcca, solver = self.solver, ktype = self.ktype, kapprox = self.kapprox)
+        fold_scores = np.zeros((self.numCV, len(self.regs), len(self.numCCs)))
+        for start in range(0, self.numCV, self.n_jobs):
+            group = range(start, min(self.numCV, start+self.n_jobs))
+            setups = Parallel(n_jobs = self.n_jobs, backend = "threading")(
+                delayed(self._cv_setup)(data, folds[fi], solver) for fi in group)
+            scores = Parallel(n_jobs = self.n_jobs, backend = "threading")(
+                delayed(self._cv_scores)(setup, fi, reg, selection)
+                for setup, fi in zip(setups, group) for reg in self.regs)
+            for k, fi in enumerate(group):
+                fold_scores[fi] = scores[k*len(self.regs):(k+1)*len(self.regs)]
+            del setups
+        corr_mat = fold_scores.mean(0)
+        self.cv_corrs = corr_mat
         best_ri, best_ci = np.where(corr_mat == corr_mat.max())
         self.best_reg = self.regs[best_ri[0]]
         self.best_numCC = self.numCCs[best_ci[0]]
-        comps = kcca(data, self.best_reg, self.best_numCC, kernelcca = self.kernelcca, ktype = self.ktype, gausigma = self.gausigma, degree = self.degree)
+        comps = kcca(data, self.best_reg, self.best_numCC, kernelcca = self.kernelcca, ktype = self.ktype, gausigma = self.gausigma, degree = self.degree, svd_backend = self.svd_backend, kapprox = self.kapprox, krank = self.krank, solver = self.solver, verbose = self.verbose)
         self.cancorrs, self.ws, self.comps = recon(data, comps, kernelcca = self.kernelcca)
         if len(data) == 2:
             self.cancorrs = self.cancorrs[np.nonzero(self.cancorrs)]
         return self
 
+    def _cv_setup(self, data, fold, solver):
+        """Split the data of a fold and set up its eigenproblem, which does not depend on reg."""
+        heldinds, notheldinds = fold
+        train = [d[notheldinds] for d in data]
+        test = [d[heldinds] for d in data]
+        if solver == "primal" and not self.kernelcca:
+            problem = linear_cca_svds(train)
+        else:
+            problem = kcca_matrices(train, kernelcca = self.kernelcca, ktype = self.ktype, gausigma = self.gausigma, degree = self.degree, svd_backend = self.svd_backend, kapprox = self.kapprox, krank = self.krank, solver = solver)
+        return solver, problem, train, test
+
+    def _cv_scores(self, setup, cvfold, reg, selection):
+        """Validation scores of one fold and reg for every numCC."""
+        solver, problem, train, test = setup
+        if self.verbose:
+            if self.kernelcca:
+                print("Training CV CCA, %s kernel, regularization = %0.4f, fold #%d" % (self.ktype, reg, cvfold+1))
+            else:
+                print("Training CV CCA, regularization = %0.4f, fold #%d" % (reg, cvfold+1))
+        maxCC = max(self.numCCs)
+        if solver == "primal" and not self.kernelcca:
+            allcomps = linear_cca_solve(problem, reg, maxCC)
+        else:
+            allcomps = kcca_solve(problem[0], problem[1], problem[2], reg, maxCC, problem[3])
+        scores = np.zeros(len(self.numCCs))
+        for ci, numCC in enumerate(self.numCCs):
+            comps = [c[:, :numCC] for c in allcomps]
+            cancorrs, ws, ccomps = recon(train, comps, kernelcca = self.kernelcca)
+            scores[ci] = _cv_score(test, ws, self.cutoff, selection)
+        return scores
+
 class CCA(_CCABase):
     '''Attributes:
         reg - regularization parameters. Default is 0.1.
@@ -162,6 +275,10 @@ class CCA(_CCABase):
         kernelcca - True if using a kernel (default), False if not kernelized.
         ktype - type of kernel if kernelcca == True (linear or gaussian). Default is linear.
         verbose - True is default
+        svd_backend - method computing the largest kernel eigenvalue the kernels are normalized by: "lanczos", "power", "eigvalsh" or an SVD backend (see braincode.math.svdbackend). Default is None (Lanczos). With the primal solver an SVD backend also computes the SVDs of the datasets; the kernel solver always uses scipy.linalg.eigh.
+        kapprox - None (exact kernel, default), "nystrom" or "rff" (random Fourier features, gaussian kernel only) low-rank kernel approximation, see _make_kernel.
+        krank - rank of the kernel approximation.
+        solver - "kernel", "primal" or "auto" (default), see kcca.
 
     Results:
         ws - canonical weights
@@ -171,12 +288,94 @@ class CCA(_CCABase):
         preds - predictions on the validation dataset
         ev - explained variance for each canonical dimension
     '''
-    def __init__(self, reg = 0., numCC = 10, kernelcca = True, ktype = None, verbose = True, cutoff = 1e-15):
-        super(CCA, self).__init__(reg = reg, numCC = numCC, kernelcca = kernelcca, ktype = ktype, verbose = verbose, cutoff = cutoff)
+    def __init__(self, reg = 0., numCC = 10, kernelcca = True, ktype = None, verbose = True, cutoff = 1e-15, svd_backend = None, solver = "auto", kapprox = None, krank = None):
+        super(CCA, self).__init__(reg = reg, numCC = numCC, kernelcca = kernelcca, ktype = ktype, verbose = verbose, cutoff = cutoff, svd_backend = svd_backend, solver = solver, kapprox = kapprox, krank = krank)
 
     def train(self, data):
         return super(CCA, self).train(data)
 
+class MultisetCCA(_CCABase):
+    '''Multiset (generalized, MAXVAR) linear CCA of many datasets, e.g. the voxel responses of several subjects to the same stimuli, solved in a truncated-SVD subspace of each dataset.
+    Each dataset is reduced to its leading rank singular vectors (or the fewest holding an energy fraction of its variance), whitened with regularization reg, and the shared response is the leading numCC left singular vectors of the concatenated whitened subspaces, see multiset_cca. The weights are mapped back to voxels, so validate, compute_ev, predict and save work as for CCA, and further datasets can be aligned to the shared response with add_subject without refitting the others.
+
+    If regs and/or numCCs are given, reg and numCC are selected by cross-validation as in CCACrossValidate: the datasets are reduced once per fold, and each reg is solved once for the largest numCC.
+
+    Attributes:
+        reg - regularization parameter, relative to the largest squared singular value of each dataset (see multiset_cca). Default is 0.1.
+        numCC - number of canonical dimensions to keep. Default is 10.
+        regs - regularization parameters to cross-validate. Default is None ([reg]).
+        numCCs - numbers of canonical dimensions to cross-validate. Default is None ([numCC]).
+        numCV - number of crossvalidation folds. Default is 10.
+        seed - seed of the random cross-validation folds. Default is None (numpy global random state).
+        rank - number of singular vectors kept per dataset. Default is None (all).
+        energy - if given, keep the fewest leading singular vectors holding this fraction of the variance of each dataset (at most rank).
+        svd_backend - SVD backend of the per-dataset reduction (see braincode.math.svdbackend). Default is None: "randomized" if rank or energy is given, "gesdd" otherwise.
+        verbose - True is default
+
+    Results:
+        ws - canonical weights
+        comps - canonical components
+        cancorrs - pairwise correlations of the canonical components on the training dataset
+        shared - shared response, (number of samples X numCC) with orthonormal columns
+        sigmas - singular values of the shared response; sigmas**2/(number of datasets) is the mean squared correlation of the datasets with it
+        corrs - correlations on the validation dataset
+        preds - predictions on the validation dataset
+        ev - explained variance for each canonical dimension
+        cv_corrs - mean cross-validation score of each (reg, numCC) pair, if cross-validated
+    '''
+    def __init__(self, reg = 0.1, numCC = 10, regs = None, numCCs = None, numCV = 10, rank = None, energy = None, svd_backend = None, verbose = True, select = 0.2, cutoff = 1e-15, seed = None):
+        super(MultisetCCA, self).__init__(numCV = numCV, reg = reg, regs = regs, numCC = numCC, numCCs = numCCs, kernelcca = False, verbose = verbose, select = select, cutoff = cutoff, svd_backend = svd_backend, solver = "primal")
+        self.rank = rank
+        self.energy = energy
+        self.seed = seed
+
+    def train(self, data):
+        if self.regs is not None or self.numCCs is not None:
+            self.cross_validate(data)
+        if self.verbose:
+            print("Training multiset CCA of %d datasets, regularization = %0.4f, %d components" % (len(data), self.reg, self.numCC))
+        svds = linear_cca_svds(data, svd_backend = self.svd_backend, rank = self.rank, energy = self.energy)
+        if self.verbose:
+            print("Dataset ranks: %s" % [len(S) for U, S, Vh in svds])
+        ws, self.shared, self.sigmas = multiset_cca(svds, self.reg, self.numCC)
+        self.cancorrs, self.ws, self.comps = recon(data, ws, kernelcca = False)
+        return self
+
+    def cross_validate(self, data):
+        '''Select reg and numCC among regs and numCCs by the mean validation score over numCV random folds (see CCACrossValidate); sets reg, numCC, best_reg, best_numCC and cv_corrs.'''
+        regs = [self.reg] if self.regs is None else self.regs
+        numCCs = [self.numCC] if self.numCCs is None else self.numCCs
+        selection = _cv_selection(data, self.select)
+        folds = _cv_folds(data[0].shape[0], self.numCV, self.seed)
+        fold_scores = np.zeros((self.numCV, len(regs), len(numCCs)))
+        for fi, (heldinds, notheldinds) in enumerate(folds):
+            train = [d[notheldinds] for d in data]
+            test = [d[heldinds] for d in data]
+            # the reduction of a fold does not depend on reg
+            svds = linear_cca_svds(train, svd_backend = self.svd_backend, rank = self.rank, energy = self.energy)
+            for ri, reg in enumerate(regs):
+                if self.verbose:
+                    print("Training CV multiset CCA, regularization = %0.4f, fold #%d" % (reg, fi+1))
+                ws = multiset_cca(svds, reg, max(numCCs))[0]
+                for ci, numCC in enumerate(numCCs):
+                    fold_scores[fi, ri, ci] = _cv_score(test, [w[:, :numCC] for w in ws], self.cutoff, selection)
+        self.cv_corrs = fold_scores.mean(0)
+        best_ri, best_ci = np.where(self.cv_corrs == self.cv_corrs.max())
+        self.reg = self.best_reg = regs[best_ri[0]]
+        self.numCC = self.best_numCC = numCCs[best_ci[0]]
+        return self.cv_corrs
+
+    def add_subject(self, d):
+        '''Align a further dataset d (number of samples X number of features, the same training samples as the datasets of train) to the shared response, leaving the weights of the other datasets unchanged. Returns its canonical weights.'''
+        if not hasattr(self, 'shared'):
+            raise NameError("Algorithm needs to be trained!")
+        svds = linear_cca_svds([d], svd_backend = self.svd_backend, rank = self.rank, energy = self.energy)
+        w = multiset_cca_add(svds[0], self.shared, self.sigmas, self.reg)
+        self.ws.append(w)
+        self.comps.append(np.dot(d, w))
+        self.cancorrs = _listcorr(self.comps)
+        return w
+
 def predict(vdata, ws, cutoff = 1e-15):
     '''Get predictions for each dataset based on the other datasets and weights. Find correlations with actual dataset.'''
     iws = [np.linalg.pinv(w.T, rcond = cutoff) for w in ws]
@@ -197,16 +396,52 @@ def predict(vdata, ws, cutoff = 1e-15):
     return preds, corrs
 
 def kcca(data, reg = 0., numCC=None, kernelcca = True, ktype = "linear",
-         gausigma = 1.0, degree = 2):
+         gausigma = 1.0, degree = 2, svd_backend = None, solver = "auto",
+         verbose = False, kapprox = None, krank = None):
     '''Set up and solve the eigenproblem for the data in kernel and specified reg
+    svd_backend - method computing the largest eigenvalue the kernels are normalized by, see _make_kernel; with the primal solver, an SVD backend also computes the SVDs of the datasets (see linear_cca). The dense generalized eigenproblem of the kernel solver is always solved by scipy.linalg.eigh, and exact SVD backends normalize the kernels by Lanczos iteration (see _max_eig), so they only change the result of the primal solver
+    kapprox, krank - low-rank kernel approximation and its rank, see _make_kernel; the eigenproblem is then solved in the span of the kernel features (see kcca_matrices), so neither the nT x nT kernels nor the (number of datasets * nT)^2 block matrices are formed
+    solver - "kernel" builds the dense (sum of nFs)^2 block matrices of the kernels (or of the features if not kernelcca) and solves the generalized eigenproblem; "primal" solves the same problem in feature space: through the thin SVD of each dataset for linear CCA (kernelcca = False, see linear_cca), and in the span of the centered features for the exact linear kernel (see kcca_matrices); "auto" picks "primal" whenever its eigenproblem is smaller (see choose_solver)
+    verbose - if True, the estimated peak memory of the solver is printed before allocating
     '''
-    if kernelcca:
-        kernel = [_make_kernel(d, ktype = ktype, gausigma = gausigma, degree = degree) for d in data]
+    solver = choose_solver([d.shape for d in data], kernelcca = kernelcca, solver = solver, ktype = ktype, kapprox = kapprox)
+    if verbose:
+        nbytes = cca_memory([d.shape for d in data], numCC, kernelcca = kernelcca, solver = solver, krank = krank if kapprox is not None else None)
+        print("CCA %s solver, estimated peak memory %0.1f MB" % (solver, nbytes/1024.**2))
+    if solver == "primal" and not kernelcca:
+        if svd_backend in _EIG_METHODS:
+            svd_backend = None
+        return linear_cca(data, reg, numCC, svd_backend = svd_backend)
+    LH, RH, nFs, basis = kcca_matrices(data, kernelcca = kernelcca, ktype = ktype, gausigma = gausigma, degree = degree, svd_backend = svd_backend, kapprox = kapprox, krank = krank, solver = solver)
+    numCC = data[0].shape[0] if numCC is None else numCC
+    return kcca_solve(LH, RH, nFs, reg, numCC, basis)
+
+def kcca_matrices(data, kernelcca = True, ktype = "linear", gausigma = 1.0,
+                  degree = 2, svd_backend = None, kapprox = None, krank = None,
+                  solver = "kernel"):
+    '''Set up the left and right sides of the kcca eigenproblem, without the regularization.
+    Returns LH, RH, the list of block sizes nFs and the basis of the components; see kcca_solve.
+    With a kernel approximation (kapprox), the kernels phi_i phi_i^T only act on the span of the features of all datasets, and so do the eigenvectors of nonzero eigenvalue: the problem is set up for their coordinates in an orthonormal basis B of [phi_1, ..., phi_n], with the kernels B^T phi_i phi_i^T B, so its blocks are at most (number of datasets * krank) wide instead of nT. The basis is None otherwise.
+    With the primal solver, the exact linear kernel is set up the same way from its features, the centered datasets scaled as in _make_kernel (see _linear_factor): the blocks are at most the sum of the feature counts wide, and the components of nonzero canonical correlation are those of the kernel solver.
+    '''
+    basis = None
+    if kernelcca and (kapprox is not None or solver == "primal"):
+        if kapprox is not None:
+            phis = [_kernel_factor(d, ktype = ktype, gausigma = gausigma, degree = degree, approx = kapprox, rank = krank) for d in data]
+        else:
+            phis = [_linear_factor(d) for d in data]
+        basis = np.linalg.qr(np.hstack(phis))[0]
+        kernel = []
+        for phi in phis:
+            factor = np.dot(basis.T, phi)
+            kernel.append(np.dot(factor, factor.T))
+        del phis
+    elif kernelcca:
+        kernel = [_make_kernel(d, ktype = ktype, gausigma = gausigma, degree = degree, svd_backend = svd_backend) for d in data]
     else:
         kernel = [d.T for d in data]
 
     nFs = [k.shape[0] for k in kernel]
-    numCC = min([k.shape[1] for k in kernel]) if numCC is None else numCC
 
     # Get the kernel auto- and cross-covariance matrices
     if kernelcca:
@@ -220,26 +455,151 @@ def kcca(data, reg = 0., numCC=None, kernelcca = True, ktype = "linear",
 
     # Fill the left and right sides of the eigenvalue problem
     for i in range(len(kernel)):
-        RH[int(np.sum(nFs[:i])):int(np.sum(nFs[:i+1])), int(np.sum(nFs[:i])):int(np.sum(nFs[:i+1]))] = crosscovs[i*(len(kernel)+1)] + reg*np.eye(nFs[i])
+        RH[int(np.sum(nFs[:i])):int(np.sum(nFs[:i+1])), int(np.sum(nFs[:i])):int(np.sum(nFs[:i+1]))] = crosscovs[i*(len(kernel)+1)]
         for j in range(len(kernel)):
             if i !=j:
                 LH[int(np.sum(nFs[:i])):int(np.sum(nFs[:i+1])), int(np.sum(nFs[:j])):int(np.sum(nFs[:j+1]))] = crosscovs[len(kernel)*j+i]
 
     LH = (LH+LH.T)/2.
     RH = (RH+RH.T)/2.
+    return LH, RH, nFs, basis
 
+def kcca_solve(LH, RH, nFs, reg, numCC, basis = None):
+    '''Solve the eigenproblem set up by kcca_matrices for regularization reg.
+    The components of every numCC' < numCC are the first numCC' columns of the result. If a basis is given, the components are mapped back from their coordinates in it.
+    '''
     maxCC = LH.shape[0]
+    numCC = min(numCC, maxCC)
+    RH = RH + reg*np.eye(maxCC)
 
     r, Vs = eigh(LH, RH, eigvals = (maxCC-numCC, maxCC-1))
     r[np.isnan(r)] = 0
     rindex = np.argsort(r)[::-1]
     comp = []
     Vs = Vs[:, rindex]
-    for i in range(len(kernel)):
+    for i in range(len(nFs)):
         comp.append(Vs[int(np.sum(nFs[:i])):int(np.sum(nFs[:i+1])), :numCC])
-    
+    if basis is not None:
+        comp = [np.dot(basis, c) for c in comp]
+
     return comp
 
+def linear_cca(data, reg = 0., numCC = None, svd_backend = None):
+    '''Solve the eigenproblem of kcca for linear CCA in feature space (kernelcca = False) from the thin SVD of each dataset.
+    Each dataset d = U S V^T is whitened by its own SVD: the components lie in the span of V, and the whitened cross-covariances are the blocks of Q^T Q with Q = [U_i S_i/sqrt(S_i^2+reg)], so only a (sum of ranks)^2 problem is solved: one SVD of Q_1^T Q_2 for two datasets, an eigendecomposition otherwise.
+    Returns the same components as kcca with solver = "kernel" (up to sign), or an approximation of them with a truncated svd_backend (see linear_cca_svds).
+    '''
+    return linear_cca_solve(linear_cca_svds(data, svd_backend = svd_backend), reg, numCC)
+
+def linear_cca_svds(data, svd_backend = None, rank = None, energy = None):
+    '''Thin SVDs of the datasets for linear_cca_solve, without the negligible singular values.
+    rank, energy - truncate each SVD to its leading rank components, or the fewest holding an energy fraction of the variance, computed with svd_backend ("randomized" by default when truncating, see braincode.math.svdbackend)
+    '''
+    if svd_backend is None:
+        svd_backend = "gesdd" if rank is None and energy is None else "randomized"
+    svds = []
+    for d in data:
+        U, S, Vh = svd(d, svd_backend, rank = rank, energy = energy)
+        keep = S > 1e-10*S[0]
+        svds.append((U[:, keep], S[keep], Vh[keep]))
+    return svds
+
+def linear_cca_solve(svds, reg = 0., numCC = None):
+    '''Solve linear CCA for regularization reg from the SVDs of linear_cca_svds, see linear_cca.'''
+    Qs = []
+    bases = []
+    for U, S, Vh in svds:
+        scale = 1./np.sqrt(S**2 + reg)
+        Qs.append(U*(S*scale))
+        bases.append(Vh.T*scale)
+    nRs = [Q.shape[1] for Q in Qs]
+    if len(svds) == 2:
+        numCC = min(nRs) if numCC is None else min(numCC, min(nRs))
+        P, r, Rh = np.linalg.svd(np.dot(Qs[0].T, Qs[1]), full_matrices = False)
+        # eigenvectors [p; q]/sqrt(2) of the whitened block matrix
+        Bs = [P[:, :numCC]/np.sqrt(2), Rh[:numCC].T/np.sqrt(2)]
+    else:
+        numCC = sum(nRs) if numCC is None else min(numCC, sum(nRs))
+        Q = np.hstack(Qs)
+        M = np.dot(Q.T, Q)
+        bounds = np.cumsum([0]+nRs)
+        for i in range(len(svds)):
+            M[bounds[i]:bounds[i+1], bounds[i]:bounds[i+1]] = 0
+        maxCC = M.shape[0]
+        r, Vs = eigh(M, eigvals = (maxCC-numCC, maxCC-1))
+        Vs = Vs[:, np.argsort(r)[::-1]]
+        Bs = [Vs[bounds[i]:bounds[i+1]] for i in range(len(svds))]
+    return [np.dot(basis, B) for basis, B in zip(bases, Bs)]
+
+def multiset_cca(svds, reg = 0., numCC = None):
+    '''Multiset (MAXVAR) linear CCA from the (truncated) SVDs of linear_cca_svds.
+    Each dataset d = U S V^T is whitened as in linear_cca, Q_i = U_i S_i/sqrt(S_i^2+reg_i), with reg relative to the largest squared singular value, reg_i = reg*S_i[0]^2 (as kcca normalizes the kernels by their largest eigenvalue), and the thin SVD Q = [Q_1, ..., Q_n] = G Sigma B^T gives the shared response G, the numCC directions best explained by all datasets together. The weights of dataset i are V_i diag(1/sqrt(S_i^2+reg_i)) B_i, with B_i = Q_i^T G Sigma^-1 its block of B, so only a (number of samples X sum of ranks) matrix is decomposed whatever the number of voxels. For two datasets and reg = 0 the components are those of linear_cca (up to scale).
+    Returns the weights, G and Sigma.
+    '''
+    Q = np.hstack([U*(S/np.sqrt(S**2 + reg*S[0]**2)) for U, S, Vh in svds])
+    numCC = min(Q.shape) if numCC is None else min(numCC, min(Q.shape))
+    G, sigmas, Bh = svd(Q)
+    G = G[:, :numCC]
+    sigmas = sigmas[:numCC]
+    ws = [multiset_cca_add(usv, G, sigmas, reg) for usv in svds]
+    return ws, G, sigmas
+
+def multiset_cca_add(usv, shared, sigmas, reg = 0.):
+    '''Weights of a dataset with thin SVD usv = (U, S, Vh) aligned to the shared response and singular values of multiset_cca, V diag(S/(S^2+reg*S[0]^2)) U^T G Sigma^-1, i.e. its multiset CCA weights as if the shared response had been fit with it.'''
+    U, S, Vh = usv
+    return np.dot(Vh.T*(S/(S**2 + reg*S[0]**2)), np.dot(U.T, shared))/sigmas
+
+def choose_solver(shapes, kernelcca = True, solver = "auto", ktype = "linear", kapprox = None):
+    '''Resolves the CCA solver for datasets of the given (nT, nF) shapes.
+    "auto" selects the primal solver when the sum of the dataset ranks (at most min(nT, nF) each) is smaller than the size of the dense problem, the dense solver otherwise: the sum of the feature counts for linear CCA in feature space (kernelcca = False), and nT for the exact linear kernel (kernelcca = True, ktype = "linear", no kapprox), which is then solved in the span of the features. Other kernels always use the kernel solver.
+    '''
+    linear = not kernelcca or (ktype in (None, "linear") and kapprox is None)
+    if solver == "auto":
+        if not linear:
+            return "kernel"
+        nprimal = sum(min(shape) for shape in shapes)
+        if kernelcca:
+            ndense = shapes[0][0]
+        else:
+            ndense = sum(shape[1] for shape in shapes)
+        return "primal" if nprimal < ndense else "kernel"
+    if solver not in ("kernel", "primal"):
+        raise ValueError("Unknown CCA solver %s" % solver)
+    if solver == "primal" and not linear:
+        raise ValueError("The primal CCA solver needs kernelcca = False or an exact linear kernel.")
+    return solver
+
+def cca_memory(shapes, numCC = None, kernelcca = True, solver = "kernel", krank = None):
+    '''Estimated peak memory (in bytes, float64) of kcca for datasets of the given (nT, nF) shapes.
+    krank - rank of the kernel approximation, if any (see kcca_matrices); the primal solver of the linear kernel is estimated as a kernel approximation of the rank of all the features
+    '''
+    nT = shapes[0][0]
+    nD = len(shapes)
+    if solver == "primal" and kernelcca:
+        krank = sum(shape[1] for shape in shapes)
+    if solver == "primal" and not kernelcca:
+        nRs = [min(shape) for shape in shapes]
+        nR = sum(nRs)
+        numCC = nR if numCC is None else numCC
+        # SVD of the largest dataset, the whitened factors and bases, and the eigenproblem
+        biggest = max(shapes, key = lambda shape: shape[0]*shape[1])
+        nvals = biggest[0]*biggest[1] + min(biggest)**2
+        nvals += nT*nR + sum(shape[1]*r for shape, r in zip(shapes, nRs))
+        nvals += (2*nR**2 if nD > 2 else min(nRs)**2) + nR*numCC
+    elif kernelcca and krank is not None:
+        nR = min(nT, krank if solver == "primal" else nD*krank)
+        nF = nD*nR
+        numCC = nT if numCC is None else min(numCC, nF)
+        # features and their basis, reduced kernels, cross-covariances, LH, RH, the workspace of eigh and the mapped components
+        nvals = 2*nT*nR + nD*nR**2 + 5*nF**2 + nF*numCC + nD*nT*numCC
+    else:
+        nFs = [nT if kernelcca else shape[1] for shape in shapes]
+        nF = sum(nFs)
+        numCC = nT if numCC is None else numCC
+        # kernels, cross-covariances, LH, RH and the workspace of eigh
+        nvals = (nD*nT**2 if kernelcca else 0) + nF**2 + 4*nF**2 + nF*numCC
+    return 8*nvals
+
 def recon(data, comp, corronly=False, kernelcca = True):
     nT = data[0].shape[0]
     # Get canonical variates and CCs
@@ -277,6 +637,31 @@ def cca_chi_test(X_cc, Y_cc, X_size, Y_size):
         dof = (X_size-i)*(Y_size-i)
         print 'Canonical component %s, p : %s'%(i+1, chisqprob(c, dof))
 
+def _cv_folds(nT, numCV, seed = None):
+    '''Random cross-validation folds (held-out indices, training indices), each holding out 20% of the nT samples in chunks of 10 (of 1 for up to 50 samples)'''
+    chunklen = 10 if nT > 50 else 1
+    nchunks = int(0.2*nT/chunklen)
+    allinds = range(nT)
+    indchunks = zip(*[iter(allinds)]*chunklen)
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    folds = []
+    for cvfold in range(numCV):
+        rng.shuffle(indchunks)
+        heldinds = [ind for chunk in indchunks[:nchunks] for ind in chunk]
+        notheldinds = sorted(set(allinds)-set(heldinds))
+        folds.append((heldinds, notheldinds))
+    return folds
+
+def _cv_selection(data, select):
+    '''Number of best predicted features a cross-validation score is averaged over'''
+    return max(1, int(select*min([d.shape[1] for d in data])))
+
+def _cv_score(test, ws, cutoff, selection):
+    '''Cross-validation score of the weights ws: mean prediction correlation on the test datasets of their selection best predicted features'''
+    preds, corrs = predict(test, ws, cutoff)
+    corrs_idx = [np.argsort(cs)[::-1] for cs in corrs]
+    return np.mean([corrs[corri][corrs_idx[corri][:selection]].mean() for corri in range(len(corrs))])
+
 def _zscore(d): return (d-d.mean(0))/d.std(0)
 def _demean(d): return d-d.mean(0)
 def _listdot(d1, d2): return [np.dot(x[0].T, x[1]) for x in zip(d1, d2)]
@@ -284,26 +669,50 @@ def _listcorr(a):
     '''Returns pairwise row correlations for all items in array as a list of matrices
     '''
     corrs = np.zeros((a[0].shape[1], len(a), len(a)))
+    za = [_unitcols(ai) for ai in a]
     for i in range(len(a)):
-        for j in range(len(a)):
-            if j>i:
-                corrs[:, i, j] = [np.nan_to_num(np.corrcoef(ai, aj)[0,1]) for (ai, aj) in zip(a[i].T, a[j].T)]
+        for j in range(i+1, len(a)):
+            corrs[:, i, j] = np.nan_to_num(np.einsum('ij,ij->j', za[i], za[j]))
     return corrs
 def _rowcorr(a, b):
     '''Correlations between corresponding matrix rows
     '''
-    cs = np.zeros((a.shape[0]))
-    for idx in range(a.shape[0]):
-        cs[idx] = np.corrcoef(a[idx], b[idx])[0,1]
-    return cs
+    return np.einsum('ij,ij->j', _unitcols(a.T), _unitcols(b.T))
+def _unitcols(d):
+    '''Centers the columns of d and scales them to unit norm'''
+    cd = _demean(d)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return cd/np.sqrt(np.einsum('ij,ij->j', cd, cd))
+
+def _chunks(shape, size = 32768):
+    '''HDF5 chunk shape of about size elements for an array of shape, at most 32 wide along the last axis'''
+    if len(shape) == 1:
+        return (min(shape[0], size),)
+    last = min(shape[-1], 32)
+    rest = [1]*(len(shape)-2)
+    return tuple(rest) + (min(shape[-2], max(1, size//last)), last)
+
+def _lazy_dataset(ds, filename):
+    '''A read-only memmap of a contiguous uncompressed h5py dataset, or the dataset itself'''
+    offset = ds.id.get_offset()
+    if ds.chunks is None and offset is not None and ds.dtype.isnative and ds.size:
+        return np.memmap(filename, mode = "r", dtype = ds.dtype, shape = ds.shape, offset = offset)
+    return ds
 
 def _make_kernel(d, normalize = True, ktype = "linear", gausigma = 1.0,
-                 degree = 2):
+                 degree = 2, svd_backend = None, approx = None, rank = None,
+                 seed = 0):
     '''Makes a kernel for data d
       If ktype is "linear", the kernel is a linear inner product
       If ktype is "gaussian", the kernel is a Gaussian kernel with sigma = gausigma
       If ktype is "poly", the kernel is a polynomial kernel with degree = degree
+      If approx is "nystrom" or "rff", the kernel is the approximation phi phi^T of rank `rank` of _kernel_factor, built without the exact kernel or the pairwise distances; it is still nT x nT, kcca_matrices avoids forming it
+      The kernel is normalized by its largest eigenvalue (see _max_eig, svd_backend selects the method); for an approximate kernel it is the exact largest eigenvalue of the small matrix phi^T phi
     '''
+    if approx is not None:
+        phi = _kernel_factor(d, normalize = normalize, ktype = ktype, gausigma = gausigma, degree = degree, approx = approx, rank = rank, seed = seed)
+        kernel = np.dot(phi, phi.T)
+        return (kernel+kernel.T)/2.
     d = np.nan_to_num(d)
     cd = _demean(d)
     if ktype == "linear":
@@ -316,5 +725,90 @@ def _make_kernel(d, normalize = True, ktype = "linear", gausigma = 1.0,
         kernel = np.dot(cd, cd.T)**degree
     kernel = (kernel+kernel.T)/2.
     if normalize:
-        kernel = kernel / np.linalg.eigvalsh(kernel).max()
+        kernel = kernel / _max_eig(kernel, svd_backend)
     return kernel
+
+def _kernel_factor(d, normalize = True, ktype = "linear", gausigma = 1.0,
+                   degree = 2, approx = "nystrom", rank = None, seed = 0):
+    '''Features phi of _kernel_features, scaled so that phi phi^T is normalized by its largest eigenvalue as in _make_kernel'''
+    phi = _kernel_features(d, approx, rank, ktype = ktype, gausigma = gausigma, degree = degree, seed = seed)
+    if normalize:
+        phi = phi / np.sqrt(np.linalg.eigvalsh(np.dot(phi.T, phi)).max())
+    return phi
+
+def _linear_factor(d):
+    '''Features phi of the linear kernel of _make_kernel, the centered dataset scaled so that phi phi^T is normalized by its largest eigenvalue'''
+    phi = _demean(np.nan_to_num(d))
+    return phi / np.sqrt(np.linalg.eigvalsh(np.dot(phi.T, phi)).max())
+
+def _kernel_block(a, b, ktype = "linear", gausigma = 1.0, degree = 2):
+    '''Kernel between the rows of a and b, as in _make_kernel (a and b already demeaned for the linear and poly kernels)'''
+    if ktype == "linear":
+        return np.dot(a, b.T)
+    elif ktype == "gaussian":
+        sqdists = (a**2).sum(1)[:, None] + (b**2).sum(1)[None] - 2*np.dot(a, b.T)
+        return np.exp(-np.clip(sqdists, 0, None) / 2*gausigma ** 2)
+    elif ktype == "poly":
+        return np.dot(a, b.T)**degree
+    raise ValueError("Unknown kernel type %s" % ktype)
+
+def _kernel_features(d, approx, rank, ktype = "linear", gausigma = 1.0,
+                     degree = 2, seed = 0, block = 4096):
+    '''Low-rank features phi (nT x rank) with phi phi^T approximating the kernel of _make_kernel
+      "nystrom": kernel columns of rank randomly chosen landmark samples, whitened by the landmark kernel
+      "rff": random Fourier features of the gaussian kernel, exp(-gausigma^2/2 |x-y|^2) = E[2 cos(w.x+b) cos(w.y+b)] with w ~ N(0, gausigma^2 I), b ~ U(0, 2 pi); the random directions are drawn block features at a time, so memory stays bounded for many features
+    '''
+    if rank is None:
+        raise ValueError("A rank is needed for the %s kernel approximation" % approx)
+    rng = np.random.RandomState(seed)
+    d = np.nan_to_num(d)
+    if ktype != "gaussian":
+        d = _demean(d)
+    nT, nF = d.shape
+    if approx == "nystrom":
+        landmarks = np.sort(rng.choice(nT, min(rank, nT), replace = False))
+        C = _kernel_block(d, d[landmarks], ktype = ktype, gausigma = gausigma, degree = degree)
+        L, V = np.linalg.eigh(C[landmarks])
+        keep = L > L.max()*1e-10
+        return np.dot(C, V[:, keep]/np.sqrt(L[keep]))
+    elif approx == "rff":
+        if ktype != "gaussian":
+            raise ValueError("Random Fourier features need the gaussian kernel")
+        proj = np.zeros((nT, rank))
+        for start in range(0, nF, block):
+            sel = slice(start, min(nF, start+block))
+            proj += np.dot(d[:, sel], gausigma*rng.standard_normal((sel.stop-sel.start, rank)))
+        return np.sqrt(2./rank)*np.cos(proj + rng.uniform(0, 2*np.pi, rank))
+    raise ValueError("Unknown kernel approximation %s" % approx)
+
+_EIG_METHODS = (None, "lanczos", "power", "eigvalsh")
+
+def _max_eig(kernel, method = None, tol = 1e-12, maxiter = 1000):
+    '''Largest eigenvalue of the symmetric positive semidefinite kernel
+      None or "lanczos": Lanczos iteration (scipy.sparse.linalg.eigsh)
+      "power": power iteration, until the Rayleigh quotient changes less than tol (relative)
+      "eigvalsh": full eigendecomposition
+      otherwise: an SVD backend (see braincode.math.svdbackend); a "randomized" backend computes the largest singular value (with its own settings if an SVDBackend is given, rank 1 otherwise), exact backends use Lanczos iteration, which is cheaper than their full SVD
+    '''
+    if method is None or method == "lanczos":
+        from scipy.sparse.linalg import eigsh
+        return eigsh(kernel, k = 1, which = "LA", return_eigenvectors = False)[0]
+    elif method == "power":
+        v = np.random.RandomState(0).standard_normal(kernel.shape[0])
+        v /= np.linalg.norm(v)
+        lam = 0.
+        for i in range(maxiter):
+            w = np.dot(kernel, v)
+            newlam = np.dot(v, w)
+            v = w / np.linalg.norm(w)
+            if abs(newlam-lam) <= tol*abs(newlam):
+                break
+            lam = newlam
+        return newlam
+    elif method == "eigvalsh":
+        return np.linalg.eigvalsh(kernel).max()
+    if not isinstance(method, SVDBackend):
+        method = SVDBackend(method, rank = 1)
+    if method.name != "randomized":
+        return _max_eig(kernel)
+    return svd(kernel, method)[1][0]
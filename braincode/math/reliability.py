@@ -0,0 +1,114 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+Voxel reliability estimated from repeated presentations of a stimulus.
+
+Voxels whose responses do not repeat across presentations carry no
+stimulus-driven signal and cannot be explained by any encoding model. These
+estimates can be used to drop such voxels before fitting.
+
+Repeated responses are given as an array of shape (V, R, T): V voxels, R
+repeats and T time points (or trials).
+"""
+
+import numpy as np
+
+
+def _rowcorr(a, b):
+    """Pearson correlation of matching rows of two (V, T) arrays."""
+    a = a - a.mean(axis=1, keepdims=True)
+    b = b - b.mean(axis=1, keepdims=True)
+    den = np.sqrt(np.sum(np.square(a), axis=1) * np.sum(np.square(b), axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(a*b, axis=1) / den
+
+def split_half_reliability(rep_ts, n_splits=20, seed=None,
+                           spearman_brown=True):
+    """Split-half reliability of each voxel.
+
+    The repeats are randomly divided into two halves [n_splits] times; the
+    correlation between the mean responses of the two halves is averaged
+    across splits (in Fisher z) and, if `spearman_brown`, corrected to the
+    reliability of the mean of all repeats.
+
+    Parameters
+    ----------
+    rep_ts : array_like, shape (V, R, T)
+        Repeated responses, R >= 2.
+    n_splits : int
+        Number of random split halves.
+    seed : int or None
+        Seed of the split selection.
+
+    Returns
+    -------
+    rel : array_like, shape (V,)
+        Reliability of each voxel; NaN for voxels without variance.
+    """
+    nrep = rep_ts.shape[1]
+    if nrep < 2:
+        raise ValueError("Split-half reliability needs at least 2 repeats.")
+    rng = np.random.RandomState(seed)
+    zs = np.zeros(rep_ts.shape[0])
+    for i in range(n_splits):
+        order = rng.permutation(nrep)
+        half_a = rep_ts[:, order[:nrep/2]].mean(axis=1)
+        half_b = rep_ts[:, order[nrep/2:]].mean(axis=1)
+        r = np.clip(_rowcorr(half_a, half_b), -0.999999, 0.999999)
+        zs += np.arctanh(r)
+    r = np.tanh(zs / n_splits)
+    if spearman_brown:
+        r = 2 * r / (1 + r)
+    return r
+
+def noise_ceiling(rep_ts, n_avg=None):
+    """Noise ceiling of each voxel, as the fraction of variance of the
+    average of `n_avg` repeats that is stimulus-driven.
+
+    The noise variance is the variance across repeats, averaged over time;
+    the signal variance is the variance of the mean response minus the
+    noise variance left in it. With the noise-ceiling SNR
+    ncsnr = sqrt(signal_var / noise_var), the ceiling is
+    ncsnr**2 / (ncsnr**2 + 1/n_avg).
+
+    Parameters
+    ----------
+    rep_ts : array_like, shape (V, R, T)
+        Repeated responses, R >= 2.
+    n_avg : int or None
+        Number of repeats averaged in the data to be predicted; all R
+        repeats if None.
+
+    Returns
+    -------
+    nc : array_like, shape (V,)
+        Noise ceiling in [0, 1], the maximal R**2 of a model. Its square
+        root is the maximal prediction correlation.
+    """
+    nrep = rep_ts.shape[1]
+    if nrep < 2:
+        raise ValueError("Noise ceiling needs at least 2 repeats.")
+    if n_avg is None:
+        n_avg = nrep
+    noise_var = rep_ts.var(axis=1, ddof=1).mean(axis=-1)
+    signal_var = rep_ts.mean(axis=1).var(axis=-1) - noise_var / nrep
+    signal_var = np.clip(signal_var, 0, None)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ncsnr2 = signal_var / noise_var
+        return ncsnr2 / (ncsnr2 + 1.0/n_avg)
+
+def select_voxels(score, threshold=None, top_k=None):
+    """Indices of the voxels whose reliability `score` is above
+    `threshold` and/or among the `top_k` highest, in increasing order.
+    Voxels with NaN scores are never selected.
+    """
+    score = np.asarray(score, dtype=np.float64)
+    valid = np.logical_not(np.isnan(score))
+    if threshold is not None:
+        valid &= np.nan_to_num(score) > threshold
+    idx = np.nonzero(valid)[0]
+    if top_k is not None and len(idx) > top_k:
+        idx = idx[np.argsort(score[idx])[::-1][:top_k]]
+    return np.sort(idx)
+
@@ -3,17 +3,21 @@
 
 import numpy as np
 import logging
-import random
 import time
-import itertools as itools
+from joblib import Parallel, delayed
 
-# z-score function
-zs = lambda v: (v-v.mean(0))/v.std(0)
+from svdcache import array_hash, decomp_key
+from svdbackend import get_backend
+from norm import DelayedDesign
+
+# z-score function, with float64 accumulation of the moments
+zs = lambda v: (v-v.mean(0, dtype=np.float64))/v.std(0, dtype=np.float64)
 
 ridge_logger = logging.getLogger("ridge_corr")
 
-def ridge(stim, resp, alpha, singcutoff=1e-10, normalpha=False,
-          logger=ridge_logger):
+def ridge(stim, resp, alpha, singcutoff=1e-10, normalpha=False, solver="auto",
+          mem_budget=None, svd_backend=None, svd_cache=None, cache_key=None,
+          dtype=np.float64, return_dual=False, logger=ridge_logger):
     """Uses ridge regression to find a linear transformation of [stim] that
     approximates [resp]. The regularization parameter is [alpha].
 
@@ -30,19 +34,60 @@ def ridge(stim, resp, alpha, singcutoff=1e-10, normalpha=False,
         Whether ridge parameters should be normalized by the largest singular
         value of stim. Good for comparing models with different numbers of
         parameters.
+    solver : "auto", "primal", "dual" or "stream"
+        "primal" works from the thin SVD of stim. "dual" works from the
+        eigendecomposition of the (T, T) Gram matrix np.dot(stim, stim.T) and
+        never forms an (N, N) or (T, N) factor, which is preferable when
+        N >> T. "stream" is the dual solver with the Gram matrix accumulated
+        over column blocks of stim, for memory-mapped (e.g. float16) feature
+        arrays that do not fit in memory as float64. "auto" picks "dual" when
+        N > T (see choose_solver).
+    mem_budget : int or None
+        With the "stream" solver, approximate number of bytes of the float64
+        column block of stim held in memory at a time (see gram).
+    svd_backend : str, SVDBackend or None
+        SVD backend of the primal solver (see braincode.math.svdbackend):
+        "gesdd" (default), "gesvd", "eigh", "randomized" or "auto".
+    svd_cache : SVDCache or None
+        If given, the decomposition of stim is looked up in (and stored into)
+        this on-disk cache.
+    cache_key : str or None
+        Cache key of stim. Computed from the content of stim if not given.
+    dtype : np.float64 or np.float32
+        Precision of the decomposition and of the matrix products. stim and
+        resp (e.g. float16 memmaps) are converted to it directly, so float32
+        halves the memory and roughly doubles the throughput of the BLAS
+        calls. The weights are returned in this dtype.
+    return_dual : boolean
+        If True and the dual solver is used, return a DualWeights object,
+        which holds the (T, M) dual coefficients and materializes the primal
+        weights np.dot(stim.T, coef) lazily, instead of the primal weights.
 
     Returns
     -------
-    wt : array_like, shape (N, M)
-        Linear regression weights.
+    wt : array_like, shape (N, M), or DualWeights
+        Linear regression weights; a DualWeights object with the dual solver
+        and return_dual.
     """
-    try:
-        U,S,Vh = np.linalg.svd(stim, full_matrices=False)
-    except np.linalg.LinAlgError:
-        logger.info("NORMAL SVD FAILED, trying more robust dgesvd..")
-        from svd_dgesvd import svd_dgesvd
-        U,S,Vh = svd_dgesvd(stim, full_matrices=False)
+    solver = choose_solver(stim.shape, solver)
+    resp = np.asarray(resp, dtype=dtype)
+    if solver in ("dual", "stream"):
+        budget = mem_budget if solver == "stream" else None
+        coef = kernel_ridge(gram(stim, mem_budget=budget, dtype=dtype), resp,
+                            alpha, singcutoff=singcutoff, normalpha=normalpha,
+                            svd_cache=svd_cache, cache_key=cache_key,
+                            logger=logger)
+        wt = DualWeights(stim, coef, mem_budget=budget)
+        return wt if return_dual else np.asarray(wt)
+
+    U,S,Vh = stim_svd(np.asarray(stim, dtype=dtype), svd_backend=svd_backend,
+                      svd_cache=svd_cache, cache_key=cache_key, logger=logger)
+    return svd_ridge(U, S, Vh, resp, alpha, normalpha=normalpha)
+
 
+def svd_ridge(U, S, Vh, resp, alpha, normalpha=False):
+    """Ridge weights from the SVD (U, S, Vh) of the stimulus. Parameters
+    are as in ridge."""
     UR = np.dot(U.T, np.nan_to_num(resp))
     
     # Expand alpha to a collection if it's just a single value
@@ -59,18 +104,59 @@ def ridge(stim, resp, alpha, singcutoff=1e-10, normalpha=False,
     # Compute weights for each alpha
     ualphas = np.unique(nalphas)
     # for layer regression, using dtype=float16
-    #wt = np.zeros((stim.shape[1], resp.shape[1]), dtype=np.float16)
-    wt = np.zeros((stim.shape[1], resp.shape[1]))
+    #wt = np.zeros((Vh.shape[1], resp.shape[1]), dtype=np.float16)
+    wt = np.zeros((Vh.shape[1], resp.shape[1]), dtype=Vh.dtype)
     for ua in ualphas:
         selvox = np.nonzero(nalphas==ua)[0]
-        awt = reduce(np.dot, [Vh.T, np.diag(S/(S**2+ua**2)), UR[:,selvox]])
+        D = (S/(S**2+ua**2)).astype(S.dtype)
+        awt = reduce(np.dot, [Vh.T, np.diag(D), UR[:,selvox]])
         wt[:,selvox] = awt
 
     return wt
+
+
+def kernel_ridge(Rgram, resp, alpha, singcutoff=1e-10, normalpha=False,
+                 svd_cache=None, cache_key=None, logger=ridge_logger):
+    """Dual form of ridge. Computes the dual coefficients C, shape (T, M),
+    such that the ridge weights are np.dot(stim.T, C), from the Gram matrix
+    Rgram = np.dot(stim, stim.T). Parameters are as in ridge; svd_cache and
+    cache_key refer to the eigendecomposition of Rgram.
+    """
+    U,S = kernel_eig(Rgram, svd_cache=svd_cache, cache_key=cache_key,
+                     logger=logger)
+    ngoodS = np.sum(S > sing_cutoff(S, singcutoff, len(S), squared=True))
+    return eig_kernel_ridge(U[:,:ngoodS], S[:ngoodS], resp, alpha,
+                            normalpha=normalpha)
+
+
+def eig_kernel_ridge(U, S, resp, alpha, normalpha=False):
+    """Dual ridge coefficients from the (truncated) eigendecomposition of
+    the Gram matrix, given as eigenvectors U and singular values S (square
+    roots of the eigenvalues). Parameters are as in ridge."""
+    UR = np.dot(U.T, np.nan_to_num(resp))
+
+    # Expand alpha to a collection if it's just a single value
+    if isinstance(alpha, float):
+        alpha = np.ones(resp.shape[1]) * alpha
+
+    # Normalize alpha by the LSV norm
+    if normalpha:
+        nalphas = alpha * S[0]
+    else:
+        nalphas = alpha
+
+    coef = np.zeros((U.shape[0], resp.shape[1]), dtype=U.dtype)
+    for ua in np.unique(nalphas):
+        selvox = np.nonzero(nalphas==ua)[0]
+        D = (1/(S**2+ua**2)).astype(S.dtype)
+        coef[:,selvox] = np.dot(U, mult_diag(D, UR[:,selvox]))
+    return coef
     
 
 def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
-               singcutoff=1e-10, use_corr=True, logger=ridge_logger):
+               singcutoff=1e-10, use_corr=True, batched=False, mem_budget=None,
+               solver="auto", svd_backend=None, svd_cache=None, cache_key=None,
+               dtype=np.float64, Presp_stats=None, logger=ridge_logger):
     """Uses ridge regression to find a linear transformation of [Rstim] that 
     approximates [Rresp], then tests by comparing the transformation of [Pstim]
     to [Presp]. This procedure is repeated for each regularization parameter
@@ -121,6 +207,37 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
         difference -- highly regularized solutions will have very small norms
         and will thus explain very little variance while still leading to high
         correlations, as correlation is scale-free while R**2 is not.
+    batched : boolean
+        If True, the (alphas x singular values) shrinkage tensor is built once
+        and the predictions for all alphas are computed in a single chunked
+        contraction instead of one product per alpha. The result is returned
+        as an array of shape (A, M).
+    mem_budget : int or None
+        Approximate number of bytes the (A, TP, m) prediction block of batched
+        mode may occupy; responses are streamed in blocks of m columns so that
+        the budget is respected. Also bounds the float64 column block of
+        Rstim/Pstim held in memory by the "stream" solver. None processes all
+        responses (and columns) in one block.
+    solver : "auto", "primal", "dual" or "stream"
+        Whether to work from the SVD of Rstim or from the eigendecomposition
+        of its (TR, TR) Gram matrix, accumulated in column blocks for
+        "stream" (see ridge). All give the same correlations; "auto" picks
+        "dual" when N > TR.
+    svd_backend : str, SVDBackend or None
+        SVD backend of the primal solver (see braincode.math.svdbackend).
+        A truncated randomized backend keeps only the leading components.
+    svd_cache : SVDCache or None
+        If given, the decomposition of Rstim is looked up in (and stored into)
+        this on-disk cache.
+    cache_key : str or None
+        Cache key of Rstim. Computed from the content of Rstim if not given.
+    dtype : np.float64 or np.float32
+        Precision of the decomposition and of the prediction products (see
+        ridge). Means and variances of the predictions and of Presp are
+        always accumulated in float64, so float32 changes the correlations
+        by a few 1e-6 at most for well-conditioned designs.
+    Presp_stats : tuple or None
+        Precomputed (zs(Presp), Presp.var(0)), see SplitPlan.
 
     Returns
     -------
@@ -130,23 +247,93 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
     
     """
     ## Calculate SVD of stimulus matrix
+    solver = choose_solver(Rstim.shape, solver)
+    Rresp = np.asarray(Rresp, dtype=dtype)
+    if solver in ("dual", "stream"):
+        budget = mem_budget if solver == "stream" else None
+        logger.info("Computing Gram matrix...")
+        Rgram = gram(Rstim, mem_budget=budget, dtype=dtype)
+        PRgram = gram(Rstim, Pstim, mem_budget=budget, dtype=dtype)
+        return kernel_ridge_corr(Rgram, PRgram, Rresp, Presp, alphas,
+                                 normalpha=normalpha, corrmin=corrmin,
+                                 singcutoff=singcutoff, use_corr=use_corr,
+                                 batched=batched, mem_budget=mem_budget,
+                                 svd_cache=svd_cache, cache_key=cache_key,
+                                 Presp_stats=Presp_stats, logger=logger)
+
     logger.info("Doing SVD...")
-    try:
-        U,S,Vh = np.linalg.svd(Rstim, full_matrices=False)
-    except np.linalg.LinAlgError:
-        logger.info("NORMAL SVD FAILED, trying more robust dgesvd..")
-        from svd_dgesvd import svd_dgesvd
-        U,S,Vh = svd_dgesvd(Rstim, full_matrices=False)
+    U,S,Vh = stim_svd(np.asarray(Rstim, dtype=dtype), svd_backend=svd_backend,
+                      svd_cache=svd_cache, cache_key=cache_key, logger=logger)
 
     ## Truncate tiny singular values for speed
+    U,S = _truncate(U, S, singcutoff, logger)
+    Vh = Vh[:S.shape[0]]
+    PVh = np.dot(np.asarray(Pstim, dtype=dtype), Vh.T) ## Precompute this matrix product for speed
+    return _decomp_ridge_corr(U, S, PVh, Rresp, Presp, alphas,
+                              normalpha=normalpha, corrmin=corrmin,
+                              use_corr=use_corr, batched=batched,
+                              mem_budget=mem_budget, Presp_stats=Presp_stats,
+                              logger=logger)
+
+
+def kernel_ridge_corr(Rgram, PRgram, Rresp, Presp, alphas, normalpha=False,
+                      corrmin=0.2, singcutoff=1e-10, use_corr=True,
+                      batched=False, mem_budget=None, svd_cache=None,
+                      cache_key=None, Presp_stats=None, logger=ridge_logger):
+    """Dual form of ridge_corr, computed from precomputed kernels.
+
+    Gives the same result as ridge_corr(Rstim, Pstim, ...) for
+    Rgram = np.dot(Rstim, Rstim.T) and PRgram = np.dot(Pstim, Rstim.T). Since
+    the training Gram matrix of any subset of samples is a sub-block of the
+    full Gram matrix, bootstrap samples can be evaluated without touching the
+    (possibly out-of-core) stimulus again.
+
+    Parameters
+    ----------
+    Rgram : array_like, shape (TR, TR)
+        Gram matrix of the training stimuli.
+    PRgram : array_like, shape (TP, TR)
+        Kernel between test and training stimuli.
+
+    The remaining parameters are as in ridge_corr; svd_cache and cache_key
+    refer to the eigendecomposition of Rgram.
+
+    Returns
+    -------
+    Rcorrs : array_like, shape (A, M)
+        The correlation between each predicted response and each column of
+        Presp for each alpha.
+    """
+    logger.info("Doing eigendecomposition of Gram matrix...")
+    U,S = kernel_eig(Rgram, svd_cache=svd_cache, cache_key=cache_key,
+                     logger=logger)
+    U,S = _truncate(U, S, singcutoff, logger, squared=True)
+    ## Vh = U.T Rstim / S, so PVh follows from the test-train kernel
+    PVh = mult_diag(1/S, np.dot(PRgram, U), left=False)
+    return _decomp_ridge_corr(U, S, PVh, Rresp, Presp, alphas,
+                              normalpha=normalpha, corrmin=corrmin,
+                              use_corr=use_corr, batched=batched,
+                              mem_budget=mem_budget, Presp_stats=Presp_stats,
+                              logger=logger)
+
+
+def _truncate(U, S, singcutoff, logger=ridge_logger, squared=False):
+    """Drops singular values below [singcutoff] (see sing_cutoff) and their
+    vectors."""
     origsize = S.shape[0]
-    ngoodS = np.sum(S > singcutoff)
+    ngoodS = np.sum(S > sing_cutoff(S, singcutoff, U.shape[0], squared))
     nbad = origsize-ngoodS
     U = U[:,:ngoodS]
     S = S[:ngoodS]
-    Vh = Vh[:ngoodS]
     logger.info("Dropped %d tiny singular values.. (U is now %s)"%(nbad, str(U.shape)))
+    return U, S
+
 
+def _decomp_ridge_corr(U, S, PVh, Rresp, Presp, alphas, normalpha=False,
+                       corrmin=0.2, use_corr=True, batched=False,
+                       mem_budget=None, Presp_stats=None, logger=ridge_logger):
+    """Evaluates ridge_corr given the truncated decomposition of the training
+    stimulus and the projected test stimulus PVh = np.dot(Pstim, Vh.T)."""
     ## Normalize alpha by the LSV norm
     norm = S[0]
     logger.info("Training stimulus has LSV norm: %0.03f"%norm)
@@ -157,18 +344,33 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
 
     ## Precompute some products for speed
     UR = np.dot(U.T, Rresp) ## Precompute this matrix product for speed
-    PVh = np.dot(Pstim, Vh.T) ## Precompute this matrix product for speed
     
     #Prespnorms = np.apply_along_axis(np.linalg.norm, 0, Presp) ## Precompute test response norms
-    zPresp = zs(Presp)
+    if Presp_stats is None:
+        Presp_stats = resp_stats(Presp)
+    zPresp, Prespvar_actual = Presp_stats
     #Prespvar = Presp.var(0)
-    Prespvar_actual = Presp.var(0)
     Prespvar = (np.ones_like(Prespvar_actual) + Prespvar_actual) / 2.0
     logger.info("Average difference between actual & assumed Prespvar: %0.3f" % (Prespvar_actual - Prespvar).mean())
+    log_template = "Training: alpha=%0.3f, mean corr=%0.5f, max corr=%0.5f, over-under(%0.2f)=%d"
+
+    if batched:
+        Rcorrs = batched_alpha_corrs(S, PVh, UR, Presp, nalphas,
+                                     use_corr=use_corr, zPresp=zPresp,
+                                     Prespvar=Prespvar, mem_budget=mem_budget)
+        for a, Rcorr in zip(alphas, Rcorrs):
+            logger.info(log_template % (a,
+                                        np.mean(Rcorr),
+                                        np.max(Rcorr),
+                                        corrmin,
+                                        (Rcorr>corrmin).sum()-(-Rcorr>corrmin).sum()))
+        return Rcorrs
+
     Rcorrs = [] ## Holds training correlations for each alpha
     for na, a in zip(nalphas, alphas):
         #D = np.diag(S/(S**2+a**2)) ## Reweight singular vectors by the ridge parameter 
         D = S / (S ** 2 + na ** 2) ## Reweight singular vectors by the (normalized?) ridge parameter
+        D = D.astype(PVh.dtype)
         
         pred = np.dot(mult_diag(D, PVh, left=False), UR) ## Best (1.75 seconds to prediction in test)
         # pred = np.dot(mult_diag(D, np.dot(Pstim, Vh.T), left=False), UR) ## Better (2.0 seconds to prediction in test)
@@ -187,14 +389,13 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
             Rcorr = (zPresp * zs(pred)).mean(0)
         else:
             ## Compute variance explained
-            resvar = (Presp - pred).var(0)
+            resvar = (Presp - pred).var(0, dtype=np.float64)
             Rsq = 1 - (resvar / Prespvar)
             Rcorr = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
             
         Rcorr[np.isnan(Rcorr)] = 0
         Rcorrs.append(Rcorr)
         
-        log_template = "Training: alpha=%0.3f, mean corr=%0.5f, max corr=%0.5f, over-under(%0.2f)=%d"
         log_msg = log_template % (a,
                                   np.mean(Rcorr),
                                   np.max(Rcorr),
@@ -205,10 +406,86 @@ def ridge_corr(Rstim, Pstim, Rresp, Presp, alphas, normalpha=False, corrmin=0.2,
     return Rcorrs
 
 
+def batched_alpha_corrs(S, PVh, UR, Presp, alphas, use_corr=True, zPresp=None,
+                        Prespvar=None, mem_budget=None):
+    """Computes the test-set fit of the ridge solution for every alpha at once.
+
+    The shrinkage factors S/(S**2+alpha**2) of all alphas are stacked into an
+    (A, K) tensor, and the predictions of all alphas are obtained from a single
+    (A*TP, K) x (K, m) product per block of m responses.
+
+    Parameters
+    ----------
+    S : array_like, shape (K,)
+        Singular values of the training stimulus.
+    PVh : array_like, shape (TP, K)
+        Test stimulus projected onto the right singular vectors,
+        np.dot(Pstim, Vh.T).
+    UR : array_like, shape (K, M)
+        Training responses projected onto the left singular vectors,
+        np.dot(U.T, Rresp).
+    Presp : array_like, shape (TP, M)
+        Test responses.
+    alphas : array_like, shape (A,)
+        (Normalized) ridge parameters.
+    use_corr : boolean
+        Use correlation (True) or signed sqrt of variance explained (False) as
+        the metric of model fit, as in ridge_corr.
+    zPresp, Prespvar : array_like, shape (TP, M) and (M,), optional
+        Precomputed z-scored test responses and assumed response variance. They
+        are derived from Presp when not given.
+    mem_budget : int or None
+        Approximate number of bytes for the (A, TP, m) prediction block. None
+        processes all responses in one block.
+
+    Returns
+    -------
+    Rcorrs : array_like, shape (A, M)
+        Model fit of each response for each alpha.
+    """
+    alphas = np.atleast_1d(np.asarray(alphas, dtype=np.float64))
+    nalpha = alphas.shape[0]
+    ntp, nvox = Presp.shape
+    if use_corr and zPresp is None:
+        zPresp = zs(Presp)
+    if not use_corr and Prespvar is None:
+        Prespvar = (1.0 + Presp.var(0, dtype=np.float64)) / 2.0
+
+    # shrinkage tensor, shape (A, K), and the scaled test projections
+    D = (S / (S ** 2 + alphas[:,None] ** 2)).astype(PVh.dtype)
+    DPVh = (D[:,None,:] * PVh[None,:,:]).reshape(nalpha*ntp, -1)
+
+    # prediction block, plus a temporary of the same size for the metric
+    bytes_per_resp = 2 * nalpha * ntp * DPVh.itemsize
+    if mem_budget is None:
+        blocklen = nvox
+    else:
+        blocklen = int(max(1, min(nvox, mem_budget // bytes_per_resp)))
+
+    Rcorrs = np.zeros((nalpha, nvox))
+    for start in range(0, nvox, blocklen):
+        sel = slice(start, min(nvox, start+blocklen))
+        pred = np.dot(DPVh, UR[:,sel]).reshape(nalpha, ntp, -1)
+        if use_corr:
+            pred -= pred.mean(1, dtype=np.float64)[:,None,:]
+            pred /= pred.std(1, dtype=np.float64)[:,None,:]
+            Rcorrs[:,sel] = (zPresp[None,:,sel] * pred).mean(1, dtype=np.float64)
+        else:
+            pred -= Presp[None,:,sel]
+            Rsq = 1 - (pred.var(1, dtype=np.float64) / Prespvar[sel])
+            Rcorrs[:,sel] = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+    Rcorrs[np.isnan(Rcorrs)] = 0
+    return Rcorrs
+
+
 def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen,
                     nchunks, corrmin=0.2, joined=None, singcutoff=1e-10, 
                     normalpha=False, single_alpha=False, use_corr=True, 
-                    logger=ridge_logger):
+                    batched=False, mem_budget=None, n_jobs=1,
+                    backend="threading", seed=None, solver="auto",
+                    svd_backend=None, svd_cache=None, select="bootstrap",
+                    dtype=np.float64, suffstats=False, split_plan=None,
+                    return_dual=False, logger=ridge_logger):
     """Uses ridge regression with a bootstrapped held-out set to get optimal 
     alpha values for each response.
     [nchunks] random chunks of length [chunklen] will be taken from [Rstim] 
@@ -285,11 +562,84 @@ def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen,
         difference -- highly regularized solutions will have very small norms 
         and will thus explain very little variance while still leading to high 
         correlations, as correlation is scale-free while R**2 is not.
+    batched : boolean
+        Whether to evaluate all alphas of a bootstrap sample in one chunked
+        contraction (see ridge_corr).
+    mem_budget : int or None
+        Memory budget in bytes for the batched evaluation (see ridge_corr)
+        and, with the "stream" solver, for the float64 column blocks of Rstim
+        and Pstim (see gram).
+    n_jobs : int
+        Number of bootstrap samples evaluated concurrently. Each sample is an
+        independent SVD plus ridge_corr on the same Rstim/Rresp.
+    backend : str
+        joblib backend used when n_jobs != 1. "threading" shares the inputs
+        directly; with a process backend ("loky", "multiprocessing") Rstim and
+        Rresp are dumped once to read-only memmaps that all workers map,
+        instead of being pickled for every task.
+    seed : int or None
+        Seed of the held-out set selection. Every bootstrap sample draws its
+        chunks from its own RandomState, seeded from [seed], so valinds and
+        bootstrap_corrs are identical for any n_jobs and backend.
+    solver : "auto", "primal", "dual" or "stream"
+        Whether to work from the SVD of Rstim or from the eigendecomposition
+        of its (TR, TR) Gram matrix (see ridge). "auto" picks "dual" when the
+        number of features exceeds the number of training time points, e.g.
+        for whole CNN layers. In dual form the Gram matrix of Rstim and its
+        kernel with Pstim are computed once, and each bootstrap sample only
+        takes sub-blocks of them. "stream" accumulates these kernels over
+        column blocks of memory-mapped Rstim/Pstim, so peak memory is set by
+        mem_budget and the number of time points rather than by the number
+        of features.
+    svd_backend : str, SVDBackend or None
+        SVD backend of the primal solver (see braincode.math.svdbackend).
+    svd_cache : SVDCache or None
+        On-disk cache of the SVDs of Rstim and of its bootstrap training
+        splits, keyed by the content of Rstim and the held-out indices. With a
+        fixed seed, every ROI and subject fitted on the same design matrix
+        reuses the cached decompositions. Designs too small to be worth
+        caching (see SVDCache.accepts) are decomposed as usual.
+    select : "bootstrap", "gcv", "loo" or "blockloo"
+        How alphas are scored. "bootstrap" refits on [nboots] random splits.
+        The other modes score every alpha exactly from the single
+        decomposition of Rstim that also yields the weights (see
+        ridge_cv_scores): generalized cross-validation, leave-one-out, or
+        leave-one-chunk-out over consecutive chunks of [chunklen] samples,
+        which accounts for the autocorrelation of fMRI responses. In these
+        modes nboots and nchunks are ignored, bootstrap_corrs has a single
+        "bootstrap" and valinds is empty.
+    dtype : np.float64 or np.float32
+        Precision of the decompositions and matrix products (see ridge and
+        ridge_corr). Rstim and Rresp are converted to it once, instead of
+        once per bootstrap sample; pass float16 memmaps directly rather than
+        converting them to float64 beforehand.
+    suffstats : boolean
+        Score the bootstrap samples from per-chunk sufficient statistics
+        (X.T X, X.T Y, sums and sums of squares of each chunk of [chunklen]
+        samples, see chunk_suffstats) instead of refitting on each split.
+        The training statistics of a split are the totals minus those of its
+        held-out chunks, so each sample costs O(N**3 + N**2 M) regardless of
+        the number of time points. Gives the same bootstrap_corrs as the
+        default up to rounding; meant for designs with few features (e.g.
+        the 46 or 72 channels of the pRF candidate models). Primal solver
+        only; batched, mem_budget, svd_backend and svd_cache do not apply to
+        the bootstrap samples.
+    split_plan : SplitPlan or None
+        Precomputed bootstrap splits, used instead of drawing [nboots]
+        splits from [seed]. nboots, chunklen, nchunks and seed are then
+        taken from the plan; in particular the chunks of suffstats and
+        blockloo are those of the plan, whatever [chunklen] is passed. The
+        plan also keeps the response side of its splits, so repeated calls
+        with the same Rresp skip that work.
+    return_dual : boolean
+        If True and the dual solver is used, return the weights as a lazily
+        materialized DualWeights object (see ridge).
     
     Returns
     -------
-    wt : array_like, shape (N, M)
-        Regression weights for N features and M responses.
+    wt : array_like, shape (N, M), or DualWeights
+        Regression weights for N features and M responses; a DualWeights
+        object with the dual solver and return_dual.
     corrs : array_like, shape (M,)
         Validation set correlations. Predicted responses for the validation set
         are obtained using the regression weights: pred = np.dot(Pstim, wt), and
@@ -307,40 +657,116 @@ def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen,
         bootstrap sample.
     """
     nresp, nvox = Rresp.shape
+    if select not in ("bootstrap", "gcv", "loo", "blockloo"):
+        raise ValueError("Unknown alpha selection %s"%select)
+    if split_plan is not None:
+        # the held-out indices of the plan are whole chunks of its chunklen
+        chunklen = split_plan.chunklen
+    if select != "bootstrap":
+        # closed-form scores, no resampling
+        nboots = 0
+    elif split_plan is not None:
+        nboots = len(split_plan)
+    if nboots > 0 and split_plan is not None:
+        splits = split_plan.splits
+    else:
+        splits = [draw_split(nresp, chunklen, nchunks,
+                             np.random.RandomState(bseed))
+                  for bseed in bootstrap_seeds(nboots, seed)]
     # Will hold the indices into the validation data for each bootstrap
-    valinds = [] 
+    valinds = [heldinds for heldinds, notheldinds in splits]
     
-    Rcmats = []
-    for bi in counter(range(nboots), countevery=1, total=nboots):
-        logger.info("Selecting held-out test set..")
-        allinds = range(nresp)
-        indchunks = zip(*[iter(allinds)]*chunklen)
-        random.shuffle(indchunks)
-        heldinds = list(itools.chain(*indchunks[:nchunks]))
-        notheldinds = list(set(allinds)-set(heldinds))
-        valinds.append(heldinds)
-        
-        RRstim = Rstim[notheldinds,:]
-        PRstim = Rstim[heldinds,:]
-        RRresp = Rresp[notheldinds,:]
-        PRresp = Rresp[heldinds,:]
-        
-        # Run ridge regression using this test set
-        Rcmat = ridge_corr(RRstim, PRstim, RRresp, PRresp, alphas,
-                           corrmin=corrmin, singcutoff=singcutoff,
-                           normalpha=normalpha, use_corr=use_corr,
-                           logger=logger)
-        
-        Rcmats.append(Rcmat)
+    solver = choose_solver(Rstim.shape, solver)
+    dual = solver in ("dual", "stream")
+    Rresp = np.asarray(Rresp, dtype=dtype)
+    if dual:
+        # the kernels are accumulated in [dtype] from the original Rstim
+        tag = "gram"
+        if np.dtype(dtype) != np.float64:
+            tag += "-" + np.dtype(dtype).name
+    else:
+        Rstim = np.asarray(Rstim, dtype=dtype)
+        Pstim = np.asarray(Pstim, dtype=dtype)
+        tag = get_backend(svd_backend).key
+    if split_plan is not None and nboots > 0:
+        resp_blocks = split_plan.resp_blocks(Rresp)
+    else:
+        resp_blocks = [None] * nboots
+    if svd_cache is not None and not svd_cache.accepts(Rstim.shape):
+        # cheaper to recompute than to read back
+        svd_cache = None
+    if svd_cache is not None:
+        stim_hash = array_hash(Rstim)
+        cache_keys = [decomp_key(stim_hash, notheldinds, tag=tag)
+                      for heldinds, notheldinds in splits]
+    else:
+        cache_keys = [None] * nboots
     
-    # Find best alphas
-    if nboots>0:
-        allRcorrs = np.dstack(Rcmats)
+    corr_kwargs = dict(corrmin=corrmin, singcutoff=singcutoff,
+                       normalpha=normalpha, use_corr=use_corr,
+                       batched=batched, mem_budget=mem_budget,
+                       svd_cache=svd_cache)
+    if suffstats and dual:
+        raise ValueError("suffstats needs the primal solver.")
+    if dual:
+        # the training Gram matrix of every split is a sub-block of this one
+        budget = mem_budget if solver == "stream" else None
+        logger.info("Computing Gram matrix...")
+        Rgram = gram(Rstim, mem_budget=budget, dtype=dtype)
+        PRgram = gram(Rstim, Pstim, mem_budget=budget, dtype=dtype)
+        bootfunc, bootstim = _bootstrap_kernel_corr, Rgram
+    elif suffstats:
+        # every split is scored from the statistics of whole chunks
+        logger.info("Computing chunk statistics...")
+        corr_kwargs = dict(corrmin=corrmin, singcutoff=singcutoff,
+                           normalpha=normalpha, use_corr=use_corr)
+        bootfunc = _bootstrap_stats_corr
+        bootstim = chunk_suffstats(Rstim, Rresp, chunklen)
     else:
-        allRcorrs = None
+        corr_kwargs["solver"] = solver
+        corr_kwargs["svd_backend"] = svd_backend
+        corr_kwargs["dtype"] = dtype
+        bootfunc, bootstim = _bootstrap_corr, Rstim
+    corr_kwargs["logger"] = logger
+    if n_jobs == 1:
+        Rcmats = []
+        for bi in counter(range(nboots), countevery=1, total=nboots):
+            heldinds, notheldinds = splits[bi]
+            Rcmats.append(bootfunc(bootstim, Rresp, heldinds, notheldinds,
+                                   alphas, corr_kwargs, cache_keys[bi],
+                                   resp_blocks[bi]))
+    else:
+        logger.info("Running %d bootstrap samples in parallel.."%nboots)
+        # large inputs are memmapped read-only once per call by joblib when a
+        # process backend is used
+        Rcmats = Parallel(n_jobs=n_jobs, backend=backend, mmap_mode="r")(
+                    delayed(bootfunc)(bootstim, Rresp, heldinds, notheldinds,
+                                      alphas, corr_kwargs, key, block)
+                    for (heldinds, notheldinds), key, block
+                    in zip(splits, cache_keys, resp_blocks))
+    
+    cache_key = None if svd_cache is None else decomp_key(stim_hash, tag=tag)
+    if select != "bootstrap":
+        logger.info("Computing closed-form %s scores.."%select)
+        if dual:
+            U,S = kernel_eig(Rgram, svd_cache=svd_cache, cache_key=cache_key,
+                             logger=logger)
+        else:
+            U,S,Vh = stim_svd(Rstim, svd_backend=svd_backend,
+                              svd_cache=svd_cache, cache_key=cache_key,
+                              logger=logger)
+        ngoodS = np.sum(S > sing_cutoff(S, singcutoff, nresp, squared=dual))
+        allRcorrs = ridge_cv_scores(U[:,:ngoodS], S[:ngoodS], Rresp, alphas,
+                                    method=select, chunklen=chunklen,
+                                    normalpha=normalpha,
+                                    use_corr=use_corr)[:,:,None]
+
+    # Find best alphas
+    if select == "bootstrap":
+        allRcorrs = np.dstack(Rcmats) if nboots>0 else None
     
     if not single_alpha:
-        if nboots==0:
+        if allRcorrs is None:
             raise ValueError("You must run at least one cross-validation step to assign "
                              "different alphas to each response.")
         
@@ -360,7 +786,7 @@ def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen,
                 valphas[jl] = alphas[bestalpha]
     else:
         logger.info("Finding single best alpha..")
-        if nboots==0:
+        if allRcorrs is None:
             if len(alphas)==1:
                 bestalphaind = 0
                 bestalpha = alphas[0]
@@ -378,11 +804,31 @@ def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen,
 
     # Find weights
     logger.info("Computing weights for each response using entire training set..")
-    wt = ridge(Rstim, Rresp, valphas, singcutoff=singcutoff, normalpha=normalpha)
+    if dual:
+        if select != "bootstrap":
+            coef = eig_kernel_ridge(U[:,:ngoodS], S[:ngoodS], Rresp, valphas,
+                                    normalpha=normalpha)
+        else:
+            coef = kernel_ridge(Rgram, Rresp, valphas, singcutoff=singcutoff,
+                                normalpha=normalpha, svd_cache=svd_cache,
+                                cache_key=cache_key, logger=logger)
+        wt = DualWeights(Rstim, coef, mem_budget=budget)
+    elif select != "bootstrap":
+        wt = svd_ridge(U, S, Vh, Rresp, valphas, normalpha=normalpha)
+    else:
+        wt = ridge(Rstim, Rresp, valphas, singcutoff=singcutoff,
+                   normalpha=normalpha, solver=solver,
+                   svd_backend=svd_backend, svd_cache=svd_cache,
+                   cache_key=cache_key, dtype=dtype)
 
     # Predict responses on prediction set
     logger.info("Predicting responses for predictions set..")
-    pred = np.dot(Pstim, wt)
+    if dual:
+        pred = np.dot(PRgram, coef)
+        if not return_dual:
+            wt = np.asarray(wt)
+    else:
+        pred = np.dot(Pstim, wt)
 
     # Find prediction correlations
     nnpred = np.nan_to_num(pred)
@@ -397,6 +843,729 @@ def bootstrap_ridge(Rstim, Rresp, Pstim, Presp, alphas, nboots, chunklen,
     return wt, corrs, valphas, allRcorrs, valinds
 
 
+def ridge_cv_scores(U, S, Rresp, alphas, method="gcv", chunklen=None,
+                    normalpha=False, use_corr=True):
+    """Scores every alpha for every response in closed form from a single
+    decomposition of the training stimulus, without refitting.
+
+    For ridge the fitted responses are H Rresp with the hat matrix
+    H = U diag(S**2/(S**2+alpha**2)) U.T, so held-out errors follow exactly
+    from the in-sample residuals r = Rresp - H Rresp:
+
+    gcv : mean(r**2) / (1 - trace(H)/T)**2, generalized cross-validation.
+    loo : leave-one-out errors r_i / (1 - H_ii).
+    blockloo : leave-one-chunk-out errors solve(I - H_BB, r_B) for
+        consecutive chunks B of [chunklen] samples. Unlike plain LOO this is
+        not biased by the temporal autocorrelation of the responses.
+
+    Parameters
+    ----------
+    U : array_like, shape (T, K)
+        Left singular vectors of the training stimulus (or eigenvectors of
+        its Gram matrix), with tiny singular values already dropped.
+    S : array_like, shape (K,)
+        The corresponding singular values.
+    Rresp : array_like, shape (T, M)
+        Training responses.
+    alphas : array_like, shape (A,)
+        Ridge parameters to be scored.
+    method : "gcv", "loo" or "blockloo"
+    chunklen : int
+        Chunk length of "blockloo".
+    normalpha : boolean
+        Whether alphas are normalized by the largest singular value.
+    use_corr : boolean
+        For "loo" and "blockloo", score by the correlation between held-out
+        predictions and responses if True. Otherwise, and always for "gcv",
+        scores are sqrt(abs(Rsq))*sign(Rsq) with Rsq = 1 - err/var(Rresp), as
+        for use_corr=False in ridge_corr.
+
+    Returns
+    -------
+    scores : array_like, shape (A, M)
+    """
+    alphas = np.atleast_1d(np.asarray(alphas, dtype=np.float64))
+    nalphas = alphas * S[0] if normalpha else alphas
+    nt = Rresp.shape[0]
+    Rresp = np.nan_to_num(Rresp)
+    UR = np.dot(U.T, Rresp)
+    Rvar = Rresp.var(0, dtype=np.float64)
+    # shrinkage of the fitted values, shape (A, K)
+    F = S**2 / (S**2 + nalphas[:,None]**2)
+
+    if method == "gcv":
+        # residual sum of squares: the part of Rresp outside the span of U
+        # plus the shrunk-away part inside it, each formed as a sum of
+        # squares (not as a difference of large terms) and in float64
+        outside = Rresp - np.dot(U, UR)
+        shrunk = (nalphas[:,None]**2 / (S**2 + nalphas[:,None]**2))**2
+        rss = (np.square(outside).sum(0, dtype=np.float64)
+               + np.dot(shrunk.astype(np.float64), UR.astype(np.float64)**2))
+        F = F.astype(np.float64)
+        err = rss / nt / ((1 - F.sum(1)/nt)**2)[:,None]
+        Rsq = 1 - err / Rvar
+        scores = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+        scores[np.isnan(scores)] = 0
+        return scores
+    if method == "blockloo" and not chunklen:
+        raise ValueError("blockloo needs a chunk length.")
+
+    scores = np.zeros((len(nalphas), Rresp.shape[1]))
+    F = F.astype(U.dtype)
+    for ai in range(len(nalphas)):
+        resid = Rresp - np.dot(U, mult_diag(F[ai], UR))
+        if method == "loo":
+            h = np.dot(U**2, F[ai])
+            err = mult_diag(1/(1-h), resid)
+        else:
+            err = np.empty_like(resid)
+            for start in range(0, nt, chunklen):
+                sel = slice(start, min(nt, start+chunklen))
+                UB = U[sel]
+                IH = np.eye(UB.shape[0]) - np.dot(UB*F[ai], UB.T)
+                err[sel] = np.linalg.solve(IH, resid[sel])
+        if use_corr:
+            scores[ai] = (zs(Rresp) * zs(Rresp - err)).mean(0)
+        else:
+            Rsq = 1 - err.var(0, dtype=np.float64) / Rvar
+            scores[ai] = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+    scores[np.isnan(scores)] = 0
+    return scores
+
+
+def chunk_suffstats(stim, resp, chunklen):
+    """Sufficient statistics of the ridge fit for each chunk of [chunklen]
+    consecutive samples, as used by the bootstrap splits of bootstrap_ridge.
+    Trailing samples that do not fill a chunk only enter the totals.
+
+    Returns
+    -------
+    stats : dict
+        "XX" (C, N, N), "XY" (C, N, M), "X" (C, N), "Y" (C, M) and "YY"
+        (C, M): X.T X, X.T Y, the sums of X and Y, and the sums of Y**2 of
+        each of the C chunks; "totXX" (N, N) and "totXY" (N, M) over all
+        samples; and "chunklen".
+    """
+    stim = np.asarray(stim, dtype=np.float64)
+    resp = np.asarray(resp, dtype=np.float64)
+    nchunk = stim.shape[0] // chunklen
+    cstim = stim[:nchunk*chunklen].reshape(nchunk, chunklen, -1)
+    cresp = resp[:nchunk*chunklen].reshape(nchunk, chunklen, -1)
+    return dict(XX=np.matmul(cstim.transpose(0,2,1), cstim),
+                XY=np.matmul(cstim.transpose(0,2,1), cresp),
+                X=cstim.sum(1), Y=cresp.sum(1), YY=np.square(cresp).sum(1),
+                totXX=np.dot(stim.T, stim), totXY=np.dot(stim.T, resp),
+                chunklen=chunklen)
+
+
+def stats_ridge_corr(stats, heldchunks, alphas, normalpha=False, corrmin=0.2,
+                     singcutoff=1e-10, use_corr=True, logger=ridge_logger):
+    """ridge_corr for training on all samples but the [heldchunks] and
+    testing on those chunks, computed from chunk_suffstats alone.
+
+    The training stimulus has X.T X = V diag(S**2) V.T, and the ridge
+    weights are V diag(1/(S**2+alpha**2)) V.T X.T Y. The sums, sums of
+    squares and cross products of the held-out predictions and responses
+    follow from the weights and the statistics of the held-out chunks, which
+    gives the correlation (or variance explained) without forming the
+    predictions.
+
+    Parameters
+    ----------
+    stats : dict
+        chunk_suffstats of the training stimuli and responses.
+    heldchunks : array_like
+        Indices of the held-out chunks.
+
+    The remaining parameters are as in ridge_corr.
+
+    Returns
+    -------
+    Rcorrs : array_like, shape (A, M)
+    """
+    nheld = len(heldchunks) * stats["chunklen"]
+    hXX = stats["XX"][heldchunks].sum(0)
+    hXY = stats["XY"][heldchunks].sum(0)
+    hX = stats["X"][heldchunks].sum(0)
+    hY = stats["Y"][heldchunks].sum(0)
+    hYY = stats["YY"][heldchunks].sum(0)
+
+    L, V = np.linalg.eigh(stats["totXX"] - hXX)
+    S = np.sqrt(np.clip(L[::-1], 0, None))
+    V = V[:,::-1][:,S > singcutoff]
+    S = S[S > singcutoff]
+    logger.info("Dropped %d tiny singular values.. (V is now %s)"%(len(L)-len(S), str(V.shape)))
+    norm = S[0]
+    logger.info("Training stimulus has LSV norm: %0.03f"%norm)
+    if normalpha:
+        nalphas = alphas * norm
+    else:
+        nalphas = alphas
+
+    ## Training cross products and held-out statistics in the V basis
+    VXY = np.dot(V.T, stats["totXY"] - hXY)
+    hVXXV = reduce(np.dot, [V.T, hXX, V])
+    hVXY = np.dot(V.T, hXY)
+    hXV = np.dot(hX, V)
+    ## Held-out response moments
+    ymean = hY / nheld
+    yvar = hYY / nheld - ymean ** 2
+    Prespvar = (1.0 + yvar) / 2.0
+    log_template = "Training: alpha=%0.3f, mean corr=%0.5f, max corr=%0.5f, over-under(%0.2f)=%d"
+
+    Rcorrs = np.zeros((len(alphas), hY.shape[0]))
+    for ai, (na, a) in enumerate(zip(nalphas, alphas)):
+        ## Weights in the V basis
+        B = mult_diag(1 / (S ** 2 + na ** 2), VXY)
+        pmean = np.dot(hXV, B) / nheld
+        pvar = (B * np.dot(hVXXV, B)).sum(0) / nheld - pmean ** 2
+        cov = (B * hVXY).sum(0) / nheld - pmean * ymean
+        if use_corr:
+            Rcorr = cov / np.sqrt(pvar * yvar)
+        else:
+            ## Compute variance explained
+            resvar = yvar + pvar - 2 * cov
+            Rsq = 1 - (resvar / Prespvar)
+            Rcorr = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+        Rcorr[np.isnan(Rcorr)] = 0
+        Rcorrs[ai] = Rcorr
+        logger.info(log_template % (a,
+                                    np.mean(Rcorr),
+                                    np.max(Rcorr),
+                                    corrmin,
+                                    (Rcorr>corrmin).sum()-(-Rcorr>corrmin).sum()))
+    return Rcorrs
+
+
+def batch_ridge_corr(Rstims, Pstims, Rresp, Presp, alphas, normalpha=False,
+                     singcutoff=1e-10, use_corr=True, dtype=np.float64):
+    """ridge_corr for a stack of B designs fitted to the same responses,
+    e.g. the candidate models of a pRF grid search.
+
+    The thin SVDs of all designs are computed in one stacked call, and the
+    predictions of all designs for an alpha in one stacked product, so there
+    is no per-design Python overhead. Intended for many small designs; the
+    (B, TP, M) predictions of one alpha are held in memory, so large grids
+    should be passed in blocks of designs.
+
+    Parameters
+    ----------
+    Rstims : array_like, shape (B, TR, N)
+        Training stimuli of B designs.
+    Pstims : array_like, shape (B, TP, N)
+        Test stimuli of the B designs.
+    Rresp, Presp, alphas, normalpha, singcutoff, use_corr, dtype :
+        As in ridge_corr; the responses are shared by all designs.
+
+    Returns
+    -------
+    Rcorrs : array_like, shape (B, A, M)
+        Model fit of each response for each design and alpha.
+    """
+    Rstims = np.asarray(Rstims, dtype=dtype)
+    Pstims = np.asarray(Pstims, dtype=dtype)
+    Rresp = np.asarray(Rresp, dtype=dtype)
+    alphas = np.atleast_1d(np.asarray(alphas, dtype=np.float64))
+
+    U,S,Vh = np.linalg.svd(Rstims, full_matrices=False)
+    UR = np.matmul(U.transpose(0,2,1), Rresp)
+    PVh = np.matmul(Pstims, Vh.transpose(0,2,1))
+    # tiny singular values are masked rather than dropped, since their
+    # number differs between designs
+    good = S > singcutoff
+    if normalpha:
+        nalphas = alphas[None,:] * S[:,:1]
+    else:
+        nalphas = np.tile(alphas, (S.shape[0], 1))
+
+    zPresp = zs(Presp)
+    Prespvar = (1.0 + Presp.var(0, dtype=np.float64)) / 2.0
+    Rcorrs = np.zeros((S.shape[0], len(alphas), Presp.shape[1]))
+    for ai in range(len(alphas)):
+        na = nalphas[:,ai:ai+1]
+        D = np.where(good, S / (S**2 + na**2), 0).astype(PVh.dtype)
+        pred = np.matmul(PVh * D[:,None,:], UR)
+        if use_corr:
+            pred -= pred.mean(1, dtype=np.float64)[:,None,:]
+            pred /= pred.std(1, dtype=np.float64)[:,None,:]
+            Rcorrs[:,ai] = (zPresp[None] * pred).mean(1, dtype=np.float64)
+        else:
+            pred -= Presp[None]
+            Rsq = 1 - (pred.var(1, dtype=np.float64) / Prespvar)
+            Rcorrs[:,ai] = np.sqrt(np.abs(Rsq)) * np.sign(Rsq)
+    Rcorrs[np.isnan(Rcorrs)] = 0
+    return Rcorrs
+
+
+def batch_bootstrap_ridge(Rstims, Rresp, Pstims, Presp, alphas, nboots,
+                          chunklen, nchunks, singcutoff=1e-10,
+                          normalpha=False, single_alpha=False, use_corr=True,
+                          seed=None, dtype=np.float64, logger=ridge_logger):
+    """bootstrap_ridge for a stack of B designs fitted to the same responses.
+
+    All designs share the same bootstrap splits, which are the splits
+    bootstrap_ridge draws for the same [seed]; with a fixed seed each design
+    gets the same alphas, weights and correlations as a separate
+    bootstrap_ridge call (primal solver). Every step (the SVDs of each
+    split, the alpha scores, the final fit and prediction) is done for all
+    designs at once, see batch_ridge_corr.
+
+    Parameters
+    ----------
+    Rstims : array_like, shape (B, TR, N)
+        Training stimuli of B designs.
+    Pstims : array_like, shape (B, TP, N)
+        Test stimuli of the B designs.
+
+    The remaining parameters are as in bootstrap_ridge.
+
+    Returns
+    -------
+    wt : array_like, shape (B, N, M)
+        Regression weights of each design.
+    corrs : array_like, shape (B, M)
+        Validation set correlations of each design.
+    alphas : array_like, shape (B, M)
+        The alpha selected for each design and response.
+    bootstrap_corrs : array_like, shape (B, A, M, nboots)
+        Scores of each design on the held out parts of the training set.
+    valinds : list of array_like
+        The held out indices of each bootstrap sample.
+    """
+    Rstims = np.asarray(Rstims, dtype=dtype)
+    Pstims = np.asarray(Pstims, dtype=dtype)
+    Rresp = np.asarray(Rresp, dtype=dtype)
+    nmodel, nresp = Rstims.shape[:2]
+    nvox = Rresp.shape[1]
+
+    valinds = []
+    Rcmats = []
+    seeds = bootstrap_seeds(nboots, seed)
+    for bi in counter(range(nboots), countevery=1, total=nboots):
+        heldinds, notheldinds = draw_split(nresp, chunklen, nchunks,
+                                           np.random.RandomState(seeds[bi]))
+        valinds.append(heldinds)
+        Rcmats.append(batch_ridge_corr(Rstims[:,notheldinds],
+                                       Rstims[:,heldinds],
+                                       Rresp[notheldinds], Rresp[heldinds],
+                                       alphas, normalpha=normalpha,
+                                       singcutoff=singcutoff,
+                                       use_corr=use_corr, dtype=dtype))
+
+    # Find best alphas
+    if nboots>0:
+        allRcorrs = np.stack(Rcmats, axis=-1)
+    else:
+        allRcorrs = None
+
+    if not single_alpha:
+        if allRcorrs is None:
+            raise ValueError("You must run at least one cross-validation step to assign "
+                             "different alphas to each response.")
+        logger.info("Finding best alpha for each voxel..")
+        valphas = alphas[np.argmax(allRcorrs.mean(3), 1)]
+    else:
+        logger.info("Finding single best alpha..")
+        if allRcorrs is None:
+            if len(alphas)==1:
+                bestalphas = np.repeat(alphas[0], nmodel)
+            else:
+                raise ValueError("You must run at least one cross-validation step "
+                                 "to choose best overall alpha, or only supply one"
+                                 "possible alpha value.")
+        else:
+            bestalphas = alphas[np.argmax(allRcorrs.mean(3).mean(2), 1)]
+        valphas = np.repeat(bestalphas[:,None], nvox, axis=1)
+
+    # Find weights, as ridge does for each design
+    logger.info("Computing weights for each response using entire training set..")
+    U,S,Vh = np.linalg.svd(Rstims, full_matrices=False)
+    UR = np.matmul(U.transpose(0,2,1), np.nan_to_num(Rresp))
+    nalphas = valphas * S[:,:1] if normalpha else valphas
+    D = S[:,:,None] / (S[:,:,None]**2 + nalphas[:,None,:]**2)
+    wt = np.matmul(Vh.transpose(0,2,1), (D * UR).astype(Vh.dtype))
+
+    # Predict responses on prediction set
+    logger.info("Predicting responses for predictions set..")
+    pred = np.nan_to_num(np.matmul(Pstims, wt))
+    if use_corr:
+        zpred = (pred - pred.mean(1, dtype=np.float64)[:,None,:]) / \
+                pred.std(1, dtype=np.float64)[:,None,:]
+        corrs = np.nan_to_num((zs(Presp)[None] * zpred).mean(1))
+    else:
+        resvar = (Presp[None] - pred).var(1, dtype=np.float64)
+        Rsqs = 1 - (resvar / Presp.var(0, dtype=np.float64))
+        corrs = np.sqrt(np.abs(Rsqs)) * np.sign(Rsqs)
+
+    return wt, corrs, valphas, allRcorrs, valinds
+
+
+def resp_stats(resp):
+    """Returns the z-scored [resp] and its variance, the response-side
+    quantities ridge_corr computes for the test responses."""
+    return zs(resp), resp.var(0, dtype=np.float64)
+
+
+class SplitPlan(object):
+    """A fixed set of bootstrap splits for bootstrap_ridge.
+
+    The held-out chunks of all samples are drawn once, from [seed], exactly
+    as bootstrap_ridge draws them. Passing the same plan to the
+    bootstrap_ridge calls of a grid search scores every candidate model on
+    the same splits, which removes split noise from the comparison of
+    models and does the index bookkeeping only once.
+
+    The response side of each split (training responses, held-out
+    responses, and their z-scores and variance) is computed on the first
+    call with a given response array and reused as long as the same array
+    (or a view of the same memory, e.g. resp.T) is passed. This holds about
+    [nboots] copies of the responses in memory.
+
+    Parameters
+    ----------
+    nresp : int
+        Number of training time points.
+    nboots, chunklen, nchunks, seed :
+        As in bootstrap_ridge.
+
+    Usage
+    -----
+    plan = SplitPlan(len(Rresp), 15, 10, 20, seed=0)
+    for stim in candidate_models:
+        wt, corrs, alphas, bcorrs, valinds = bootstrap_ridge(
+            stim, Rresp, ..., split_plan=plan)
+    """
+    def __init__(self, nresp, nboots, chunklen, nchunks, seed=None):
+        self.nresp = nresp
+        self.nboots = nboots
+        self.chunklen = chunklen
+        self.nchunks = nchunks
+        self.seed = seed
+        self.splits = [draw_split(nresp, chunklen, nchunks,
+                                  np.random.RandomState(bseed))
+                       for bseed in bootstrap_seeds(nboots, seed)]
+        self._resp = None
+        self._resp_key = None
+        self._blocks = None
+
+    def __len__(self):
+        return self.nboots
+
+    @property
+    def valinds(self):
+        """Held-out indices of each bootstrap sample."""
+        return [heldinds for heldinds, notheldinds in self.splits]
+
+    def resp_blocks(self, resp):
+        """Returns a list of (resp[notheldinds], resp[heldinds],
+        resp_stats(resp[heldinds])) for each split, computed once per
+        response array."""
+        if resp.shape[0] != self.nresp:
+            raise ValueError("Split plan is for %d time points, got %d."
+                             %(self.nresp, resp.shape[0]))
+        key = (resp.__array_interface__["data"][0], resp.shape,
+               resp.strides, resp.dtype.str)
+        if key != self._resp_key:
+            # holding the array keeps its memory from being reused by another
+            self._resp = resp
+            self._blocks = []
+            for heldinds, notheldinds in self.splits:
+                Presp = resp[heldinds,:]
+                self._blocks.append((resp[notheldinds,:], Presp,
+                                     resp_stats(Presp)))
+            self._resp_key = key
+        return self._blocks
+
+
+def bootstrap_seeds(nboots, seed=None):
+    """Returns one integer seed per bootstrap sample, derived from [seed].
+    The same [seed] always yields the same sequence of per-sample seeds.
+    """
+    return np.random.RandomState(seed).randint(np.iinfo(np.int32).max,
+                                               size=nboots)
+
+def draw_split(nresp, chunklen, nchunks, rng=np.random):
+    """Breaks range(nresp) into chunks of length [chunklen] and holds out
+    [nchunks] randomly selected chunks.
+
+    Returns
+    -------
+    heldinds : array_like, shape (nchunks*chunklen,)
+        Held-out indices, in the order of the selected chunks.
+    notheldinds : array_like
+        The remaining indices, in increasing order.
+    """
+    nchunk_total = nresp // chunklen
+    order = rng.permutation(nchunk_total)[:nchunks]
+    heldinds = (order[:,None]*chunklen + np.arange(chunklen)).ravel()
+    notheldinds = np.setdiff1d(np.arange(nresp), heldinds)
+    return heldinds, notheldinds
+
+def _bootstrap_corr(Rstim, Rresp, heldinds, notheldinds, alphas, corr_kwargs,
+                    cache_key=None, resp_block=None):
+    """Runs ridge_corr for a single bootstrap sample. [resp_block] holds the
+    precomputed response side of the split (see SplitPlan.resp_blocks)."""
+    if resp_block is None:
+        resp_block = (Rresp[notheldinds,:], Rresp[heldinds,:], None)
+    return ridge_corr(Rstim[notheldinds,:], Rstim[heldinds,:],
+                      resp_block[0], resp_block[1], alphas,
+                      cache_key=cache_key, Presp_stats=resp_block[2],
+                      **corr_kwargs)
+
+def _bootstrap_stats_corr(stats, Rresp, heldinds, notheldinds, alphas,
+                          corr_kwargs, cache_key=None, resp_block=None):
+    """Runs stats_ridge_corr for a single bootstrap sample, given the
+    chunk_suffstats of Rstim and Rresp."""
+    # draw_split holds out whole chunks, in chunk order
+    heldchunks = heldinds[::stats["chunklen"]] // stats["chunklen"]
+    return stats_ridge_corr(stats, heldchunks, alphas, **corr_kwargs)
+
+def _bootstrap_kernel_corr(Rgram, Rresp, heldinds, notheldinds, alphas,
+                           corr_kwargs, cache_key=None, resp_block=None):
+    """Runs kernel_ridge_corr for a single bootstrap sample, taking the
+    kernels of the split from the full Gram matrix."""
+    if resp_block is None:
+        resp_block = (Rresp[notheldinds,:], Rresp[heldinds,:], None)
+    return kernel_ridge_corr(Rgram[np.ix_(notheldinds, notheldinds)],
+                             Rgram[np.ix_(heldinds, notheldinds)],
+                             resp_block[0], resp_block[1], alphas,
+                             cache_key=cache_key, Presp_stats=resp_block[2],
+                             **corr_kwargs)
+
+def stim_svd(stim, svd_backend=None, svd_cache=None, cache_key=None,
+             logger=ridge_logger):
+    """Thin SVD of [stim] computed with [svd_backend] (see
+    braincode.math.svdbackend), optionally looked up in an on-disk SVDCache
+    (if the cache accepts its shape, see SVDCache.accepts).
+
+    Returns
+    -------
+    U, S, Vh : array_like
+        As returned by np.linalg.svd(stim, full_matrices=False), possibly
+        truncated by the backend.
+    """
+    backend = get_backend(svd_backend)
+    if svd_cache is not None and not svd_cache.accepts(stim.shape):
+        svd_cache = None
+    if svd_cache is not None:
+        if cache_key is None:
+            cache_key = decomp_key(array_hash(stim), tag=backend.key)
+        cached = svd_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached SVD %s.."%cache_key[:8])
+            return cached
+    U,S,Vh = backend(stim)
+    if svd_cache is not None:
+        svd_cache.put(cache_key, (U, S, Vh))
+    return U, S, Vh
+
+def sing_cutoff(S, singcutoff, n, squared=False):
+    """Returns the singular value threshold below which components of a
+    decomposition with singular values [S] of an n-row matrix are dropped.
+
+    This is [singcutoff] in float64. In lower precision, components below
+    the rounding noise of the decomposition, S[0]*n*eps, are dropped as well
+    since they are pure noise. If S are the square roots of the eigenvalues
+    of a Gram matrix (squared=True) that noise is S[0]*sqrt(n*eps).
+    """
+    if S.dtype == np.float64 or not len(S):
+        return singcutoff
+    eps = np.finfo(S.dtype).eps
+    noise = S[0] * (np.sqrt(n*eps) if squared else n*eps)
+    return max(singcutoff, noise)
+
+def choose_solver(shape, solver="auto"):
+    """Resolves the ridge solver for a stimulus of the given (T, N) shape.
+    "auto" selects the dual (Gram) form when there are more features than
+    time points, the primal (SVD) form otherwise.
+    """
+    if solver == "auto":
+        nt, nf = shape
+        return "dual" if nf > nt else "primal"
+    if solver not in ("primal", "dual", "stream"):
+        raise ValueError("Unknown ridge solver %s"%solver)
+    return solver
+
+def gram(X, Y=None, mem_budget=None, dtype=np.float64):
+    """Computes the kernel np.dot(Y, X.T), or the Gram matrix np.dot(X, X.T)
+    if [Y] is None, by accumulating over column (feature) blocks.
+
+    Only one block of columns of X (and Y) is converted to [dtype] at a time,
+    so X and Y may be memory-mapped arrays of any dtype (e.g. float16 feature
+    stacks) that do not fit in memory as float64.
+
+    Parameters
+    ----------
+    X : array_like, shape (T, N)
+    Y : array_like, shape (TY, N), optional
+    mem_budget : int or None
+        Approximate number of bytes of the converted column blocks. None
+        converts all columns at once.
+
+    X and Y may be DelayedDesign objects. Then only the kernel of their
+    undelayed stimuli is accumulated and the delays are applied to it by
+    shifting, so the delayed design is never formed.
+
+    Returns
+    -------
+    K : array_like, shape (TY, T)
+    """
+    if isinstance(X, DelayedDesign) or isinstance(Y, DelayedDesign):
+        return _delayed_gram(X, Y, mem_budget=mem_budget, dtype=dtype)
+    nt, nf = X.shape
+    ny = nt if Y is None else Y.shape[0]
+    itemsize = np.dtype(dtype).itemsize
+    if mem_budget is None:
+        blocklen = nf
+    else:
+        blocklen = int(max(1, mem_budget // ((nt+ny)*itemsize)))
+    K = np.zeros((ny, nt), dtype=dtype)
+    for start in range(0, nf, blocklen):
+        sel = slice(start, min(nf, start+blocklen))
+        xb = np.asarray(X[:,sel], dtype=dtype)
+        yb = xb if Y is None else np.asarray(Y[:,sel], dtype=dtype)
+        K += np.dot(yb, xb.T)
+    return K
+
+def _delayed_gram(X, Y=None, mem_budget=None, dtype=np.float64):
+    """gram for DelayedDesign arguments, see DelayedDesign."""
+    if Y is None:
+        Y = X
+    if isinstance(X, DelayedDesign) and X.same_delays(Y):
+        return X.shift_gram(gram(X.stim, None if Y is X else Y.stim,
+                                 mem_budget=mem_budget, dtype=dtype))
+    if isinstance(X, DelayedDesign):
+        # Y X_d^T = (Y_d stim^T) shifted along the columns
+        return sum(X.shift(gram(X.stim, Y[:,sel], mem_budget=mem_budget,
+                                dtype=dtype), d, 1)
+                   for d, sel in X.blocks())
+    return sum(Y.shift(gram(X[:,sel], Y.stim, mem_budget=mem_budget,
+                            dtype=dtype), d, 0)
+               for d, sel in Y.blocks())
+
+def kernel_eig(K, svd_cache=None, cache_key=None, logger=ridge_logger):
+    """Eigendecomposition of the Gram matrix K = np.dot(stim, stim.T).
+    The eigenvectors equal the left singular vectors of stim, and the
+    square roots of the eigenvalues its singular values.
+
+    Returns
+    -------
+    U : array_like, shape (T, T)
+        Eigenvectors, ordered by decreasing eigenvalue.
+    S : array_like, shape (T,)
+        Square roots of the (non-negative) eigenvalues, decreasing.
+    """
+    if svd_cache is not None and not svd_cache.accepts(K.shape):
+        svd_cache = None
+    if svd_cache is not None:
+        if cache_key is None:
+            cache_key = decomp_key(array_hash(K), tag="gram")
+        cached = svd_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached eigendecomposition %s.."%cache_key[:8])
+            return cached
+    L, U = np.linalg.eigh(K)
+    L = L[::-1]
+    U = U[:,::-1]
+    S = np.sqrt(np.clip(L, 0, None))
+    if svd_cache is not None:
+        svd_cache.put(cache_key, (U, S))
+    return U, S
+
+
+class DualWeights(object):
+    """Ridge weights held in dual form.
+
+    The primal weights np.dot(stim.T, coef), shape (N, M), are only computed
+    when requested, either as a whole (np.asarray(wt)) or for a selection of
+    features and responses (wt[rows, cols], materialize). Predictions are
+    computed through the (TP, T) test-train kernel without forming them.
+
+    Parameters
+    ----------
+    stim : array_like, shape (T, N)
+        Training stimuli the coefficients were fitted on. May be a memmap.
+    coef : array_like, shape (T, M)
+        Dual coefficients.
+    mem_budget : int or None
+        If given, kernels with stim are accumulated in column blocks of about
+        this many bytes (see gram).
+    """
+    def __init__(self, stim, coef, mem_budget=None):
+        self.stim = stim
+        self.coef = coef
+        self.mem_budget = mem_budget
+
+    @property
+    def shape(self):
+        return (self.stim.shape[1], self.coef.shape[1])
+
+    @property
+    def T(self):
+        return self.materialize().T
+
+    def predict(self, X):
+        """Predicted responses np.dot(X, wt) for stimuli X, shape (TP, N)."""
+        return np.dot(gram(self.stim, X, mem_budget=self.mem_budget,
+                           dtype=self.coef.dtype), self.coef)
+
+    def materialize(self, rows=slice(None), cols=slice(None)):
+        """Primal weights of the selected features (rows) and responses
+        (cols)."""
+        if isinstance(self.stim, DelayedDesign):
+            return self.stim.tdot(self.coef[:,cols])[rows]
+        return np.dot(np.asarray(self.stim[:,rows], dtype=self.coef.dtype).T,
+                      self.coef[:,cols])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        return self.materialize(*key)
+
+    def __array__(self, dtype=None):
+        wt = self.materialize()
+        return wt if dtype is None else wt.astype(dtype)
+
+    def save(self, filename, mem_budget=None, blocklen=4096):
+        """Writes the primal weights to an .npy file without holding the full
+        (N, M) array in memory.
+        The weights are computed in blocks of features and responses taking
+        about [mem_budget] bytes (the budget of the object if not given),
+        together with the block of stimuli they are computed from; without a
+        budget, [blocklen] features of all responses at a time."""
+        nf, nvox = self.shape
+        budget = self.mem_budget if mem_budget is None else mem_budget
+        itemsize = self.coef.dtype.itemsize
+        out = np.lib.format.open_memmap(filename, mode="w+",
+                                        dtype=self.coef.dtype,
+                                        shape=(nf, nvox))
+        if isinstance(self.stim, DelayedDesign):
+            # all delays of a feature come from the same stimulus column, so
+            # the delayed design is transformed a block of responses at a time
+            rowlen = nf
+            collen = nvox if budget is None else \
+                     max(1, budget // (itemsize*(nf+self.coef.shape[0])))
+        elif budget is None:
+            rowlen, collen = blocklen, nvox
+        else:
+            # half of the budget for the float64 stimulus block, half for the
+            # weights
+            rowlen = max(1, min(nf, budget // (16*self.coef.shape[0])))
+            collen = max(1, budget // (2*itemsize*rowlen))
+        for rstart in range(0, nf, rowlen):
+            rows = slice(rstart, min(nf, rstart+rowlen))
+            if not isinstance(self.stim, DelayedDesign):
+                stim = np.asarray(self.stim[:,rows], dtype=self.coef.dtype)
+            for cstart in range(0, nvox, collen):
+                cols = slice(cstart, min(nvox, cstart+collen))
+                if isinstance(self.stim, DelayedDesign):
+                    out[:,cols] = self.stim.tdot(self.coef[:,cols])
+                else:
+                    out[rows,cols] = np.dot(stim.T, self.coef[:,cols])
+        out.flush()
+        del out
+
+
 def mult_diag(d, mtx, left=True):
     """Multiply a full matrix by a diagonal matrix.
     This function should always be faster than dot.
@@ -0,0 +1,273 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+Pluggable thin SVD backends.
+
+Available backends:
+    gesdd      - LAPACK divide-and-conquer SVD (what np.linalg.svd uses).
+    gesvd      - LAPACK QR-iteration SVD; slower, but more robust where
+                 gesdd fails to converge.
+    eigh       - eigendecomposition of the smaller Gram matrix (X X^T or
+                 X^T X). Fast for very thin or very wide matrices, but
+                 loses precision for singular values below
+                 sqrt(eps) * S[0] and drops those below 1e-10, so it is not
+                 one of the exact backends `auto` chooses from.
+    randomized - randomized range finder followed by a small SVD (Halko et
+                 al., 2011). Only computes the leading `rank` components, or
+                 as many as needed to reach an `energy` fraction of the
+                 squared Frobenius norm.
+    auto       - the fastest exact backend for the shape class and dtype of
+                 the input, measured once by `autotune` on a bounded sample
+                 of it and remembered.
+
+All backends return (U, S, Vh) as np.linalg.svd(X, full_matrices=False),
+with S in decreasing order.
+"""
+
+import time
+import json
+import hashlib
+import logging
+import numpy as np
+from scipy import linalg
+
+svd_logger = logging.getLogger("svdbackend")
+
+EXACT_BACKENDS = ('gesdd', 'gesvd')
+
+# shape class and dtype -> fastest backend name, filled by autotune
+_tuned = {}
+
+
+def _lapack_svd(X, driver):
+    return linalg.svd(X, full_matrices=False, lapack_driver=driver,
+                      check_finite=False)
+
+def svd_gesdd(X):
+    """Thin SVD using LAPACK gesdd, falling back to gesvd on failure."""
+    try:
+        return _lapack_svd(X, 'gesdd')
+    except (np.linalg.LinAlgError, linalg.LinAlgError):
+        svd_logger.info("gesdd SVD failed, trying more robust gesvd..")
+        return _lapack_svd(X, 'gesvd')
+
+def svd_gesvd(X):
+    """Thin SVD using LAPACK gesvd."""
+    return _lapack_svd(X, 'gesvd')
+
+def svd_eigh(X, cutoff=1e-10):
+    """Thin SVD from the eigendecomposition of the smaller Gram matrix.
+    Components with singular values below `cutoff` are dropped.
+    """
+    nt, nf = X.shape
+    if nt <= nf:
+        L, U = linalg.eigh(np.dot(X, X.T), check_finite=False)
+    else:
+        L, V = linalg.eigh(np.dot(X.T, X), check_finite=False)
+    L = L[::-1]
+    S = np.sqrt(np.clip(L, 0, None))
+    keep = S > cutoff
+    S = S[keep]
+    if nt <= nf:
+        U = U[:, ::-1][:, keep]
+        Vh = np.dot(U.T, X) / S[:, None]
+    else:
+        V = V[:, ::-1][:, keep]
+        U = np.dot(X, V) / S
+        Vh = V.T
+    return U, S, Vh
+
+def svd_randomized(X, rank=None, energy=None, n_oversamples=10, n_iter=4,
+                   random_state=None):
+    """Randomized truncated SVD.
+
+    Parameters
+    ----------
+    X : array_like, shape (T, N)
+    rank : int or None
+        Number of components to compute.
+    energy : float in (0, 1] or None
+        If `rank` is None, the rank is doubled (starting from 16) until the
+        computed components hold this fraction of the squared Frobenius norm
+        of X; the result is then truncated to the smallest such rank.
+    n_oversamples : int
+        Extra random directions sampled beyond the target rank.
+    n_iter : int
+        Number of (QR-stabilized) power iterations.
+    random_state : int, RandomState or None
+    """
+    rng = random_state
+    if not isinstance(rng, np.random.RandomState):
+        rng = np.random.RandomState(rng)
+    maxrank = min(X.shape)
+    if rank is None and energy is None:
+        raise ValueError("Randomized SVD needs a rank or an energy target.")
+    if rank is not None:
+        return _randomized(X, min(rank, maxrank), n_oversamples, n_iter, rng)
+    total = np.sum(np.square(X))
+    k = min(16, maxrank)
+    while True:
+        U, S, Vh = _randomized(X, k, n_oversamples, n_iter, rng)
+        cum = np.cumsum(S**2) / total
+        if cum[-1] >= energy or k == maxrank:
+            n = min(len(S), np.searchsorted(cum, energy) + 1)
+            return U[:, :n], S[:n], Vh[:n]
+        k = min(2*k, maxrank)
+
+def _randomized(X, k, n_oversamples, n_iter, rng):
+    nt, nf = X.shape
+    ns = min(k + n_oversamples, min(nt, nf))
+    Q = np.dot(X, rng.normal(size=(nf, ns)).astype(X.dtype))
+    Q, _ = linalg.qr(Q, mode='economic', check_finite=False)
+    for i in range(n_iter):
+        Q, _ = linalg.qr(np.dot(X.T, Q), mode='economic', check_finite=False)
+        Q, _ = linalg.qr(np.dot(X, Q), mode='economic', check_finite=False)
+    B = np.dot(Q.T, X)
+    Ub, S, Vh = _lapack_svd(B, 'gesdd')
+    U = np.dot(Q, Ub)
+    return U[:, :k], S[:k], Vh[:k]
+
+
+class SVDBackend(object):
+    """A callable thin-SVD backend.
+
+    Parameters
+    ----------
+    name : str
+        One of 'gesdd', 'gesvd', 'eigh', 'randomized' or 'auto'.
+    rank : int or None
+        Keep only the leading `rank` components.
+    energy : float or None
+        Keep the fewest leading components holding this fraction of the
+        squared Frobenius norm.
+    kwargs :
+        Extra arguments of svd_randomized (n_oversamples, n_iter,
+        random_state).
+
+    Usage
+    -----
+    U, S, Vh = SVDBackend('randomized', rank=100)(X)
+    """
+    def __init__(self, name='gesdd', rank=None, energy=None, **kwargs):
+        if name not in EXACT_BACKENDS + ('eigh', 'randomized', 'auto'):
+            raise ValueError("Unknown SVD backend %s" % name)
+        self.name = name
+        self.rank = rank
+        self.energy = energy
+        self.kwargs = kwargs
+
+    @property
+    def key(self):
+        """A string identifying the decomposition this backend computes,
+        used to tell apart cached results of truncated backends. For the
+        randomized backend it includes n_oversamples, n_iter and
+        random_state; a RandomState is identified by its current state."""
+        if self.rank is None and self.energy is None:
+            return 'svd'
+        key = 'svd-%s-%s-%s' % (self.name, self.rank, self.energy)
+        if self.name == 'randomized':
+            rng = self.kwargs.get('random_state')
+            if isinstance(rng, np.random.RandomState):
+                rng = hashlib.md5(rng.get_state()[1].tobytes()).hexdigest()
+            key += '-%s-%s-%s' % (self.kwargs.get('n_oversamples', 10),
+                                  self.kwargs.get('n_iter', 4), rng)
+        return key
+
+    def __call__(self, X):
+        name = self.name
+        if name == 'auto':
+            name = autotune(X.shape, X.dtype, X=X)
+        if name == 'randomized':
+            return svd_randomized(X, rank=self.rank, energy=self.energy,
+                                  **self.kwargs)
+        elif name == 'gesvd':
+            U, S, Vh = svd_gesvd(X)
+        elif name == 'eigh':
+            U, S, Vh = svd_eigh(X)
+        else:
+            U, S, Vh = svd_gesdd(X)
+        return truncate(U, S, Vh, rank=self.rank, energy=self.energy)
+
+    def __repr__(self):
+        return 'SVDBackend(%r, rank=%r, energy=%r)' % (self.name, self.rank,
+                                                       self.energy)
+
+def get_backend(backend):
+    """Return an SVDBackend for a backend name or an SVDBackend."""
+    if isinstance(backend, SVDBackend):
+        return backend
+    if backend is None:
+        return SVDBackend()
+    return SVDBackend(backend)
+
+def svd(X, backend='gesdd', rank=None, energy=None, **kwargs):
+    """Thin SVD of X with the given backend, see SVDBackend."""
+    if isinstance(backend, SVDBackend):
+        return backend(X)
+    return SVDBackend(backend, rank=rank, energy=energy, **kwargs)(X)
+
+def truncate(U, S, Vh, rank=None, energy=None):
+    """Keep the leading `rank` components, or the fewest leading components
+    holding an `energy` fraction of sum(S**2)."""
+    n = len(S)
+    if rank is not None:
+        n = min(n, rank)
+    if energy is not None and len(S):
+        cum = np.cumsum(S**2) / np.sum(S**2)
+        n = min(n, np.searchsorted(cum, energy) + 1)
+    return U[:, :n], S[:n], Vh[:n]
+
+def shape_class(shape, max_size=512, max_ratio=8):
+    """The (T, N) shape `autotune` times for a (T, N) matrix: each side
+    rounded to a power of two, then both scaled down together until the
+    smaller is at most `max_size`, and the larger clipped to `max_ratio`
+    times the smaller. Matrices of the same class share a choice."""
+    t, n = [2**int(round(np.log2(max(d, 1)))) for d in shape]
+    scale = max(1, min(t, n) // max_size)
+    t, n = t // scale, n // scale
+    cap = max_ratio * min(t, n)
+    return min(t, cap), min(n, cap)
+
+def autotune(shape, dtype=np.float64, backends=EXACT_BACKENDS, repeat=2,
+             tune_file=None, X=None):
+    """Return the fastest exact backend for a (T, N) matrix of `dtype`.
+
+    Each backend is timed on a matrix of the shape class of `shape` (see
+    shape_class), which is at most 512 x 4096: the leading block of `X` if
+    it is given, a random matrix otherwise. The choice is
+    made once per shape class and dtype, remembered for the rest of the
+    session and, if `tune_file` (a JSON file) is given, across sessions.
+    """
+    t, n = shape_class(shape)
+    key = '%dx%d-%s' % (t, n, np.dtype(dtype).name)
+    if key in _tuned:
+        return _tuned[key]
+    if tune_file is not None:
+        try:
+            with open(tune_file) as f:
+                _tuned.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        if key in _tuned:
+            return _tuned[key]
+    if X is not None:
+        sample = np.array(X[:t, :n], dtype=dtype)
+    else:
+        sample = np.random.RandomState(0).standard_normal((t, n))
+        sample = sample.astype(dtype)
+    timing = {}
+    for name in backends:
+        best = np.inf
+        for r in range(repeat):
+            tic = time.time()
+            SVDBackend(name)(sample)
+            best = min(best, time.time() - tic)
+        timing[name] = best
+    choice = min(timing, key=timing.get)
+    svd_logger.info("SVD autotune %s: %s (%s)" % (key, choice, timing))
+    _tuned[key] = choice
+    if tune_file is not None:
+        with open(tune_file, 'w') as f:
+            json.dump(_tuned, f)
+    return choice
@@ -0,0 +1,169 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+On-disk cache of stimulus decompositions.
+
+The design matrices used for ridge regression (candidate pRF models, CNN
+layer features) are the same for every ROI and every subject, so the SVD of
+each design, and of each of its bootstrap training splits, only has to be
+computed once. Decompositions are stored as .npz files named by a content
+hash of the design matrix and the selected sample indices; the least
+recently used files are removed once the cache exceeds its size cap.
+
+Only decompositions that cost more to compute than to read back are
+cached. A thin SVD of a (T, N) matrix takes O(T N r) flops for r = min(T, N)
+but reads back only the O((T + N) r) values of its factors, so the ratio
+grows with r; below about r = 256 (e.g. the 46 or 72 channels of the pRF
+candidate models) recomputing is as fast as the disk and the cache is
+skipped, see SVDCache.accepts.
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+
+def array_hash(arr, block_bytes=64*1024**2):
+    """Return a hex digest of the shape, dtype and content of `arr`.
+    The content is hashed in blocks of rows of about `block_bytes`, so `arr`
+    can be a memmap (or a view of one) larger than memory.
+    """
+    h = hashlib.sha1()
+    h.update(str(arr.shape).encode())
+    h.update(str(arr.dtype).encode())
+    if arr.ndim == 0 or arr.shape[0] == 0:
+        h.update(np.ascontiguousarray(arr).view(np.uint8).ravel().data)
+        return h.hexdigest()
+    row_bytes = max(1, arr[0].nbytes)
+    blocklen = max(1, block_bytes // row_bytes)
+    for start in range(0, arr.shape[0], blocklen):
+        block = np.ascontiguousarray(arr[start:start+blocklen])
+        h.update(block.view(np.uint8).ravel().data)
+    return h.hexdigest()
+
+def decomp_key(stim_hash, inds=None, tag='svd'):
+    """Return the cache key of a decomposition.
+    `stim_hash` is the array_hash of the full design matrix, `inds` are the
+    row indices (e.g. the not-held-out samples of a bootstrap split) the
+    decomposition is computed from, None for all rows.
+    """
+    h = hashlib.sha1()
+    h.update(tag.encode())
+    h.update(stim_hash.encode())
+    if inds is not None:
+        h.update(np.ascontiguousarray(inds, dtype=np.int64).data)
+    return h.hexdigest()
+
+
+class SVDCache(object):
+    """LRU-evicted on-disk store of matrix decompositions.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cached .npz files. Several processes may share
+        the same directory.
+    max_size : int
+        Size cap of the cache in bytes. Once exceeded, the least recently used
+        entries are removed.
+    min_rank : int
+        Decompositions of matrices whose smaller dimension is below
+        `min_rank` are not cached, see `accepts`.
+    low_water : float
+        Eviction removes entries until the cache is below this fraction of
+        `max_size`, so that the directory is only scanned once every
+        (1 - low_water) * max_size bytes of new entries.
+
+    The size of the cache is kept as a running total of the entries put by
+    this process, initialized from a scan of the directory and refreshed by
+    each eviction; entries put by other processes sharing the directory are
+    counted at the next scan.
+    """
+    def __init__(self, cache_dir, max_size=4*1024**3, min_rank=256,
+                 low_water=0.9):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.min_rank = min_rank
+        self.low_water = low_water
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key+'.npz')
+
+    def accepts(self, shape):
+        """Whether the decomposition of a matrix of `shape` is worth caching,
+        i.e. its smaller dimension is at least `min_rank`."""
+        return min(shape) >= self.min_rank
+
+    def get(self, key):
+        """Return the cached arrays of `key` as a tuple, or None."""
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                arrays = tuple(f['arr_%d'%i] for i in range(len(f.files)))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return arrays
+
+    def put(self, key, arrays):
+        """Store the tuple `arrays` under `key` and enforce the size cap."""
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, *arrays)
+        nbytes = os.path.getsize(tmp)
+        try:
+            nbytes -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.rename(tmp, path)
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += nbytes
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is below
+        `low_water` * `max_size`."""
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith('.npz'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, fname))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+        total = sum(e[1] for e in entries)
+        for mtime, size, fname in sorted(entries):
+            if total <= self.low_water * self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, fname))
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+    def size(self):
+        """Return the current size of the cache in bytes."""
+        return sum(os.path.getsize(os.path.join(self.cache_dir, f))
+                   for f in os.listdir(self.cache_dir) if f.endswith('.npz'))
+
+    def clear(self):
+        """Remove all cached entries."""
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.npz'):
+                os.remove(os.path.join(self.cache_dir, fname))
+        self._size = 0
@@ -4,7 +4,7 @@
 import os
 import numpy as np
 from joblib import Parallel, delayed
-from braincode.math import corr2_coef, ols_fit, ridge
+from braincode.math import corr2_coef, ols_fit, ridge, reliability
 
 
 def random_cross_modal_corr(fmri_ts, feat_ts, voxel_num, iter_num, filename):
@@ -54,24 +54,44 @@ def mrf(in_fmri, in_feat, out, idx):
             out[idx, i, j] = ols_fit(y, x)
 
 def ridge_regression(train_feat, train_fmri, val_feat, val_fmri,
-                     out_dir, prefix, with_wt=True, n_cpus=4):
+                     out_dir, prefix, with_wt=True, n_cpus=4, rep_fmri=None,
+                     rel_thr=None, rel_top_k=None):
     """Calculate ridge regression between features from one pixel location and
     the fmri responses from all voxels.
+    If `rel_thr` and/or `rel_top_k` are given, only voxels whose split-half
+    reliability across the repeated responses `rep_fmri` (#voxel, #repeat,
+    #time) exceeds `rel_thr` and/or is among the `rel_top_k` highest are
+    fitted; the outputs of the other voxels are NaN.
     """
+    vxl_sel = slice(None)
+    if rel_thr is not None or rel_top_k is not None:
+        if rep_fmri is None:
+            raise ValueError("Voxel prescreening needs repeated responses.")
+        rel = reliability.split_half_reliability(rep_fmri)
+        vxl_sel = reliability.select_voxels(rel, threshold=rel_thr,
+                                            top_k=rel_top_k)
+        np.save(os.path.join(out_dir, prefix+'_vxl_reliability.npy'), rel)
+        print 'Reliable voxel number: %s'%(len(vxl_sel))
     feat_size = train_feat.shape[0]
     pixel_size = (train_feat.shape[1], train_feat.shape[2])
     voxel_size = train_fmri.shape[0]
     corr_file = os.path.join(out_dir, prefix+'_corr.npy')
     corr_mtx = np.memmap(corr_file, dtype='float16', mode='w+',
                          shape=(pixel_size[0]*pixel_size[1], voxel_size))
+    if not isinstance(vxl_sel, slice):
+        corr_mtx[:] = np.NaN
+        train_fmri = train_fmri[vxl_sel]
+        val_fmri = val_fmri[vxl_sel]
     if with_wt:
         wt_file = os.path.join(out_dir, prefix+'_weights.npy')
         wt_mtx = np.memmap(wt_file, dtype='float16', mode='w+',
                     shape=(pixel_size[0]*pixel_size[1], voxel_size, feat_size))
+        if not isinstance(vxl_sel, slice):
+            wt_mtx[:] = np.NaN
         print 'Compute Ridge regreesion for each pixel ...'
         Parallel(n_jobs=n_cpus)(delayed(ridge_sugar_with_wt)(train_feat,
                                                 train_fmri, val_feat, val_fmri,
-                                                corr_mtx, wt_mtx, v)
+                                                corr_mtx, wt_mtx, v, vxl_sel)
                                             for v in [(i, j)
                                                 for i in range(pixel_size[0])
                                                 for j in range(pixel_size[1])])
@@ -81,7 +101,7 @@ def ridge_regression(train_feat, train_fmri, val_feat, val_fmri,
         print 'Compute Ridge regreesion for each pixel ...'
         Parallel(n_jobs=n_cpus)(delayed(ridge_sugar)(train_feat, train_fmri,
                                                      val_feat, val_fmri,
-                                                     corr_mtx, v)
+                                                     corr_mtx, v, vxl_sel)
                                             for v in [(i, j)
                                                 for i in range(pixel_size[0])
                                                 for j in range(pixel_size[1])])
@@ -89,41 +109,52 @@ def ridge_regression(train_feat, train_fmri, val_feat, val_fmri,
     np.save(corr_file, narray)
 
 def layer_ridge_regression(train_feat, train_fmri, val_feat, val_fmri,
-                           out_dir, prefix, with_wt=True):
+                           out_dir, prefix, with_wt=True, mem_budget=None):
     """Calculate ridge regression between features from one layer and
     the fmri responses from all voxels.
+    If `mem_budget` (in bytes) is given, the (memory-mapped) features are
+    streamed in column blocks of about that size instead of being loaded.
     """
     train_feat = train_feat.reshape(-1, train_feat.shape[3])
     val_feat = val_feat.reshape(-1, val_feat.shape[3])
     voxel_size = train_fmri.shape[0]
     corr_file = os.path.join(out_dir, prefix+'_corr.npy')
-    wt, corr, valphas, bscores, valinds = ridge.bootstrap_ridge(train_feat.T, train_fmri.T, val_feat.T, val_fmri.T, alphas=np.logspace(-2, 2, 20), nboots=5, chunklen=100, nchunks=10, single_alpha=True)
+    solver = 'auto' if mem_budget is None else 'stream'
+    wt, corr, valphas, bscores, valinds = ridge.bootstrap_ridge(train_feat.T, train_fmri.T, val_feat.T, val_fmri.T, alphas=np.logspace(-2, 2, 20), nboots=5, chunklen=100, nchunks=10, single_alpha=True, solver=solver, mem_budget=mem_budget, return_dual=True)
     np.save(corr_file, corr)
     if with_wt:
         wt_file = os.path.join(out_dir, prefix+'_weights.npy')
-        np.save(wt_file, wt)
-
-def ridge_sugar(train_feat, train_fmri, val_feat, val_fmri, corr_mtx, idx):
-    """Sugar function for ridge regression."""
+        # layer-wide models are fitted in dual form, weights are written
+        # block by block
+        if isinstance(wt, ridge.DualWeights):
+            wt.save(wt_file, mem_budget=mem_budget)
+        else:
+            np.save(wt_file, wt)
+
+def ridge_sugar(train_feat, train_fmri, val_feat, val_fmri, corr_mtx, idx,
+                vxl_sel=slice(None)):
+    """Sugar function for ridge regression.
+    The fmri responses are those of the voxels `vxl_sel` of `corr_mtx`."""
     pixel_size = (train_feat.shape[1], train_feat.shape[2])
     row, col = idx[0], idx[1]
     print 'row %s - col %s' % (row, col)
     tfeat = train_feat[:, row, col, :]
     vfeat = val_feat[:, row, col, :]
     wt, corr, valphas, bscores, valinds = ridge.bootstrap_ridge(tfeat.T, train_fmri.T, vfeat.T, val_fmri.T, alphas=np.logspace(-2, 2, 20), nboots=5, chunklen=100, nchunks=10, single_alpha=True)
-    corr_mtx[row*pixel_size[0]+col] = corr
+    corr_mtx[row*pixel_size[0]+col, vxl_sel] = corr
 
 def ridge_sugar_with_wt(train_feat, train_fmri, val_feat, val_fmri,
-                        corr_mtx, wt_mtx, idx):
-    """Sugar function for ridge regression."""
+                        corr_mtx, wt_mtx, idx, vxl_sel=slice(None)):
+    """Sugar function for ridge regression.
+    The fmri responses are those of the voxels `vxl_sel` of `corr_mtx`."""
     pixel_size = (train_feat.shape[1], train_feat.shape[2])
     row, col = idx[0], idx[1]
     print 'row %s - col %s' % (row, col)
     tfeat = train_feat[:, row, col, :]
     vfeat = val_feat[:, row, col, :]
     wt, corr, valphas, bscores, valinds = ridge.bootstrap_ridge(tfeat.T, train_fmri.T, vfeat.T, val_fmri.T, alphas=np.logspace(-2, 2, 20), nboots=5, chunklen=100, nchunks=10, single_alpha=True)
-    corr_mtx[row*pixel_size[0]+col] = corr
-    wt_mtx[row*pixel_size[0]+col] = wt.T
+    corr_mtx[row*pixel_size[0]+col, vxl_sel] = corr
+    wt_mtx[row*pixel_size[0]+col, vxl_sel] = wt.T
 
 def pred_cnn_ridge(train_fmri, train_feat, val_fmri, val_feat,
                    out_dir, prefix, with_wt=True, n_cpus=2):
@@ -42,6 +42,20 @@ def load_vim2_fmri(db_dir, subj_id, roi=None):
     tf.close()
     return vxl_idx, train_ts, val_ts
 
+def load_vim2_rep_fmri(db_dir, subj_id, vxl_idx):
+    """Load the responses of the selected voxels to each of the 10 repeats of
+    the validation stimulus, shape (#voxel, 10, 540)."""
+    fmri_file = os.path.join(db_dir, 'VoxelResponses_subject%s.mat'%(subj_id))
+    tf = tables.open_file(fmri_file)
+    voxel_num = tf.get_node('/rt').shape[0]
+    rep_ts = tf.get_node('/rva')[:]
+    # keep voxels on the first axis
+    if rep_ts.shape[0] != voxel_num:
+        rep_ts = rep_ts.T
+    rep_ts = np.nan_to_num(rep_ts[vxl_idx])
+    tf.close()
+    return rep_ts
+
 def load_vim1_fmri(db_dir, subj_id, roi=None):
     """Load fmri time courses for each voxel within specified ROI."""
     fmri_file = os.path.join(db_dir, 'EstimatedResponses.mat')
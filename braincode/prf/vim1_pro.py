@@ -9,7 +9,8 @@ from joblib import Parallel, delayed
 from sklearn import linear_model
 
 from braincode.util import configParser
-from braincode.math import make_2d_gaussian, ridge
+from braincode.math import make_2d_gaussian, gaussian_pool, ridge
+from braincode.math import reliability
 from braincode.math.norm import zscore
 from braincode.prf import dataio
 from braincode.prf import util as vutil
@@ -85,8 +86,7 @@ def get_candidate_model(feat_dir, data_type):
                                     'train_candidate_model_%02d.npy'%(i+1))
             cand_model = np.memmap(out_file, dtype='float16', mode='w+',
                     shape=(50*50*17, tmp.shape[0], 72))
-            Parallel(n_jobs=4)(delayed(model_pro)(tmp, cand_model, xi, yi, si)
-                    for si in range(17) for xi in range(50) for yi in range(50))
+            model_pro(tmp, cand_model)
             # save memmap object as a numpy.array
             model_array = np.array(cand_model)
             np.save(out_file, model_array)
@@ -111,32 +111,24 @@ def get_candidate_model(feat_dir, data_type):
         out_file = os.path.join(feat_dir, '%s_candidate_model.npy'%(data_type))
         cand_model = np.memmap(out_file, dtype='float16', mode='w+',
                                shape=(50*50*17, time_count, 72))
-        Parallel(n_jobs=4)(delayed(model_pro)(tmp, cand_model, xi, yi, si)
-                    for si in range(17) for xi in range(50) for yi in range(50))
+        model_pro(tmp, cand_model)
         # save memmap object as a numpy.array
         model_array = np.array(cand_model)
         np.save(out_file, model_array)
 
-def model_pro(feat, cand_model, xi, yi, si):
-    """Sugar function for generating candidate model."""
-    mi = si*50*50 + xi*50 + yi
-    center_x = np.arange(5, 500, 10)
-    center_y = np.arange(5, 500, 10)
+def model_pro(feat, cand_model):
+    """Sugar function for generating candidate model.
+    Gabor features `feat` of shape (time, 72, 500, 500) are pooled with all
+    gaussian kernels at once, 10 time points per pass.
+    """
+    center = np.arange(5, 500, 10)
     sigma = [1] + [n*5 for n in range(1, 13)] + [70, 80, 90, 100]
-    x0 = center_x[xi]
-    y0 = center_y[yi]
-    s = sigma[si]
-    print 'Model %s : center - (%s, %s), sigma %s'%(mi, y0, x0, s)
-    kernel = make_2d_gaussian(500, s, center=(x0, y0))
-    kernel = kernel.flatten()
-    idx_head = 0
-    parts = feat.shape[0] / 10
-    for i in range(parts):
-        tmp = feat[(i*10):(i*10+10), ...]
-        tmp = tmp.reshape(720, 250000)
-        res = tmp.dot(kernel).astype(np.float16)
-        cand_model[mi, idx_head:(idx_head+10), ...] = res.reshape(10, 72)
-        idx_head += 10
+    out = cand_model.reshape(17, 50, 50, feat.shape[0], 72)
+    for i in range(0, feat.shape[0], 10):
+        print 'Time point %s'%(i)
+        tmp = np.transpose(feat[i:(i+10), ...], (2, 3, 0, 1))
+        res = gaussian_pool(tmp, sigma, center, col_block=144)
+        out[:, :, :, i:(i+10), :] = res.astype(np.float16)
 
 def get_candidate_model_new(db_dir, data_type):
     """Get gaussian kernel based on receptivefield features."""
@@ -152,33 +144,24 @@ def get_candidate_model_new(db_dir, data_type):
     out_file = os.path.join(db_dir, '%s_candidate_model.npy'%(data_type))
     cand_model = np.memmap(out_file, dtype='float16', mode='w+',
                            shape=(50*50*10, img_num[data_type], 72))
-    Parallel(n_jobs=4)(delayed(model_pro_new)(feat, cand_model, xi, yi, si)
-                for si in range(10) for xi in range(50) for yi in range(50))
+    model_pro_new(feat, cand_model)
     # save memmap object as a numpy.array
     model_array = np.array(cand_model)
     np.save(out_file, model_array)
 
-def model_pro_new(feat, cand_model, xi, yi, si):
-    """Sugar function for generating candidate model."""
-    mi = si*50*50 + xi*50 + yi
-    center_x = np.arange(2, 250, 5)
-    center_y = np.arange(2, 250, 5)
+def model_pro_new(feat, cand_model):
+    """Sugar function for generating candidate model.
+    Gabor features `feat` of shape (image, 250, 250, 72) are pooled with all
+    gaussian kernels at once, 10 images per pass.
+    """
+    center = np.arange(2, 250, 5)
     sigma = [2, 4, 8, 16, 32, 60, 70, 80, 90, 100]
-    x0 = center_x[xi]
-    y0 = center_y[yi]
-    s = sigma[si]
-    print 'Model %s : center - (%s, %s), sigma %s'%(mi, y0, x0, s)
-    kernel = make_2d_gaussian(250, s, center=(x0, y0))
-    kernel = kernel.flatten()
-    idx_head = 0
-    parts = feat.shape[0] / 10
-    for i in range(parts):
-        tmp = feat[(i*10):(i*10+10), ...]
-        tmp = np.transpose(tmp, (0, 3, 1, 2))
-        tmp = tmp.reshape(720, 62500)
-        res = tmp.dot(kernel).astype(np.float16)
-        cand_model[mi, idx_head:(idx_head+10), ...] = res.reshape(10, 72)
-        idx_head += 10
+    out = cand_model.reshape(10, 50, 50, feat.shape[0], 72)
+    for i in range(0, feat.shape[0], 10):
+        print 'Image %s'%(i)
+        tmp = np.transpose(feat[i:(i+10), ...], (1, 2, 0, 3))
+        res = gaussian_pool(tmp, sigma, center, col_block=144)
+        out[:, :, :, i:(i+10), :] = res.astype(np.float16)
 
 def get_vxl_idx(prf_dir, db_dir, subj_id, roi):
     """Get voxel index in specific ROI"""
@@ -190,10 +173,24 @@ def get_vxl_idx(prf_dir, db_dir, subj_id, roi):
     check_path(roi_dir)
     np.save(os.path.join(roi_dir, 'vxl_idx.npy'), vxl_idx)
 
-def ridge_fitting(feat_dir, prf_dir, db_dir, subj_id, roi):
+def ridge_fitting(feat_dir, prf_dir, db_dir, subj_id, roi, n_jobs=1,
+                  svd_cache=None, seed=None, batch_size=None):
     """pRF model fitting using ridge regression.
     90% trainning data used for model tuning, and another 10% data used for
     model seletion.
+    `n_jobs` bootstrap samples of each model are fitted in parallel.
+    If a `svd_cache` (braincode.math.svdcache.SVDCache) is given together with
+    a fixed `seed`, the decompositions of the candidate models are shared
+    across ROIs and subjects, if they are large enough to be worth caching
+    (see SVDCache.accepts). With the default `min_rank` the 72-channel
+    candidate models are not cached, their SVDs being cheaper to recompute
+    than to read back.
+    If `batch_size` is given, blocks of `batch_size` candidate models are
+    fitted at once with ridge.batch_bootstrap_ridge instead (`n_jobs` and
+    `svd_cache` are not used then); with a fixed `seed` the results are the
+    same as fitting the models one by one.
+    Either way all candidate models are scored on the same bootstrap splits,
+    drawn once from `seed`.
     """
     # load fmri response
     vxl_idx, train_fmri_ts, val_fmri_ts = dataio.load_vim1_fmri(db_dir, subj_id,
@@ -227,33 +224,60 @@ def ridge_fitting(feat_dir, prf_dir, db_dir, subj_id, roi):
     tune_fmri_ts = train_fmri_ts[:, :int(1750*0.9)]
     sel_fmri_ts = train_fmri_ts[:, int(1750*0.9):]
     # model testing
-    for i in range(42500):
-        print 'Model %s'%(i)
+    if batch_size is not None:
         # remove models which centered outside the 20 degree of visual angle
-        xi = (i % 2500) / 50
-        yi = (i % 2500) % 50
-        x0 = np.arange(5, 500, 10)[xi]
-        y0 = np.arange(5, 500, 10)[yi]
+        x0 = np.arange(5, 500, 10)[(np.arange(42500) % 2500) / 50]
+        y0 = np.arange(5, 500, 10)[(np.arange(42500) % 2500) % 50]
         d = np.sqrt(np.square(x0-250)+np.square(y0-250))
-        if d > 249:
-            print 'Model center outside the visual angle'
-            paras[i, ...] = np.NaN
-            mcorr[i] = np.NaN
-            alphas[i] = np.NaN
-            continue
-        train_x = np.array(train_models[i, ...]).astype(np.float64)
-        train_x = zscore(train_x.T).T
-        # split training dataset into model tunning and selection sets
-        tune_x = train_x[:int(1750*0.9), :]
-        sel_x = train_x[int(1750*0.9):, :]
-        wt, r, alpha, bscores, valinds = ridge.bootstrap_ridge(
-                tune_x, tune_fmri_ts.T, sel_x, sel_fmri_ts.T,
+        paras[d > 249, ...] = np.NaN
+        mcorr[d > 249] = np.NaN
+        alphas[d > 249] = np.NaN
+        model_idx = np.nonzero(d <= 249)[0]
+        for i in range(0, len(model_idx), batch_size):
+            idx = model_idx[i:i+batch_size]
+            print 'Model %s-%s'%(idx[0], idx[-1])
+            batch_x = np.array(train_models[idx, ...]).astype(np.float64)
+            batch_x = np.array([zscore(x.T).T for x in batch_x])
+            wt, r, alpha, bscores, valinds = ridge.batch_bootstrap_ridge(
+                batch_x[:, :int(1750*0.9), :], tune_fmri_ts.T,
+                batch_x[:, int(1750*0.9):, :], sel_fmri_ts.T,
                 alphas=np.logspace(-2, 3, ALPHA_NUM),
                 nboots=BOOTS_NUM, chunklen=175, nchunks=1,
-                single_alpha=False, use_corr=False)
-        paras[i, ...] = wt.T
-        mcorr[i] = r
-        alphas[i] = alpha
+                single_alpha=False, use_corr=False, seed=seed)
+            paras[idx, ...] = wt.transpose(0, 2, 1)
+            mcorr[idx] = r
+            alphas[idx] = alpha
+    else:
+        # all candidate models are scored on the same bootstrap splits
+        split_plan = ridge.SplitPlan(int(1750*0.9), BOOTS_NUM, 175, 1, seed=seed)
+        for i in range(42500):
+            print 'Model %s'%(i)
+            # remove models which centered outside the 20 degree of visual angle
+            xi = (i % 2500) / 50
+            yi = (i % 2500) % 50
+            x0 = np.arange(5, 500, 10)[xi]
+            y0 = np.arange(5, 500, 10)[yi]
+            d = np.sqrt(np.square(x0-250)+np.square(y0-250))
+            if d > 249:
+                print 'Model center outside the visual angle'
+                paras[i, ...] = np.NaN
+                mcorr[i] = np.NaN
+                alphas[i] = np.NaN
+                continue
+            train_x = np.array(train_models[i, ...]).astype(np.float64)
+            train_x = zscore(train_x.T).T
+            # split training dataset into model tunning and selection sets
+            tune_x = train_x[:int(1750*0.9), :]
+            sel_x = train_x[int(1750*0.9):, :]
+            wt, r, alpha, bscores, valinds = ridge.bootstrap_ridge(
+                    tune_x, tune_fmri_ts.T, sel_x, sel_fmri_ts.T,
+                    alphas=np.logspace(-2, 3, ALPHA_NUM),
+                    nboots=BOOTS_NUM, chunklen=175, nchunks=1,
+                    single_alpha=False, use_corr=False, n_jobs=n_jobs,
+                    svd_cache=svd_cache, split_plan=split_plan)
+            paras[i, ...] = wt.T
+            mcorr[i] = r
+            alphas[i] = alpha
     # save output
     paras = np.array(paras)
     np.save(paras_file, paras)
@@ -262,16 +286,31 @@ def ridge_fitting(feat_dir, prf_dir, db_dir, subj_id, roi):
     alphas = np.array(alphas)
     np.save(alphas_file, alphas)
 
-def ridge_regression(prf_dir, db_dir, subj_id, roi):
+def ridge_regression(prf_dir, db_dir, subj_id, roi, rep_fmri=None,
+                     rel_thr=None, rel_top_k=None):
     """pRF model fitting using ridge regression.
     90% trainning data used for model tuning, and another 10% data used for
     model seletion.
+    If `rel_thr` and/or `rel_top_k` are given, only voxels whose split-half
+    reliability across repeated validation trials exceeds `rel_thr` and/or
+    is among the `rel_top_k` highest are fitted; the outputs of the other
+    voxels are NaN. `rep_fmri` holds the single-trial validation responses
+    of the ROI voxels, shape (#voxel, #repeat, #image).
     """
     # load fmri response
     vxl_idx, train_fmri_ts, val_fmri_ts = dataio.load_vim1_fmri(db_dir, subj_id,
                                                                 roi=roi)
     del val_fmri_ts
     print 'Voxel number: %s'%(len(vxl_idx))
+    # voxel prescreening
+    fit_vxls = range(len(vxl_idx))
+    if rel_thr is not None or rel_top_k is not None:
+        if rep_fmri is None:
+            raise ValueError("Voxel prescreening needs repeated responses.")
+        rel = reliability.split_half_reliability(rep_fmri)
+        fit_vxls = reliability.select_voxels(rel, threshold=rel_thr,
+                                             top_k=rel_top_k)
+        print 'Reliable voxel number: %s'%(len(fit_vxls))
     # load candidate models
     train_models = np.load(os.path.join(db_dir, 'train_candidate_model.npy'),
                            mmap_mode='r')
@@ -290,6 +329,11 @@ def ridge_regression(prf_dir, db_dir, subj_id, roi):
     alphas_file = os.path.join(roi_dir, 'reg_alphas.npy')
     alphas = np.memmap(alphas_file, dtype='float64', mode='w+',
                        shape=(len(vxl_idx)))
+    if rel_thr is not None or rel_top_k is not None:
+        np.save(os.path.join(roi_dir, 'vxl_reliability.npy'), rel)
+        paras[:] = np.NaN
+        val_r2[:] = np.NaN
+        alphas[:] = np.NaN
     # fMRI data z-score
     print 'fmri data temporal z-score'
     m = np.mean(train_fmri_ts, axis=1, keepdims=True)
@@ -299,7 +343,7 @@ def ridge_regression(prf_dir, db_dir, subj_id, roi):
     tune_fmri_ts = train_fmri_ts[:, :int(1750*0.9)]
     sel_fmri_ts = train_fmri_ts[:, int(1750*0.9):]
     # model fitting
-    for i in range(len(vxl_idx)):
+    for i in fit_vxls:
         print '-----------------'
         print 'Voxel %s'%(i)
         for j in range(25000):
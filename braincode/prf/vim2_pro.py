@@ -11,7 +11,9 @@ import bob.ip.gabor
 import bob.sp
 
 from braincode.util import configParser
-from braincode.math import ipl, make_2d_gaussian, ridge, make_cycle
+from braincode.math import ipl, make_2d_gaussian, gaussian_pool, ridge
+from braincode.math import make_cycle
+from braincode.math import reliability
 from braincode.pipeline import retinotopy
 from braincode.timeseries import hrf
 from braincode.math.norm import zscore
@@ -157,8 +159,18 @@ def get_candidate_model(feat_dir, kernel='gaussian'):
                             shape=(32*32*15, 46, 7200))
     val_model = np.memmap(out_val, dtype='float16', mode='w+',
                           shape=(32*32*15, 46, 540))
-    Parallel(n_jobs=4)(delayed(model_pro)(train_feat, val_feat, train_model,
-                                          val_model, kernel, xi, yi, si)
+    if kernel == 'gaussian':
+        # one separable pooling pass per sigma over all centers
+        centers = np.arange(0, 128, 4)
+        sigma = np.linspace(1, 50, 15)
+        gaussian_pool(train_feat.reshape(128, 128, 46*7200), sigma, centers,
+                      out=train_model.reshape(15, 32, 32, 46*7200))
+        gaussian_pool(val_feat.reshape(128, 128, 46*540), sigma, centers,
+                      out=val_model.reshape(15, 32, 32, 46*540))
+    else:
+        Parallel(n_jobs=4)(delayed(model_pro)(train_feat, val_feat,
+                                              train_model, val_model, kernel,
+                                              xi, yi, si)
                     for si in range(15) for xi in range(32) for yi in range(32))
     
     # save memmap object as a numpy.array
@@ -201,16 +213,45 @@ def para2hue(paras):
         hues += paras[i]*tmp
     return hues
 
-def ridge_fitting(feat_dir, prf_dir, db_dir, subj_id, roi):
+def ridge_fitting(feat_dir, prf_dir, db_dir, subj_id, roi, n_jobs=1,
+                  svd_cache=None, seed=None, batch_size=None, rel_thr=None,
+                  rel_top_k=None):
     """pRF model fitting using ridge regression.
     90% trainning data used for model tuning, and another 10% data used for
     model seletion.
+    `n_jobs` bootstrap samples of each model are fitted in parallel.
+    If a `svd_cache` (braincode.math.svdcache.SVDCache) is given together with
+    a fixed `seed`, the decompositions of the candidate models are shared
+    across ROIs and subjects, if they are large enough to be worth caching
+    (see SVDCache.accepts). With the default `min_rank` the 46-channel
+    candidate models are not cached, their SVDs being cheaper to recompute
+    than to read back.
+    If `batch_size` is given, blocks of `batch_size` candidate models are
+    fitted at once with ridge.batch_bootstrap_ridge instead (`n_jobs` and
+    `svd_cache` are not used then); with a fixed `seed` the results are the
+    same as fitting the models one by one.
+    Either way all candidate models are scored on the same bootstrap splits,
+    drawn once from `seed`.
+    If `rel_thr` and/or `rel_top_k` are given, only voxels whose split-half
+    reliability across the repeated validation runs exceeds `rel_thr`
+    and/or is among the `rel_top_k` highest are fitted; the outputs of the
+    other voxels are NaN.
     """
     # load fmri response
     vxl_idx, train_fmri_ts, val_fmri_ts = dataio.load_vim2_fmri(db_dir, subj_id,
                                                                 roi=roi)
     del val_fmri_ts
     print 'Voxel number: %s'%(len(vxl_idx))
+    # voxel prescreening
+    vxl_sel = slice(None)
+    if rel_thr is not None or rel_top_k is not None:
+        rep_fmri_ts = dataio.load_vim2_rep_fmri(db_dir, subj_id, vxl_idx)
+        rel = reliability.split_half_reliability(rep_fmri_ts, seed=seed)
+        del rep_fmri_ts
+        vxl_sel = reliability.select_voxels(rel, threshold=rel_thr,
+                                            top_k=rel_top_k)
+        train_fmri_ts = train_fmri_ts[vxl_sel]
+        print 'Reliable voxel number: %s'%(len(vxl_sel))
     # load candidate models
     train_models = np.load(os.path.join(feat_dir, 'train_candidate_model.npy'),
                            mmap_mode='r')
@@ -229,6 +270,11 @@ def ridge_fitting(feat_dir, prf_dir, db_dir, subj_id, roi):
     alphas_file = os.path.join(roi_dir, 'reg_alphas.npy')
     alphas = np.memmap(alphas_file, dtype='float64', mode='w+',
                        shape=(15360, len(vxl_idx)))
+    if rel_thr is not None or rel_top_k is not None:
+        np.save(os.path.join(roi_dir, 'vxl_reliability.npy'), rel)
+        paras[:] = np.NaN
+        mcorr[:] = np.NaN
+        alphas[:] = np.NaN
     # fMRI data z-score
     print 'fmri data temporal z-score'
     m = np.mean(train_fmri_ts, axis=1, keepdims=True)
@@ -238,21 +284,39 @@ def ridge_fitting(feat_dir, prf_dir, db_dir, subj_id, roi):
     tune_fmri_ts = train_fmri_ts[:, :int(7200*0.9)]
     sel_fmri_ts = train_fmri_ts[:, int(7200*0.9):]
     # model testing
-    for i in range(15360):
-        print 'Model %s'%(i)
-        train_x = np.array(train_models[i, ...]).astype(np.float64)
-        train_x = zscore(train_x).T
-        # split training dataset into model tunning and selection sets
-        tune_x = train_x[:int(7200*0.9), :]
-        sel_x = train_x[int(7200*0.9):, :]
-        wt, r, alpha, bscores, valinds = ridge.bootstrap_ridge(
-                tune_x, tune_fmri_ts.T, sel_x, sel_fmri_ts.T,
+    if batch_size is not None:
+        for i in range(0, 15360, batch_size):
+            print 'Model %s-%s'%(i, min(15360, i+batch_size)-1)
+            batch_x = np.array(train_models[i:i+batch_size, ...]).astype(np.float64)
+            batch_x = np.array([zscore(x).T for x in batch_x])
+            wt, r, alpha, bscores, valinds = ridge.batch_bootstrap_ridge(
+                batch_x[:, :int(7200*0.9), :], tune_fmri_ts.T,
+                batch_x[:, int(7200*0.9):, :], sel_fmri_ts.T,
                 alphas=np.logspace(-2, 3, ALPHA_NUM),
                 nboots=BOOTS_NUM, chunklen=720, nchunks=1,
-                single_alpha=False, use_corr=False)
-        paras[i, ...] = wt.T
-        mcorr[i] = r
-        alphas[i] = alpha
+                single_alpha=False, use_corr=False, seed=seed)
+            paras[i:i+batch_size, vxl_sel] = wt.transpose(0, 2, 1)
+            mcorr[i:i+batch_size, vxl_sel] = r
+            alphas[i:i+batch_size, vxl_sel] = alpha
+    else:
+        # all candidate models are scored on the same bootstrap splits
+        split_plan = ridge.SplitPlan(int(7200*0.9), BOOTS_NUM, 720, 1, seed=seed)
+        for i in range(15360):
+            print 'Model %s'%(i)
+            train_x = np.array(train_models[i, ...]).astype(np.float64)
+            train_x = zscore(train_x).T
+            # split training dataset into model tunning and selection sets
+            tune_x = train_x[:int(7200*0.9), :]
+            sel_x = train_x[int(7200*0.9):, :]
+            wt, r, alpha, bscores, valinds = ridge.bootstrap_ridge(
+                    tune_x, tune_fmri_ts.T, sel_x, sel_fmri_ts.T,
+                    alphas=np.logspace(-2, 3, ALPHA_NUM),
+                    nboots=BOOTS_NUM, chunklen=720, nchunks=1,
+                    single_alpha=False, use_corr=False, n_jobs=n_jobs,
+                    svd_cache=svd_cache, split_plan=split_plan)
+            paras[i, vxl_sel] = wt.T
+            mcorr[i, vxl_sel] = r
+            alphas[i, vxl_sel] = alpha
     # save output
     paras = np.array(paras)
     np.save(paras_file, paras)
@@ -155,12 +155,13 @@ def hrf_estimate(tf, feat_ts):
     vxl_data = np.nan_to_num(vxl_data)
 
     out = np.zeros((290400, 40, 5))
-    for i in range(5):
-        for j in range(feat_ts.shape[0]):
-            print '%s - %s' %(i, j)
-            tmp = feat_ts[j, :]
-            tmp = (tmp - tmp.mean()) / tmp.std()
-            out[j, :, i] = time_lag_corr(tmp, vxl_data[i, :], 40)
+    for j in range(0, feat_ts.shape[0], 1024):
+        tmp = feat_ts[j:j+1024, :]
+        tmp = (tmp - tmp.mean(axis=1, keepdims=True)) / \
+              tmp.std(axis=1, keepdims=True)
+        # all features in the block x all voxels x all lags at once
+        c = time_lag_corr(tmp[:, None, :], vxl_data[None, :, :], 40)
+        out[j:j+1024] = c.transpose(0, 2, 1)
     np.save('hrf_test.npy', out)
 
 def pls_y_pred_x(plsca, Y):
@@ -12,7 +12,7 @@ from sklearn.linear_model import LassoCV
 
 from braincode.util import configParser
 from braincode.math import parallel_corr2_coef, corr2_coef, ridge
-from braincode.math import get_pls_components, rcca
+from braincode.math import get_pls_components, rcca, reliability
 from braincode.math import LinearRegression
 from braincode.math.norm import zero_one_norm, zscore
 from braincode.pipeline import retinotopy
@@ -219,6 +219,26 @@ if __name__ == '__main__':
         full_vxl_idx = np.nonzero(full_mask==1)[0]
         vxl_idx = np.intersect1d(full_vxl_idx, non_nan_idx)
         #np.save(os.path.join(subj_dir, 'full_vxl_idx.npy'), vxl_idx)
+    #-- voxel prescreening
+    # only keep voxels whose split-half reliability across the 10 repeated
+    # validation runs exceeds rel_thr and/or is among the rel_top_k highest,
+    # as set in the [prescreen] section of the config; leave both empty to
+    # keep all voxels
+    rel_thr = cf.get('prescreen', 'rel_thr')
+    rel_thr = float(rel_thr) if rel_thr else None
+    rel_top_k = cf.get('prescreen', 'rel_top_k')
+    rel_top_k = int(rel_top_k) if rel_top_k else None
+    if rel_thr is not None or rel_top_k is not None:
+        # data shape: (73728, 10, 540)
+        rep_fmri_ts = tf.get_node('/rva')[:]
+        if rep_fmri_ts.shape[0] != train_fmri_ts.shape[0]:
+            rep_fmri_ts = rep_fmri_ts.T
+        rel = reliability.split_half_reliability(
+                                np.nan_to_num(rep_fmri_ts[vxl_idx]))
+        del rep_fmri_ts
+        vxl_idx = vxl_idx[reliability.select_voxels(rel, threshold=rel_thr,
+                                                    top_k=rel_top_k)]
+        print 'Reliable voxel number: %s'%(len(vxl_idx))
     roi_dict = get_roi_idx(tf, vxl_idx)
     #np.save(os.path.join(subj_dir, 'roi_idx_pointer.npy'), roi_dict)
     #roi_dict = np.load(os.path.join(subj_dir, 'roi_idx_pointer.npy')).item()
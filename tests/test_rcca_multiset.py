@@ -0,0 +1,34 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""Multiset CCA of braincode.math.rcca."""
+
+import numpy as np
+
+from braincode.math import rcca
+
+
+def make_data(ntime=300, nfeats=(80, 120, 60), nshared=4, seed=0):
+    """z-scored datasets sharing `nshared` latent time courses."""
+    rng = np.random.RandomState(seed)
+    z = rng.randn(ntime, nshared)
+    data = [np.dot(z, rng.randn(nshared, f)) + 2*rng.randn(ntime, f)
+            for f in nfeats]
+    return [(d-d.mean(0))/d.std(0) for d in data]
+
+def test_regs_change_cv_score():
+    # the squared singular values of z-scored data are large, the grid of
+    # relative regs has to span weak to strong regularization all the same
+    data = make_data()
+    cca = rcca.MultisetCCA(regs=np.logspace(-4, 2, 10), numCCs=[4], numCV=3,
+                           rank=40, seed=0, verbose=False)
+    cca.train(data)
+    assert np.ptp(cca.cv_corrs[:, 0]) > 1e-2
+
+def test_add_subject():
+    # a dataset added after training gets the weights of a joint fit
+    data = make_data()
+    cca = rcca.MultisetCCA(reg=0.1, numCC=4, verbose=False).train(data)
+    w = cca.add_subject(data[1])
+    assert np.allclose(w, cca.ws[1])
+    assert len(cca.ws) == 4
@@ -0,0 +1,32 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""Solver choice of braincode.math.rcca."""
+
+import numpy as np
+
+from braincode.math import rcca
+
+
+def make_data(ntime=150, nfeats=(20, 30), nshared=3, seed=0):
+    """Datasets sharing `nshared` latent time courses."""
+    rng = np.random.RandomState(seed)
+    z = rng.randn(ntime, nshared)
+    return [np.dot(z, rng.randn(nshared, f)) + rng.randn(ntime, f)
+            for f in nfeats]
+
+def test_auto_picks_primal_for_linear_kernel():
+    shapes = [(150, 20), (150, 30)]
+    assert rcca.choose_solver(shapes) == "primal"
+    assert rcca.choose_solver(shapes, ktype="gaussian") == "kernel"
+    assert rcca.choose_solver(shapes, kapprox="nystrom") == "kernel"
+    assert rcca.choose_solver([(150, 100), (150, 80)]) == "kernel"
+
+def test_linear_kernel_primal_matches_kernel():
+    for data in (make_data(), make_data(nfeats=(20, 30, 15))):
+        kernel = rcca.CCA(reg=0.1, numCC=3, solver="kernel",
+                          verbose=False).train(data)
+        primal = rcca.CCA(reg=0.1, numCC=3, verbose=False).train(data)
+        assert np.allclose(primal.cancorrs, kernel.cancorrs)
+        for wp, wk in zip(primal.ws, kernel.ws):
+            assert np.allclose(np.abs(wp), np.abs(wk))
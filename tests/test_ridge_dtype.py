@@ -0,0 +1,65 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""Correlations of the float32 compute mode of braincode.math.ridge against
+the float64 reference."""
+
+import numpy as np
+
+from braincode.math import ridge
+
+# bound of the absolute correlation difference between float32 and float64
+TOL = 1e-5
+
+ALPHAS = np.logspace(0, 3, 5)
+
+
+def make_data(ntrain=200, ntest=60, nfeat=40, nresp=30, seed=0):
+    rng = np.random.RandomState(seed)
+    Rstim = rng.randn(ntrain, nfeat)
+    Pstim = rng.randn(ntest, nfeat)
+    wt = rng.randn(nfeat, nresp)
+    Rresp = np.dot(Rstim, wt) + 5*rng.randn(ntrain, nresp)
+    Presp = np.dot(Pstim, wt) + 5*rng.randn(ntest, nresp)
+    return Rstim, Pstim, Rresp, Presp
+
+def max_corr_diff(single, double):
+    return np.max(np.abs(np.asarray(single) - np.asarray(double)))
+
+def check_ridge_corr(**kwargs):
+    Rstim, Pstim, Rresp, Presp = make_data()
+    corrs = [ridge.ridge_corr(Rstim, Pstim, Rresp, Presp, ALPHAS,
+                              dtype=dtype, **kwargs)
+             for dtype in (np.float32, np.float64)]
+    assert max_corr_diff(*corrs) < TOL
+
+def check_bootstrap_ridge(**kwargs):
+    Rstim, Pstim, Rresp, Presp = make_data()
+    results = [ridge.bootstrap_ridge(Rstim, Rresp, Pstim, Presp, ALPHAS,
+                                     nboots=4, chunklen=10, nchunks=4,
+                                     seed=0, dtype=dtype, **kwargs)
+               for dtype in (np.float32, np.float64)]
+    single, double = results
+    # bootstrap correlations of every split and alpha
+    assert max_corr_diff(single[3], double[3]) < TOL
+    # the same alphas are selected, and give the same test correlations
+    assert np.all(single[2] == double[2])
+    assert max_corr_diff(single[1], double[1]) < TOL
+
+def test_ridge_corr_primal():
+    check_ridge_corr(solver="primal")
+
+def test_ridge_corr_dual():
+    check_ridge_corr(solver="dual")
+
+def test_ridge_corr_batched():
+    check_ridge_corr(solver="primal", batched=True)
+
+def test_bootstrap_ridge_primal():
+    check_bootstrap_ridge(solver="primal")
+
+def test_bootstrap_ridge_dual():
+    check_bootstrap_ridge(solver="dual")
+
+def test_bootstrap_ridge_batched():
+    check_bootstrap_ridge(solver="primal", batched=True)
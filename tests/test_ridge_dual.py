@@ -0,0 +1,37 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""Weights returned by the dual solver of braincode.math.ridge."""
+
+import numpy as np
+
+from braincode.math import ridge
+
+
+def make_data(ntime=50, nfeat=120, nresp=8, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randn(ntime, nfeat), rng.randn(ntime, nresp)
+
+def test_ridge_auto_returns_array():
+    # "auto" picks the dual solver for N > T but still returns the weights
+    stim, resp = make_data()
+    wt = ridge.ridge(stim, resp, 10.)
+    assert isinstance(wt, np.ndarray)
+    primal = ridge.ridge(stim, resp, 10., solver="primal")
+    assert np.allclose(wt, primal)
+
+def test_ridge_return_dual():
+    stim, resp = make_data()
+    wt = ridge.ridge(stim, resp, 10., return_dual=True)
+    assert isinstance(wt, ridge.DualWeights)
+    assert np.allclose(np.asarray(wt), ridge.ridge(stim, resp, 10.))
+
+def test_bootstrap_ridge_auto_returns_array():
+    stim, resp = make_data(ntime=200, nfeat=300)
+    results = [ridge.bootstrap_ridge(stim, resp, stim[:40], resp[:40],
+                                     np.logspace(0, 2, 3), 2, 10, 4, seed=0,
+                                     return_dual=return_dual)
+               for return_dual in (False, True)]
+    assert isinstance(results[0][0], np.ndarray)
+    assert isinstance(results[1][0], ridge.DualWeights)
+    assert np.allclose(results[0][0], np.asarray(results[1][0]))
@@ -0,0 +1,34 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""bootstrap_ridge scoring of precomputed SplitPlan splits."""
+
+import numpy as np
+
+from braincode.math import ridge
+
+ALPHAS = np.logspace(0, 3, 5)
+
+
+def make_data(ntrain=240, ntest=60, nfeat=12, nresp=20, seed=0):
+    rng = np.random.RandomState(seed)
+    Rstim = rng.randn(ntrain, nfeat)
+    Pstim = rng.randn(ntest, nfeat)
+    wt = rng.randn(nfeat, nresp)
+    Rresp = np.dot(Rstim, wt) + 3*rng.randn(ntrain, nresp)
+    Presp = np.dot(Pstim, wt) + 3*rng.randn(ntest, nresp)
+    return Rstim, Pstim, Rresp, Presp
+
+def test_suffstats_split_plan():
+    # the chunklen of the call differs from that of the plan
+    Rstim, Pstim, Rresp, Presp = make_data()
+    plan = ridge.SplitPlan(len(Rresp), 4, 15, 4, seed=0)
+    results = [ridge.bootstrap_ridge(Rstim, Rresp, Pstim, Presp, ALPHAS,
+                                     nboots=4, chunklen=10, nchunks=4,
+                                     solver="primal", suffstats=suffstats,
+                                     split_plan=plan)
+               for suffstats in (False, True)]
+    default, suffstats = results
+    assert np.allclose(suffstats[3], default[3], atol=1e-8)
+    assert np.all(suffstats[2] == default[2])
+    assert np.allclose(suffstats[1], default[1], atol=1e-8)